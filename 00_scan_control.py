@@ -2,45 +2,53 @@ import subprocess
 import time
 import json
 import os
-from datetime import datetime, timedelta
+import heapq
+import importlib.util
+import queue
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+
+import metrics
+import rootbox_log
+import sane_session
+import state_store
+from scan_executor import run_scan, release_parked, release_quarantined, scan_timeout, DeviceBusy, ScanTimeout, DEFAULT_MAX_SCANS_PER_BUS, DEFAULT_GROUP_BY
 
 # Define dynamic paths
 HOME_DIR = os.path.expanduser("~")
 ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
 
 SETTINGS_PATH = os.path.join(ROOTBOX_DIR, 'web', 'settings.json')
-LOG_DIR = os.path.join(ROOTBOX_DIR, 'logs')
-LOG_PATH = os.path.join(LOG_DIR, 'control_log.txt')
 PID_FILE = os.path.join(ROOTBOX_DIR, 'controller.pid')
 
-SCAN_IMAGE_SCRIPT = os.path.join(ROOTBOX_DIR, '01_scan_image.py')
 IMAGE_MANAGER_SCRIPT = os.path.join(ROOTBOX_DIR, '02_image_manager.py')
+SCAN_IMAGE_SCRIPT = os.path.join(ROOTBOX_DIR, '01_scan_image.py')
 
-def rotate_log():
-    os.makedirs(LOG_DIR, exist_ok=True)
-
-    if os.path.exists(LOG_PATH):
-        timestamp = datetime.now().strftime('%d-%m-%Y-%H-%M')
-        archived_log = os.path.join(LOG_DIR, f"control_log_{timestamp}.txt")
-        os.rename(LOG_PATH, archived_log)
-
-    log_files = sorted(
-        [f for f in os.listdir(LOG_DIR) if f.startswith("control_log") and f.endswith(".txt")],
-        key=lambda f: os.path.getmtime(os.path.join(LOG_DIR, f))
-    )
+# Upper bound on scans running at once; per-device locks and the per-bus
+# limit in scan_executor decide which of them actually touch the USB bus.
+MAX_PARALLEL_SCANS = 6
 
-    while len(log_files) > 5:
-        oldest = log_files.pop(0)
-        try:
-            os.remove(os.path.join(LOG_DIR, oldest))
-        except Exception as e:
-            print(f"⚠️ Failed to delete old log {oldest}: {e}")
+# How often settings.json is stat()ed for changes while waiting for the next
+# deadline. Only an mtime check, so idle cost is negligible.
+SETTINGS_POLL_SECONDS = 1
+# Delay before a failed scan is attempted again; doubles with each
+# consecutive failure up to the maximum
+RETRY_DELAY_SECONDS = 30
+MAX_RETRY_DELAY_SECONDS = 3600
+# A scanner is marked degraded after a timeout, or this many failures in a row
+DEGRADE_AFTER_FAILURES = 3
+# After a restart a scanner keeps its phase (last scan + whole intervals). A
+# slot missed by no more than this is still taken straight away; otherwise
+# the scanner waits for its next slot.
+CATCH_UP_GRACE_SECONDS = 300
 
-def log(message):
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(LOG_PATH, 'a') as f:
-        f.write(f"[{timestamp}] {message}\n")
-    print(f"[{timestamp}] {message}")
+def log(message, **fields):
+    """Structured log record (see rootbox_log); extra fields e.g. scanner, stage, duration."""
+    rootbox_log.log(message, source="controller", **fields)
 
 def load_settings():
     try:
@@ -51,68 +59,313 @@ def load_settings():
         return {}
 
 def save_settings(settings):
+    """Write settings.json via a temp file and rename, so readers never see it half-written."""
     try:
-        with open(SETTINGS_PATH, 'w') as f:
+        tmp = SETTINGS_PATH + ".tmp"
+        with open(tmp, 'w') as f:
             json.dump(settings, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, SETTINGS_PATH)
     except Exception as e:
         log(f"⚠️ Failed to save settings: {e}")
 
-# Rotate log at startup
-rotate_log()
+def settings_mtime():
+    try:
+        return os.stat(SETTINGS_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+def fmt_time(ts):
+    return datetime.fromtimestamp(ts).strftime('%H:%M:%S')
+
+def schedule(scanner_id, due):
+    """Set the next deadline for a scanner. Older heap entries for it become stale."""
+    next_due[scanner_id] = due
+    heapq.heappush(deadlines, (due, scanner_id))
+    state_store.set_next_due(scanner_id, due)
+
+def interval_seconds(config):
+    """A scanner's scan interval in seconds, never less than a minute."""
+    try:
+        minutes = int(config.get("interval_minutes", 60) or 0)
+    except (TypeError, ValueError):
+        log(f"⚠️ Invalid interval_minutes {config.get('interval_minutes')!r}; using 60", level="warning")
+        minutes = 60
+    return max(minutes * 60, 60)
+
+def next_in_phase(last_run, interval, now):
+    """Next deadline on the grid last_run + k * interval, catching up a slot missed only just."""
+    due = last_run + interval
+    if due >= now:
+        return due
+    missed = last_run + interval * ((now - last_run) // interval)
+    return now if now - missed <= CATCH_UP_GRACE_SECONDS else missed + interval
+
+def restore_state():
+    """Seed last run times, failure counts and saved deadlines from the state store."""
+    for scanner_id, state in state_store.scanner_states().items():
+        if state["last_scan"]:
+            last_run_times[scanner_id] = state["last_scan"]
+        if state["failures"]:
+            failures[scanner_id] = state["failures"]
+        if state["degraded_reason"]:
+            degraded.add(scanner_id)
+        if state["next_due"]:
+            saved_due[scanner_id] = state["next_due"]
+
+def reschedule_all(scanners):
+    """
+    Bring the deadline heap in line with freshly loaded settings. Scanners
+    that have scanned before keep their phase; new ones are spread evenly
+    across their interval instead of all starting at once.
+    """
+    now = time.time()
+    for scanner_id in list(next_due):
+        config = scanners.get(scanner_id, {})
+        if not config.get("enabled", False):
+            del next_due[scanner_id]
+            state_store.set_next_due(scanner_id, None)
+            log(f"⏸ {scanner_id} disabled; removed from schedule")
+
+    fresh = []
+    for scanner_id, config in scanners.items():
+        if not config.get("enabled", False) or scanner_id in running_scans:
+            continue
+        interval = interval_seconds(config)
+        if scanner_id in next_due and intervals.get(scanner_id) == interval:
+            continue
+        intervals[scanner_id] = interval
+        last_run = last_run_times.get(scanner_id)
+        due = saved_due.pop(scanner_id, None)
+        if due is not None and due >= now:
+            # Deadline from before a restart (e.g. a retry backoff) still ahead
+            due = min(due, now + interval)
+        elif last_run is not None:
+            due = next_in_phase(last_run, interval, now)
+        else:
+            fresh.append((scanner_id, interval))
+            continue
+        schedule(scanner_id, due)
+        log(f"🗓 Next scan for {scanner_id} at {fmt_time(due)}")
+
+    for i, (scanner_id, interval) in enumerate(sorted(fresh)):
+        due = now + interval * i / len(fresh)
+        schedule(scanner_id, due)
+        log(f"🗓 Next scan for {scanner_id} at {fmt_time(due)} (staggered {i + 1}/{len(fresh)})")
+
+def on_scan_done(_future):
+    wake.set()
+
+def retry_delay(failure_count):
+    return min(RETRY_DELAY_SECONDS * 2 ** (failure_count - 1), MAX_RETRY_DELAY_SECONDS)
+
+def load_script(name, path):
+    """Import one of the numbered RootBox scripts as a module."""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def start_image_manager():
+    """
+    Run 02_image_manager.py as a long-lived worker thread in this process, so
+    its Drive service, credentials and folder IDs stay cached between scans.
+    Returns the thread, or None if the image manager could not be loaded.
+    """
+    try:
+        image_manager = load_script("image_manager", IMAGE_MANAGER_SCRIPT)
+    except Exception as e:
+        log(f"❌ Image manager failed to load: {e}")
+        return None
+    thread = threading.Thread(
+        target=image_manager.run_worker,
+        args=(scan_events, stop_event),
+        name="image-manager",
+        daemon=True,
+    )
+    thread.start()
+    log("🧹 Image manager worker started.")
+    return thread
+
+def load_scan_engine():
+    """
+    Load 01_scan_image.py in-process when python-sane is available, so scans
+    reuse open SANE device handles. Returns the module, or None to run each
+    scan as a scanimage subprocess.
+    """
+    if not sane_session.available():
+        log("ℹ️ python-sane not installed; scans will use scanimage")
+        return None
+    try:
+        module = load_script("scan_image", SCAN_IMAGE_SCRIPT)
+    except Exception as e:
+        log(f"❌ Scan engine failed to load, using scanimage: {e}")
+        return None
+    log("📠 Using persistent SANE sessions for scans.")
+    return module
+
+def scan_function(settings):
+    """In-process scan callable for run_scan, or None for the subprocess path."""
+    if scan_engine is None:
+        return None
+    if settings.get("capture", {}).get("engine", "auto") == "scanimage":
+        return None
+    return partial(scan_engine.scan, in_process=True)
 
 # Write PID
 with open(PID_FILE, 'w') as f:
     f.write(str(os.getpid()))
 
+# The web UI stops the controller with SIGTERM; exit through the cleanup
+# below so queued log records are written
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
 log("🟢 Controller started.")
 
-last_run_times = {}
+last_run_times = {}  # scanner_id -> start time (epoch seconds) of last good scan
+running_scans = {}   # scanner_id -> (future, start time)
+deadlines = []       # heap of (due time, scanner_id)
+failures = {}        # scanner_id -> consecutive failed scans
+degraded = set()     # scanner_ids currently marked degraded
+saved_due = {}       # scanner_id -> deadline restored from the state store, until first scheduled
+next_due = {}        # scanner_id -> current deadline; heap entries that disagree are stale
+intervals = {}       # scanner_id -> interval in seconds the deadline was computed with
+wake = threading.Event()
+scan_events = queue.Queue()  # scanner IDs of finished scans, consumed by the image manager
+stop_event = threading.Event()
+executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_SCANS)
 
 try:
+    start_image_manager()
+    scan_engine = load_scan_engine()
+
+    settings = load_settings()
+    if state_store.migrate_settings(settings):
+        save_settings(settings)
+        log("🔧 Moved runtime state out of settings.json")
+    restore_state()
+    loaded_mtime = settings_mtime()
+    reschedule_all(settings.get("scanners", {}))
+
     while True:
-        settings = load_settings()
+        # Hand manual scans from the web UI to the image manager
+        for scanner_id in state_store.take_scan_events():
+            scan_events.put(scanner_id)
+
+        # Pick up settings edits from the web UI
+        mtime = settings_mtime()
+        if mtime != loaded_mtime:
+            settings = load_settings()
+            loaded_mtime = mtime
+            log("🔧 Settings changed; rescheduling")
+            reschedule_all(settings.get("scanners", {}))
+
         scanners = settings.get("scanners", {})
+        max_per_bus = settings.get("max_scans_per_bus", DEFAULT_MAX_SCANS_PER_BUS)
+        group_by = settings.get("scan_group_by", DEFAULT_GROUP_BY)
 
-        for scanner_id, config in scanners.items():
-            label = config.get("label", scanner_id)
-            enabled = config.get("enabled", False)
-            interval = config.get("interval_minutes", 60)
-            resolution = config.get("resolution", 150)
+        # Free devices whose SANE session has sat unused for a while, or
+        # that a manual scan or options query is waiting for
+        for device in release_parked(settings.get("sane_idle_seconds", sane_session.DEFAULT_IDLE_SECONDS)):
+            log(f"💤 Closed SANE session for {device} and released the device")
+        for device in release_quarantined():
+            log(f"🩹 Hung scan on {device} has exited; device released")
 
-            if not enabled:
+        # Collect scans that finished since the last pass
+        for scanner_id, (future, started) in list(running_scans.items()):
+            if not future.done():
                 continue
+            del running_scans[scanner_id]
+            config = scanners.get(scanner_id, {})
+            interval = interval_seconds(config)
+            try:
+                future.result()
+                last_run_times[scanner_id] = started
+                failures.pop(scanner_id, None)
+                state_store.record_success(scanner_id, started)
+                if scanner_id in degraded:
+                    degraded.discard(scanner_id)
+                    log(f"💚 {scanner_id} recovered", scanner=scanner_id, stage="health")
+                log(f"✅ Scan complete for {scanner_id}", scanner=scanner_id, stage="scan",
+                    duration=time.time() - started)
+                metrics.observe("rootbox_scan_seconds", time.time() - started, scanner=scanner_id)
+                metrics.inc("rootbox_scans_total", scanner=scanner_id, result="ok")
+                scan_events.put(scanner_id)
+                due = started + interval
+            except DeviceBusy as e:
+                # Held by a manual scan or an options query; the scanner is fine
+                metrics.inc("rootbox_scans_total", scanner=scanner_id, result="busy")
+                log(f"⏳ {scanner_id} busy, retrying in {RETRY_DELAY_SECONDS}s: {e}", scanner=scanner_id, stage="scan")
+                due = time.time() + RETRY_DELAY_SECONDS
+            except Exception as e:
+                failures[scanner_id] = failures.get(scanner_id, 0) + 1
+                delay = retry_delay(failures[scanner_id])
+                fields = {"scanner": scanner_id, "stage": "scan", "duration": time.time() - started, "level": "error"}
+                metrics.inc("rootbox_scans_total", scanner=scanner_id,
+                            result="timeout" if isinstance(e, ScanTimeout) else "failed")
+                if isinstance(e, ScanTimeout):
+                    log(f"⏱ Scan timed out for {scanner_id}: {e}", **fields)
+                elif isinstance(e, subprocess.CalledProcessError):
+                    log(f"❌ Scan failed for {scanner_id}: {e}", **fields)
+                else:
+                    log(f"❌ Scan error for {scanner_id}: {e}", **fields)
+                if isinstance(e, ScanTimeout) or failures[scanner_id] >= DEGRADE_AFTER_FAILURES:
+                    log(f"🚧 {scanner_id} marked degraded after {failures[scanner_id]} failure(s); backing off {delay:.0f}s",
+                        scanner=scanner_id, stage="health", level="warning")
+                    degraded.add(scanner_id)
+                    state_store.record_failure(scanner_id, failures[scanner_id], str(e))
+                else:
+                    state_store.record_failure(scanner_id, failures[scanner_id])
+                due = time.time() + delay
 
-            now = datetime.now()
-            last_run = last_run_times.get(scanner_id, now - timedelta(minutes=interval + 1))
-            elapsed = (now - last_run).total_seconds() / 60
-
-            if elapsed >= interval:
-                log(f"▶ Running scan for {scanner_id} ({label}) at {resolution}dpi")
+            if config.get("enabled", False):
+                schedule(scanner_id, due)
+                intervals[scanner_id] = interval
+                log(f"🗓 Next scan for {scanner_id} at {fmt_time(due)}")
 
-                try:
-                    subprocess.run(["python3", SCAN_IMAGE_SCRIPT, scanner_id], check=True)
-                    last_run_times[scanner_id] = now
-                    settings["scanners"][scanner_id]["last_scan"] = now.isoformat()
-                    save_settings(settings)
-                    log(f"✅ Scan complete for {scanner_id}")
-                except subprocess.CalledProcessError as e:
-                    log(f"❌ Scan failed for {scanner_id}: {e}")
+        # Launch every scan whose deadline has passed
+        now = time.time()
+        while deadlines and deadlines[0][0] <= now:
+            due, scanner_id = heapq.heappop(deadlines)
+            if next_due.get(scanner_id) != due or scanner_id in running_scans:
+                continue  # stale entry
+            del next_due[scanner_id]
+            config = scanners.get(scanner_id, {})
+            label = config.get("label", scanner_id)
+            resolution = config.get("resolution", 150)
+            device = config.get("device", "")
+            timeout = scan_timeout(resolution, settings.get("scan_timeouts"), config.get("scan_timeout_seconds"))
 
-            else:
-                log(f"⏳ Skipping {scanner_id} — next scan in {interval - int(elapsed)} min")
+            log(f"▶ Running scan for {scanner_id} ({label}) at {resolution}dpi", scanner=scanner_id, stage="scan")
+            future = executor.submit(run_scan, scanner_id, device, max_per_bus, group_by,
+                                     scan_function(settings), timeout)
+            running_scans[scanner_id] = (future, now)
+            future.add_done_callback(on_scan_done)
 
-        try:
-            subprocess.run(["python3", IMAGE_MANAGER_SCRIPT], check=True)
-            log("🧹 Image manager complete.")
-        except subprocess.CalledProcessError as e:
-            log(f"❌ Image manager failed: {e}")
+        metrics.set_gauge("rootbox_scans_running", len(running_scans))
+        metrics.set_gauge("rootbox_scanners_degraded", len(degraded))
 
-        time.sleep(30)
+        # Sleep until the earliest deadline, a finished scan or the next settings check
+        while deadlines and next_due.get(deadlines[0][1]) != deadlines[0][0]:
+            heapq.heappop(deadlines)
+        timeout = SETTINGS_POLL_SECONDS
+        if deadlines:
+            timeout = min(timeout, max(0, deadlines[0][0] - time.time()))
+        wake.wait(timeout)
+        wake.clear()
 
 except KeyboardInterrupt:
     log("🛑 Controller stopped by keyboard.")
+except SystemExit:
+    log("🛑 Controller stopped.")
 except Exception as e:
     log(f"❗ Unexpected error: {e}")
 finally:
+    stop_event.set()
+    scan_events.put(None)
+    executor.shutdown(wait=False)
+    sane_session.close_all()
+    rootbox_log.close()
     if os.path.exists(PID_FILE):
         os.remove(PID_FILE)
@@ -4,6 +4,17 @@ import json
 import time
 import subprocess
 
+import change_detect
+import device_options
+import image_catalog
+import metrics
+import sane_session
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it only batch capture is available
+    Image = None
+
 # Find user home and RootBox directory
 HOME_DIR = os.path.expanduser("~")
 ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
@@ -11,6 +22,33 @@ ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
 SETTINGS_PATH = os.path.join(ROOTBOX_DIR, 'web', 'settings.json')
 SCAN_IMAGES_DIR = os.path.join(ROOTBOX_DIR, 'scan_images')
 
+# Set SCANIMAGE to use a different scanimage binary (e.g. a stand-in for testing)
+SCANIMAGE = os.environ.get("SCANIMAGE", "scanimage")
+
+# Capture defaults, overridden by the "capture" block in settings.json:
+#   engine: "sane" keeps a SANE device handle open between scans (python-sane,
+#           only worthwhile inside a long-running process such as the
+#           controller); "scanimage" runs the scanimage CLI for every scan;
+#           "auto" uses sane in-process when python-sane is installed
+#   mode: "stream" pipes raw PNM from scanimage into an in-process encoder;
+#         "batch" lets scanimage write the PNG itself (scanimage engine only)
+#   format: png / webp / tiff (sane engine and stream mode)
+#   compress_level: 0-9 for PNG (sane engine and stream mode)
+DEFAULT_CAPTURE = {"engine": "auto", "mode": "stream", "format": "png", "compress_level": 6}
+
+# Output formats for stream mode: extension and Pillow save options
+STREAM_FORMATS = {
+    "png": (".png", lambda level: {"format": "PNG", "compress_level": level}),
+    "webp": (".webp", lambda level: {"format": "WEBP", "lossless": True, "method": min(6, level)}),
+    "tiff": (".tif", lambda level: {"format": "TIFF", "compression": "tiff_adobe_deflate"}),
+}
+
+# Rows of a streamed scan are decoded this many bytes at a time
+PNM_BAND_BYTES = 4 * 1024 * 1024
+
+class ScanError(Exception):
+    """A scan could not be taken or saved."""
+
 def load_settings():
     try:
         with open(SETTINGS_PATH, 'r') as f:
@@ -19,52 +57,238 @@ def load_settings():
         print(f"Failed to load settings: {e}")
         return {}
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python3 01_scan_image.py scanner_id")
-        sys.exit(1)
+def resolve_engine(capture, in_process=False):
+    """Pick "sane" or "scanimage" for the configured engine."""
+    engine = capture.get("engine", "auto")
+    if engine == "auto":
+        engine = "sane" if in_process and sane_session.available() else "scanimage"
+    if engine == "sane" and not sane_session.available():
+        print("python-sane not installed; falling back to scanimage")
+        engine = "scanimage"
+    return engine
+
+# -----------------------------
+# Capture
+# -----------------------------
+def _read_token(stream):
+    """Next whitespace-delimited token of a PNM header, skipping comments."""
+    token = b""
+    while True:
+        c = stream.read(1)
+        if not c:
+            break
+        if c == b"#":
+            while c not in (b"\n", b""):
+                c = stream.read(1)
+            continue
+        if c.isspace():
+            if token:
+                break
+            continue
+        token += c
+    return token
+
+def read_pnm(stream):
+    """
+    Read one binary PNM image (P4/P5/P6, as written by scanimage
+    --format=pnm) from a stream and return it as a Pillow image.
+    Pixel rows are decoded a band at a time straight into the image, so
+    apart from the image itself only one band (PNM_BAND_BYTES) is held in
+    memory; nothing touches the disk.
+    """
+    magic = _read_token(stream)
+    if magic not in (b"P4", b"P5", b"P6"):
+        raise ValueError(f"Unsupported PNM stream (magic {magic!r})")
+    width = int(_read_token(stream))
+    height = int(_read_token(stream))
+    maxval = 1 if magic == b"P4" else int(_read_token(stream))
+
+    if magic == b"P4":
+        mode, raw_mode, row_bytes = "1", "1;I", (width + 7) // 8
+    elif maxval > 255:
+        if magic == b"P6":
+            raise ValueError("16-bit colour is not supported in stream mode; use batch mode")
+        mode, raw_mode, row_bytes = "I;16B", "I;16B", width * 2
+    elif magic == b"P5":
+        mode, raw_mode, row_bytes = "L", "L", width
+    else:
+        mode, raw_mode, row_bytes = "RGB", "RGB", width * 3
 
-    scanner_id = sys.argv[1]
+    img = Image.new(mode, (width, height))
+    band_rows = max(1, min(height, PNM_BAND_BYTES // row_bytes))
+    band = bytearray(band_rows * row_bytes)
+    view = memoryview(band)
+    for top in range(0, height, band_rows):
+        rows = min(band_rows, height - top)
+        size = rows * row_bytes
+        pos = 0
+        while pos < size:
+            n = stream.readinto(view[pos:size])
+            if not n:
+                raise ValueError(f"Scan stream ended early ({top * row_bytes + pos} of {height * row_bytes} bytes)")
+            pos += n
+        img.paste(Image.frombuffer(mode, (width, rows), band[:size] if rows < band_rows else band,
+                                   "raw", raw_mode, 0, 1), (0, top))
+    return img
 
+def _commit(tmp_path, final_path):
+    """fsync a finished temp file and atomically move it into place."""
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, final_path)
+
+def capture_stream(scan_cmd, final_path, fmt, compress_level):
+    """
+    Run scanimage with PNM on stdout, encode in-process and write the result
+    once, via a hidden temp file that is renamed into place when complete.
+    Returns the decoded image.
+    """
+    tmp_path = os.path.join(os.path.dirname(final_path), f".{os.path.basename(final_path)}.part")
+    _, options = STREAM_FORMATS[fmt]
+    proc = subprocess.Popen(scan_cmd + ["--format=pnm"], stdout=subprocess.PIPE)
+    try:
+        img = read_pnm(proc.stdout)
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, scan_cmd)
+        img.save(tmp_path, **options(compress_level))
+        _commit(tmp_path, final_path)
+        return img
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def capture_batch(scan_cmd, final_path):
+    """Let scanimage write the PNG itself, to a hidden temp name renamed on success."""
+    tmp_path = os.path.join(os.path.dirname(final_path), f".{os.path.basename(final_path)}.part")
+    try:
+        subprocess.run(scan_cmd + [
+            "--format=png",
+            "--batch={}".format(tmp_path),
+            "--batch-start=1",
+            "--batch-count=1"
+        ], check=True)
+        _commit(tmp_path, final_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def capture_sane(device, config, final_path, fmt, compress_level):
+    """Scan through a persistent SANE session and write the result via a temp file. Returns the image."""
+    tmp_path = os.path.join(os.path.dirname(final_path), f".{os.path.basename(final_path)}.part")
+    _, options = STREAM_FORMATS[fmt]
+    try:
+        img = sane_session.scan(device, config.get("resolution", 150), config.get("mode") or "Color",
+                                config.get("depth"), device_options.sane_geometry(config.get("roi")))
+        img.save(tmp_path, **options(compress_level))
+        _commit(tmp_path, final_path)
+        return img
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def scan(scanner_id, in_process=False):
+    """
+    Take one scan for a scanner and record it in the catalog. Returns the
+    path of the saved image; raises ScanError on failure. The controller
+    calls this directly (in_process=True) so SANE sessions outlive a scan.
+    """
     settings = load_settings()
     scanners = settings.get("scanners", {})
 
     if scanner_id not in scanners:
-        print(f"Scanner ID '{scanner_id}' not found in settings.")
-        sys.exit(1)
+        raise ScanError(f"Scanner ID '{scanner_id}' not found in settings.")
 
     config = scanners[scanner_id]
     label = config.get("label", scanner_id).replace(" ", "_")
     device = config.get("device", "")
     resolution = config.get("resolution", 150)
 
+    capture = dict(DEFAULT_CAPTURE, **settings.get("capture", {}))
+    engine = resolve_engine(capture, in_process)
+    mode = capture["mode"]
+    fmt = capture["format"] if capture["format"] in STREAM_FORMATS else "png"
+    depth = int(config.get("depth") or 8)
+    if depth > 8:
+        # python-sane only returns 8-bit images, and Pillow has no 48-bit RGB
+        # mode, so 16-bit colour is left to scanimage to write
+        if engine == "sane":
+            sane_session.close_session(device)
+            engine = "scanimage"
+        if (config.get("mode") or "Color") == "Color":
+            mode = "batch"
+        if fmt == "webp":
+            # WebP only holds 8 bits per channel
+            print(f"{depth}-bit scans cannot be stored as WebP; saving as PNG")
+            fmt = "png"
+    if engine == "scanimage" and mode == "stream" and Image is None:
+        print("Pillow not installed; falling back to batch capture")
+        mode = "batch"
+    if engine == "scanimage" and mode != "stream":
+        fmt = "png"
+
     # Prepare folder for this scanner
     scanner_folder = os.path.join(SCAN_IMAGES_DIR, scanner_id)
     os.makedirs(scanner_folder, exist_ok=True)
 
     # Unix timestamp for filename
     timestamp = int(time.time())
-    filename = f"{scanner_id}-{label}-{timestamp}.png"
+    filename = f"{scanner_id}-{label}-{timestamp}{STREAM_FORMATS[fmt][0]}"
     filepath = os.path.join(scanner_folder, filename)
 
     # Build scan command
     scan_cmd = [
-        "scanimage",
+        SCANIMAGE,
         "-d", device,
-        "--format=png",
         f"--resolution={resolution}",
-        "--mode", "Color",
-        "--batch={}".format(filepath),
-        "--batch-start=1",
-        "--batch-count=1"
-    ]
+    ] + device_options.scanimage_args(config)
 
+    started = time.time()
+    img = None  # the captured image, when it was decoded in this process
     try:
-        print(f"Starting scan for {scanner_id} ({label}) at {resolution} dpi...")
-        subprocess.run(scan_cmd, check=True)
+        if engine == "sane":
+            print(f"Starting SANE session scan for {scanner_id} ({label}) at {resolution} dpi...")
+            img = capture_sane(device, config, filepath, fmt, int(capture["compress_level"]))
+        else:
+            print(f"Starting {mode} scan for {scanner_id} ({label}) at {resolution} dpi...")
+            if mode == "stream":
+                img = capture_stream(scan_cmd, filepath, fmt, int(capture["compress_level"]))
+            else:
+                capture_batch(scan_cmd, filepath)
         print(f"Scan saved to {filepath}")
-    except subprocess.CalledProcessError as e:
-        print(f"Scan failed: {e}")
+    except Exception as e:
+        raise ScanError(f"Scan failed: {e}") from e
+    size = os.path.getsize(filepath)
+    metrics.observe("rootbox_capture_seconds", time.time() - started, scanner=scanner_id, engine=engine)
+    metrics.inc("rootbox_image_bytes_total", size, scanner=scanner_id)
+
+    # Record the new scan so the image manager doesn't have to go looking for it
+    try:
+        image_catalog.add_image(scanner_id, filepath, timestamp, size, depth=depth)
+    except Exception as e:
+        print(f"Failed to record scan in catalog: {e}")
+
+    # Fingerprint the scan while it is still in memory, for the image
+    # manager's change detection (batch captures are fingerprinted from file)
+    if img is not None and change_detect.available():
+        try:
+            change_detect.record(scanner_id, filename, img)
+        except Exception as e:
+            print(f"Failed to record scan signature: {e}")
+    return filepath
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python3 01_scan_image.py scanner_id")
+        sys.exit(1)
+
+    try:
+        scan(sys.argv[1])
+    except ScanError as e:
+        print(e)
         sys.exit(1)
 
 if __name__ == "__main__":
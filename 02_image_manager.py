@@ -1,15 +1,29 @@
 import os
+import fcntl
 import shutil
 import json
+import mimetypes
 import pickle
+import multiprocessing
+import queue
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import getpass
 
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+
+import change_detect
+import drive_upload
+import image_catalog
+import metrics
+import previews
+import recompress
+import rootbox_log
+import upload_queue
+import usb_sync
 
 # -----------------------------
 # CONFIG
@@ -19,44 +33,101 @@ ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
 
 SCAN_DIR = os.path.join(ROOTBOX_DIR, "scan_images")
 OLD_DIR = os.path.join(ROOTBOX_DIR, "old")
-LOG_FILE = os.path.join(ROOTBOX_DIR, "logs", "control_log.txt")
 
+# Legacy per-scanner "last uploaded timestamp" file. Only read to seed the
+# upload queue so images uploaded before the queue existed are not re-sent.
 LAST_UPLOAD_FILE = os.path.join(ROOTBOX_DIR, "last_upload.json")
 
 MAX_IMAGES = 10
-OLD_SIZE_LIMIT_BYTES = int(20 * 1024**3)  # 20 GB
+# old/ eviction: once usage reaches the high watermark, the oldest images are
+# deleted until usage is back under the low watermark
+OLD_SIZE_LIMIT_BYTES = int(20 * 1024**3)  # 20 GB high watermark
+OLD_LOW_WATERMARK_BYTES = int(18 * 1024**3)  # 18 GB low watermark
+# Cap on deletions per cycle, so eviction I/O is spread over several cycles
+EVICTION_BATCH = 200
+
+# Background lossless recompression of old/ (needs Pillow). Format is one of
+# recompress.FORMATS; set RECOMPRESS_FORMAT=off to disable.
+RECOMPRESS_FORMAT = os.environ.get("RECOMPRESS_FORMAT", "png")
+RECOMPRESS_WORKERS = recompress.default_workers()
+RECOMPRESS_BATCH = 8
+RECOMPRESS_IDLE_SECONDS = 300
+
+# Gallery thumbnails and previews (see previews.py) are rendered as soon as a
+# scan is registered, by a small niced process pool (needs Pillow)
+PREVIEW_WORKERS = 1
+
+# Per-scanner old/ quotas come from "archive_quota_gb" in the scanner settings
+SETTINGS_PATH = os.path.join(ROOTBOX_DIR, 'web', 'settings.json')
 
 # Google Drive
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 TOKEN_PATH = os.path.join(ROOTBOX_DIR, "creds", "token.pickle")
 CREDENTIALS_PATH = os.path.join(ROOTBOX_DIR, "creds", "credentials.json")
+# Persistent cache of Drive folder IDs, so folders are looked up once, not per upload
+FOLDER_CACHE_PATH = os.path.join(ROOTBOX_DIR, "creds", "folder_ids.json")
+# Drive accepts at most 100 calls per batch request
+DRIVE_BATCH_LIMIT = 100
+# Without token.pickle no Drive is configured (headless mode never runs the
+# OAuth flow): scans are kept locally and on USB, and their queue items are
+# skipped with this reason until a token appears
+NO_DRIVE_REASON = "no Google Drive configured"
 
 # Root folder in Google Drive where "scanner01", "scanner02" etc. exist
 DRIVE_ROOT_FOLDER_ID = "1my_IEvjcIxUgUBlKN-GCfrOMm3_0Cpu9"  # your upload-folder ID
 
 # USB copy configuration
-# Set USB_IMAGE_COPY_PATH environment variable to override a single default path.
-USB_IMAGE_COPY_PATH = os.environ.get("USB_IMAGE_COPY_PATH", "/media/usb/RootBox")
 # Set USB_SEARCH_PATHS to a comma-separated list of base paths to search for mounts.
 # Use {USER} placeholder to inject the current user (e.g. "/media/{USER}").
 # Default tries /media/<user>, /run/media/<user>, /media and /mnt
 USB_SEARCH_PATHS = os.environ.get("USB_SEARCH_PATHS", "")
+# When running as a worker: drives are back-filled as soon as they are
+# mounted, and all drives are checked for missing images this often
+USB_SYNC_IDLE_SECONDS = 3600
+
+# When running as a worker inside the controller: run a full cycle at least
+# this often even without new-scan events, so failed uploads are retried.
+WORKER_IDLE_SECONDS = 600
+# Held by whichever process is running the image manager (the controller's
+# worker or a standalone run), so two never work the upload queue at once
+WORKER_LOCK_PATH = os.path.join(ROOTBOX_DIR, "locks", "image_manager.lock")
+
+# Upload queue draining: uploads in flight at once, and how many queued
+# items are claimed per pass
+UPLOAD_CONCURRENCY = 2
+UPLOAD_BATCH = 20
+
+# Drive state kept in memory for the lifetime of the process. Credentials are
+# shared; each upload thread builds its own service object (httplib2 is not
+# thread-safe).
+_drive = {"creds": None}
+_drive_lock = threading.Lock()
+_thread_local = threading.local()
+_folder_ids = {}  # "parent_id/folder_name" -> folder id, loaded from FOLDER_CACHE_PATH
+_folder_ids_loaded = False
+# After a failed upload wave, draining pauses until the failed items' backoff
+# expires so an outage does not walk through the whole backlog
+_upload_pause = {"until": 0}
+
+# old/ usage per scanner in bytes, loaded from the catalog once and then kept
+# up to date as images are archived and evicted
+_old_usage = {}
+_old_usage_loaded = False
+_usage_lock = threading.Lock()
+_eviction = {"active": False}
+_preview_pool = {"pool": None}
+
+# Parsed mount table, refreshed only when the kernel reports a mount change
+_mount_table = usb_sync.MountTable()
+
+_upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY, thread_name_prefix="upload")
 
 # -----------------------------
 # UTILS
 # -----------------------------
-def log(scanner, message):
-    timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-    entry = f"{timestamp} [{scanner}] [Image Manager] {message}"
-    # Ensure log directory exists
-    try:
-        os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
-        with open(LOG_FILE, "a") as f:
-            f.write(entry + "\n")
-    except Exception:
-        # If log file can't be written, still print so debugging is possible
-        pass
-    print(entry)
+def log(scanner, message, **fields):
+    """Structured log record; `scanner` is "System" for messages not about one scanner."""
+    rootbox_log.log(message, source="image_manager", scanner=None if scanner == "System" else scanner, **fields)
 
 def load_last_uploads():
     if os.path.exists(LAST_UPLOAD_FILE):
@@ -64,53 +135,171 @@ def load_last_uploads():
             return json.load(f)
     return {}
 
-def save_last_uploads(data):
-    os.makedirs(os.path.dirname(LAST_UPLOAD_FILE), exist_ok=True)
-    with open(LAST_UPLOAD_FILE, "w") as f:
-        json.dump(data, f)
-
 def get_scanner_folders():
     return [d for d in os.listdir(SCAN_DIR)
             if os.path.isdir(os.path.join(SCAN_DIR, d)) and d.startswith("scanner")]
 
-def get_folder_size(path):
-    total = 0
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            try:
-                total += os.path.getsize(os.path.join(root, f))
-            except FileNotFoundError:
-                pass
-    return total
+def ensure_catalog():
+    """Index existing images the first time the catalog is used."""
+    if image_catalog.is_empty():
+        count = image_catalog.rebuild(SCAN_DIR, OLD_DIR)
+        log("System", f"Built image catalog ({count} images)")
+
+def get_old_usage():
+    global _old_usage_loaded
+    with _usage_lock:
+        if not _old_usage_loaded:
+            _old_usage.update(image_catalog.scanner_sizes(image_catalog.OLD))
+            _old_usage_loaded = True
+    return _old_usage
+
+def adjust_old_usage(scanner, delta):
+    usage = get_old_usage()
+    with _usage_lock:
+        usage[scanner] = usage.get(scanner, 0) + delta
+
+def load_settings():
+    try:
+        with open(SETTINGS_PATH, "r") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def load_archive_quotas():
+    """{scanner: bytes} for scanners with an "archive_quota_gb" setting."""
+    scanners = load_settings().get("scanners", {})
+    quotas = {}
+    for scanner, config in scanners.items():
+        quota_gb = config.get("archive_quota_gb")
+        if quota_gb:
+            quotas[scanner] = int(float(quota_gb) * 1024**3)
+    return quotas
+
+def _evictable(scanner, pending_on_usb=False):
+    """
+    Yield a scanner's images in old/, oldest first, skipping any still
+    awaiting upload. With `pending_on_usb`, images awaiting upload that are
+    already backed up on a USB drive are yielded too.
+    """
+    after = None
+    while True:
+        page = image_catalog.images(image_catalog.OLD, scanner, limit=100, after=after)
+        if not page:
+            return
+        for image in page:
+            # Never delete a scan that has not reached Google Drive (or, past the high watermark, USB) yet
+            if not upload_queue.is_pending(image["filename"]) or (pending_on_usb and image["on_usb"]):
+                yield image
+        after = page[-1]["timestamp"]
+
+def evict_image(image):
+    """Delete one archived image. Returns the bytes freed."""
+    f = image["filename"]
+    try:
+        os.remove(image["path"])
+    except FileNotFoundError:
+        pass
+    except Exception as ex:
+        log(image["scanner"], f"Error deleting old file {f}: {ex}")
+        return 0
+    image_catalog.mark_deleted(f)
+    if upload_queue.is_pending(f):
+        upload_queue.mark_lost(f, "evicted from old/ before upload (copy kept on USB)")
+        image_catalog.set_upload_state(f, upload_queue.LOST)
+        drive_upload.discard_session(f)
+        log(image["scanner"], f"Evicted {f} before it was uploaded; it is kept on USB", level="warning")
+    adjust_old_usage(image["scanner"], -image["size"])
+    metrics.inc("rootbox_evictions_total", scanner=image["scanner"])
+    metrics.inc("rootbox_evicted_bytes_total", image["size"], scanner=image["scanner"])
+    return image["size"]
 
 def manage_old_folder():
+    """
+    Evict archived images oldest-first. Scanners over their own
+    "archive_quota_gb" are trimmed back to it. Once total usage reaches
+    OLD_SIZE_LIMIT_BYTES, images are evicted until it drops below
+    OLD_LOW_WATERMARK_BYTES, always from the scanner furthest over its quota
+    (or its equal share of the limit), so one high-resolution scanner cannot
+    push everyone else's history out. Past the high watermark, images still
+    awaiting upload may go too if they are on USB, so a long Drive outage (or
+    no Drive at all) cannot fill the disk. At most EVICTION_BATCH files go per cycle.
+    """
     if not os.path.exists(OLD_DIR):
         return
 
-    folder_size = get_folder_size(OLD_DIR)
-    if folder_size >= OLD_SIZE_LIMIT_BYTES:
-        for f in os.listdir(OLD_DIR):
-            file_path = os.path.join(OLD_DIR, f)
-            try:
-                os.remove(file_path)
-            except Exception as ex:
-                log("System", f"Error deleting old file {f}: {ex}")
-        log("System", f"Deleted all files in 'old/' folder (used {folder_size / 1024**3:.2f} GB)")
+    usage = get_old_usage()
+    quotas = load_archive_quotas()
+    candidates = {}
+    budget = EVICTION_BATCH
+    evicted = {}
+    freed = 0
+
+    def evict_oldest(scanner, pending_on_usb=False):
+        nonlocal budget, freed
+        gen = candidates.setdefault((scanner, pending_on_usb), _evictable(scanner, pending_on_usb))
+        image = next(gen, None)
+        if image is None:
+            return False
+        size = evict_image(image)
+        budget -= 1
+        freed += size
+        evicted[scanner] = evicted.get(scanner, 0) + 1
+        return True
+
+    # Explicit per-scanner quotas
+    for scanner, quota in quotas.items():
+        while budget > 0 and usage.get(scanner, 0) > quota:
+            if not evict_oldest(scanner):
+                break
+
+    # Global watermarks
+    total = sum(usage.values())
+    if total >= OLD_SIZE_LIMIT_BYTES:
+        _eviction["active"] = True
+    if _eviction["active"]:
+        share = OLD_SIZE_LIMIT_BYTES / max(1, len([s for s, b in usage.items() if b > 0]))
+        exhausted = set()
+        while budget > 0 and total > OLD_LOW_WATERMARK_BYTES:
+            eligible = [s for s, b in usage.items() if b > 0 and s not in exhausted]
+            if not eligible:
+                break
+            scanner = max(eligible, key=lambda s: usage[s] - quotas.get(s, share))
+            if not evict_oldest(scanner, pending_on_usb=True):
+                exhausted.add(scanner)
+            total = sum(usage.values())
+        if total <= OLD_LOW_WATERMARK_BYTES:
+            _eviction["active"] = False
+
+    for scanner, size in usage.items():
+        metrics.set_gauge("rootbox_archive_bytes", size, scanner=scanner)
+
+    if evicted:
+        summary = ", ".join(f"{s}: {n}" for s, n in sorted(evicted.items()))
+        log("System", f"Evicted {sum(evicted.values())} old images ({freed / 1024**2:.1f} MB; {summary}); "
+                      f"'old/' now {sum(usage.values()) / 1024**3:.2f} GB", stage="evict", freed_bytes=freed)
 
 def manage_images(scanner):
     folder = os.path.join(SCAN_DIR, scanner)
     os.makedirs(OLD_DIR, exist_ok=True)
 
     try:
-        images = [f for f in os.listdir(folder) if f.endswith(".png")]
-        images.sort(key=lambda f: os.path.getmtime(os.path.join(folder, f)))
+        # Oldest first, by the timestamp recorded in the catalog
+        images = image_catalog.images(image_catalog.LIVE, scanner)
 
         while len(images) > MAX_IMAGES:
             oldest = images.pop(0)
-            src = os.path.join(folder, oldest)
-            dst = os.path.join(OLD_DIR, oldest)
-            shutil.move(src, dst)
-            log(scanner, f"Moved image to old/: {oldest}")
+            src = os.path.join(folder, oldest["filename"])
+            dst = os.path.join(OLD_DIR, oldest["filename"])
+            try:
+                shutil.move(src, dst)
+            except FileNotFoundError:
+                image_catalog.mark_deleted(oldest["filename"])
+                log(scanner, f"Catalogued image vanished before archiving: {oldest['filename']}")
+                continue
+            image_catalog.move(oldest["filename"], image_catalog.OLD, dst)
+            adjust_old_usage(scanner, oldest["size"])
+            upload_queue.update_path(oldest["filename"], dst)
+            log(scanner, f"Moved image to old/: {oldest['filename']}", stage="archive")
 
     except Exception as ex:
         log(scanner, f"ERROR managing images: {ex}")
@@ -118,15 +307,16 @@ def manage_images(scanner):
 # -----------------------------
 # USB detection helper
 # -----------------------------
-def get_usb_mounts():
+def get_usb_mounts(table=None):
     """
-    Return a list of detected USB mount roots to copy images to.
+    Return the detected USB drives to copy images to, as mount dicts
+    (mount_point, id, ...) from usb_sync.
     Strategy:
       - Use USB_SEARCH_PATHS env if provided (comma-separated).
       - Otherwise search defaults: /media/<user>, /run/media/<user>, /media, /mnt
-    Only include candidates that are actual mountpoints and writable.
+    Only writable mounts that are a search path or directly inside one are
+    included. The mount table is only re-read after it changes.
     """
-    mounts = []
     user = getpass.getuser()
 
     if USB_SEARCH_PATHS:
@@ -134,61 +324,30 @@ def get_usb_mounts():
     else:
         bases = [f"/media/{user}", f"/run/media/{user}", "/media", "/mnt"]
 
-    def is_writable_dir(p):
-        try:
-            return os.path.isdir(p) and os.access(p, os.W_OK | os.X_OK)
-        except Exception:
-            return False
-
-    for base in bases:
-        try:
-            if not os.path.isdir(base):
-                continue
-            # Include immediate children that are mountpoints AND writable
-            for name in os.listdir(base):
-                candidate = os.path.join(base, name)
-                if os.path.ismount(candidate) and is_writable_dir(candidate):
-                    mounts.append(candidate)
-            # Include the base itself only if it is a mountpoint and writable (rare)
-            if os.path.ismount(base) and is_writable_dir(base):
-                mounts.append(base)
-        except Exception:
-            continue
-
-    # Deduplicate while preserving order
-    seen = set()
-    result = []
-    for m in mounts:
-        if m not in seen:
-            seen.add(m)
-            result.append(m)
-    return result
+    try:
+        return (table or _mount_table).mounts_under(bases)
+    except Exception as ex:
+        log("System", f"Could not read the mount table: {ex}", stage="usb_backup", level="error")
+        return []
 
 # -----------------------------
 # USB helper (copy)
 # -----------------------------
-def copy_to_usb(src_path, scanner, usb_root=USB_IMAGE_COPY_PATH):
-    """
-    Copy the image to a mounted USB drive. This attempts to create a structured
-    destination: <usb_root>/scan_images/<scanner>/
-    Returns True on success, False on failure.
-    Behavior: If the configured usb_root does not exist, this logs and returns False.
-    """
-    try:
-        # Basic existence check for the USB root. If the mount isn't present, bail out.
-        if not os.path.exists(usb_root):
-            raise FileNotFoundError(f"USB root not found at {usb_root}")
-
-        dest_dir = os.path.join(usb_root, "scan_images", scanner)
-        os.makedirs(dest_dir, exist_ok=True)
-
-        dest_path = os.path.join(dest_dir, os.path.basename(src_path))
-        shutil.copy2(src_path, dest_path)
-        log(scanner, f"Copied {os.path.basename(src_path)} to USB at {dest_path}")
-        return True
-    except Exception as ex:
-        log(scanner, f"Failed copying to USB ({usb_root}): {ex}")
-        return False
+def log_usb_sync(results, scanner="System"):
+    """Log the outcome of usb_sync.sync per drive; returns the filenames copied or already present on any drive."""
+    on_usb = set()
+    for mount_point, stats in results.items():
+        on_usb.update(stats["copied"], stats["present_files"])
+        metrics.observe("rootbox_usb_copy_seconds", stats["seconds"])
+        metrics.inc("rootbox_usb_bytes_total", stats["bytes"])
+        if stats["copied"]:
+            log(scanner, f"Copied {len(stats['copied'])} image(s) ({stats['bytes'] / 1024**2:.1f} MB) to USB at {mount_point}",
+                stage="usb_backup", drive=mount_point, copied=len(stats["copied"]), bytes=stats["bytes"])
+        if stats["error"]:
+            metrics.inc("rootbox_usb_failures_total")
+            log(scanner, f"Failed copying to USB ({mount_point}): {stats['error']}", stage="usb_backup",
+                level="error", drive=mount_point)
+    return on_usb
 
 # -----------------------------
 # GOOGLE DRIVE HELPERS
@@ -243,100 +402,582 @@ def get_creds():
         log("System", f"Error resolving Google Drive credentials: {ex}. Skipping cloud upload.")
         return None
 
-def get_or_create_drive_folder(service, parent_id, folder_name):
-    query = f"name='{folder_name}' and '{parent_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-    resp = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-    files = resp.get('files', [])
-    if files:
-        return files[0]['id']
-    folder_metadata = {
-        'name': folder_name,
-        'mimeType': 'application/vnd.google-apps.folder',
-        'parents': [parent_id]
-    }
-    folder = service.files().create(body=folder_metadata, fields='id').execute()
-    return folder['id']
-
-def upload_latest_image(scanner, latest_file, latest_timestamp, last_uploads):
-    # First: detect USB mounts and attempt to copy to every detected USB
+def drive_configured():
+    """True if a Drive token exists (it may still be expired or unusable)."""
+    return os.path.exists(TOKEN_PATH)
+
+def get_valid_creds():
+    """
+    Return the cached credentials while they are valid. They are only re-read
+    from token.pickle (and refreshed) once they expire.
+    """
+    with _drive_lock:
+        creds = _drive["creds"]
+        if creds is None or not getattr(creds, "valid", False):
+            creds = get_creds()
+            _drive["creds"] = creds
+    return creds
+
+def get_drive_service():
+    """Return a Drive service object for the calling thread, reusing it while the credentials are valid."""
+    creds = get_valid_creds()
+    if not creds:
+        return None
+
+    if getattr(_thread_local, "creds", None) is not creds:
+        _thread_local.service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+        _thread_local.creds = creds
+    return _thread_local.service
+
+def _load_folder_cache():
+    global _folder_ids_loaded
+    if _folder_ids_loaded:
+        return
+    _folder_ids_loaded = True
     try:
-        usb_mounts = get_usb_mounts()
-        if not usb_mounts:
-            log(scanner, "No USB mounts detected; skipping local USB backup")
+        with open(FOLDER_CACHE_PATH, "r") as f:
+            _folder_ids.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except Exception as ex:
+        log("System", f"Ignoring unreadable folder ID cache: {ex}")
+
+def _save_folder_cache():
+    try:
+        os.makedirs(os.path.dirname(FOLDER_CACHE_PATH), exist_ok=True)
+        tmp = FOLDER_CACHE_PATH + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(_folder_ids, f, indent=2)
+        os.replace(tmp, FOLDER_CACHE_PATH)
+    except Exception as ex:
+        log("System", f"Failed to save folder ID cache: {ex}")
+
+def invalidate_drive_folder(parent_id, folder_name):
+    """Forget a cached folder ID (e.g. after Drive answered 404 for it)."""
+    _load_folder_cache()
+    if _folder_ids.pop(f"{parent_id}/{folder_name}", None) is not None:
+        _save_folder_cache()
+        log(folder_name, "Cached Google Drive folder no longer exists; will look it up again")
+
+def _batch_execute(service, requests):
+    """
+    Run {request_id: request} as batch HTTP calls (DRIVE_BATCH_LIMIT per call).
+    Returns {request_id: response}; failed requests are logged and left out.
+    """
+    responses = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            log(request_id, f"Google Drive metadata request failed: {exception}")
         else:
-            log(scanner, f"Detected USB mounts: {usb_mounts}")
-            for mount in usb_mounts:
-                try:
-                    ok = copy_to_usb(latest_file, scanner, usb_root=mount)
-                    if not ok:
-                        log(scanner, f"Copy to USB {mount} failed; continuing")
-                except Exception as ex:
-                    log(scanner, f"Error copying to USB {mount}: {ex}")
+            responses[request_id] = response
+
+    items = list(requests.items())
+    for start in range(0, len(items), DRIVE_BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=callback)
+        for request_id, request in items[start:start + DRIVE_BATCH_LIMIT]:
+            batch.add(request, request_id=request_id)
+        batch.execute()
+    return responses
+
+def resolve_drive_folders(service, parent_id, folder_names):
+    """
+    Return {folder_name: folder_id} for sub-folders of parent_id, creating any
+    that do not exist. Cached IDs cost nothing; the rest are looked up with a
+    single batch request, and missing ones created with a second.
+    """
+    _load_folder_cache()
+    missing = [n for n in folder_names if f"{parent_id}/{n}" not in _folder_ids]
+    if missing:
+        lookups = {}
+        for name in missing:
+            query = f"name='{name}' and '{parent_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
+            lookups[name] = service.files().list(q=query, spaces='drive', fields='files(id, name)')
+        for name, resp in _batch_execute(service, lookups).items():
+            files = resp.get('files', [])
+            if files:
+                _folder_ids[f"{parent_id}/{name}"] = files[0]['id']
+
+        creates = {}
+        for name in missing:
+            if f"{parent_id}/{name}" not in _folder_ids:
+                folder_metadata = {
+                    'name': name,
+                    'mimeType': 'application/vnd.google-apps.folder',
+                    'parents': [parent_id]
+                }
+                creates[name] = service.files().create(body=folder_metadata, fields='id')
+        for name, folder in _batch_execute(service, creates).items():
+            _folder_ids[f"{parent_id}/{name}"] = folder['id']
+            log(name, "Created Google Drive folder")
+
+        _save_folder_cache()
+
+    return {n: _folder_ids[f"{parent_id}/{n}"] for n in folder_names if f"{parent_id}/{n}" in _folder_ids}
+
+def get_or_create_drive_folder(service, parent_id, folder_name):
+    folder_id = resolve_drive_folders(service, parent_id, [folder_name]).get(folder_name)
+    if folder_id is None:
+        raise RuntimeError(f"Could not resolve Google Drive folder '{folder_name}'")
+    return folder_id
 
+def backup_to_usb(scanner, path):
+    """Copy an image to every detected USB drive in parallel (best-effort). Returns True if any drive has it."""
+    try:
+        drives = get_usb_mounts()
+        if not drives:
+            log(scanner, "No USB mounts detected; skipping local USB backup")
+            return False
+        image = {"scanner": scanner, "filename": os.path.basename(path), "path": path}
+        return image["filename"] in log_usb_sync(usb_sync.sync(drives, [image]), scanner)
     except Exception as ex:
         # best-effort: do not block upload
         log(scanner, f"Unexpected error detecting/copying USB mounts: {ex}")
+        return False
 
-    # Then: upload to Google Drive as before (best-effort)
+def sync_usb_drives(drives):
+    """
+    Back-fill USB drives with every image that still has a local copy
+    (scan_images/ and old/), oldest first, skipping what each drive already has.
+    """
+    if not drives:
+        return
+    images = image_catalog.images(image_catalog.LIVE) + image_catalog.images(image_catalog.OLD)
+    started = time.time()
+    known = {image["filename"] for image in images if image["on_usb"]}
+    for filename in log_usb_sync(usb_sync.sync(drives, images)) - known:
+        image_catalog.set_on_usb(filename)
+    log("System", f"USB sync checked {len(images)} images on {len(drives)} drive(s)",
+        stage="usb_backup", duration=time.time() - started)
+
+def run_usb_sync(stop_event):
+    """
+    Background USB back-fill used by the worker: a drive is synced as soon
+    as it is mounted, and every drive again after USB_SYNC_IDLE_SECONDS.
+    Waits on mount table changes instead of scanning for drives.
+    """
+    table = usb_sync.MountTable()
+    synced = set()  # mount ids back-filled since the last full pass
+    last_full_pass = 0
+    while not stop_event.is_set():
+        try:
+            drives = get_usb_mounts(table)
+            if time.time() - last_full_pass >= USB_SYNC_IDLE_SECONDS:
+                last_full_pass = time.time()
+                synced.clear()
+            new = [d for d in drives if d["id"] not in synced]
+            if new:
+                log("System", f"Syncing USB drive(s): {[d['mount_point'] for d in new]}", stage="usb_backup")
+                sync_usb_drives(new)
+                synced.update(d["id"] for d in new)
+            # Wake on a mount change, checking stop_event every few seconds
+            deadline = last_full_pass + USB_SYNC_IDLE_SECONDS
+            while not stop_event.is_set() and time.time() < deadline and not table.changed(5):
+                pass
+        except Exception as ex:
+            log("System", f"Unhandled error in USB sync worker: {ex}")
+            stop_event.wait(60)
+    table.close()
+
+def upload_image(scanner, path, folder_id):
+    """
+    Upload one image to the scanner's Drive folder in resumable chunks. An
+    interrupted upload continues from its last confirmed chunk on the next
+    attempt. Raises on failure.
+    """
+    creds = get_valid_creds()
+    if not creds:
+        raise RuntimeError("No valid Google Drive credentials available.")
+    file_metadata = {'name': os.path.basename(path), 'parents': [folder_id]}
+    mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    started = time.time()
+    drive_upload.resumable_upload(path, file_metadata, creds.token, mime_type=mime_type)
+    size = os.path.getsize(path)
+    log(scanner, f"Uploaded {os.path.basename(path)} to Google Drive", stage="upload",
+        duration=time.time() - started, bytes=size)
+    metrics.observe("rootbox_upload_seconds", time.time() - started, scanner=scanner)
+    metrics.inc("rootbox_upload_bytes_total", size, scanner=scanner)
+
+def process_upload(item, folder_id):
+    """
+    Back up and upload one queued image. Returns None on success, or the
+    backoff delay in seconds after a failure was put back in the queue.
+    """
+    scanner, path, filename = item["scanner"], item["path"], item["filename"]
+    if not os.path.exists(path):
+        upload_queue.mark_lost(filename, "file missing")
+        image_catalog.set_upload_state(filename, upload_queue.LOST)
+        drive_upload.discard_session(filename)
+        log(scanner, f"Queued image {filename} no longer exists; dropping from upload queue")
+        return None
+
+    # USB copy happens once per image, even if the Drive upload is retried
+    if not item["usb_done"]:
+        if backup_to_usb(scanner, path):
+            image_catalog.set_on_usb(filename)
+        upload_queue.mark_usb_done(filename)
+
+    if folder_id is None and not drive_configured():
+        upload_queue.mark_skipped(filename, NO_DRIVE_REASON)
+        image_catalog.set_upload_state(filename, upload_queue.SKIPPED)
+        return None
+
+    try:
+        if folder_id is None:
+            raise RuntimeError("Google Drive folder unavailable (no credentials or lookup failed).")
+        upload_image(scanner, path, folder_id)
+        upload_queue.mark_done(filename)
+        image_catalog.set_upload_state(filename, upload_queue.DONE)
+        return None
+    except drive_upload.UploadError as ex:
+        if ex.status == 404 and ex.stage == "start":
+            # The parent folder is gone (deleted, or a different account)
+            invalidate_drive_folder(DRIVE_ROOT_FOLDER_ID, scanner)
+        metrics.inc("rootbox_upload_failures_total", scanner=scanner)
+        delay = upload_queue.mark_failed(filename, ex)
+        log(scanner, f"Cloud upload of {filename} failed: {ex}. Retrying in {int(delay)}s.",
+            stage="upload", level="error")
+        return delay
+    except Exception as ex:
+        metrics.inc("rootbox_upload_failures_total", scanner=scanner)
+        delay = upload_queue.mark_failed(filename, ex)
+        log(scanner, f"Cloud upload of {filename} failed: {ex}. Retrying in {int(delay)}s.",
+            stage="upload", level="error")
+        return delay
+
+def drain_upload_queue():
+    """
+    Upload due items oldest-first, UPLOAD_CONCURRENCY at a time. Stops at the
+    first failed wave and pauses until its backoff expires, so an outage costs
+    a handful of attempts rather than one per queued image.
+    """
+    while time.time() >= _upload_pause["until"]:
+        items = upload_queue.due_items(UPLOAD_BATCH)
+        if not items:
+            return
+
+        # Resolve Drive folders up front, on this thread and in one batch, so
+        # concurrent uploads never race to create the same folder
+        folder_ids = {}
+        try:
+            service = get_drive_service()
+            if service:
+                folder_ids = resolve_drive_folders(
+                    service, DRIVE_ROOT_FOLDER_ID, sorted({i["scanner"] for i in items}))
+        except Exception as ex:
+            log("System", f"Failed to resolve Google Drive folders: {ex}")
+            folder_ids = {}
+
+        for start in range(0, len(items), UPLOAD_CONCURRENCY):
+            wave = items[start:start + UPLOAD_CONCURRENCY]
+            delays = [d for d in _upload_pool.map(
+                lambda item: process_upload(item, folder_ids.get(item["scanner"])), wave) if d is not None]
+            if delays:
+                _upload_pause["until"] = time.time() + min(delays)
+                for item in items[start + UPLOAD_CONCURRENCY:]:
+                    upload_queue.release(item["filename"])
+                return
+
+def detect_change(scanner, path, timestamp, config):
+    """
+    Compare a new scan with the scanner's reference scan (see change_detect.py)
+    and record the outcome in the catalog. Returns True for a near-duplicate.
+    """
+    if not change_detect.available():
+        return False
+    f = os.path.basename(path)
+    started = time.time()
     try:
-        creds = get_creds()
-        if not creds:
-            raise RuntimeError("No valid Google Drive credentials available.")
-        service = build('drive', 'v3', credentials=creds)
-        folder_id = get_or_create_drive_folder(service, DRIVE_ROOT_FOLDER_ID, scanner)
-        file_metadata = {'name': os.path.basename(latest_file), 'parents': [folder_id]}
-        media = MediaFileUpload(latest_file, resumable=True)
-        service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-        log(scanner, f"Uploaded {os.path.basename(latest_file)} to Google Drive")
-        # Only mark as uploaded on success
-        last_uploads[scanner] = latest_timestamp
-        save_last_uploads(last_uploads)
+        score, duplicate = change_detect.check(
+            scanner, f, timestamp, path, float(config["threshold"]), float(config["max_gap_hours"]))
     except Exception as ex:
-        log(scanner, f"Cloud upload failed: {ex}. Will retry next cycle.")
+        log(scanner, f"Change detection failed for {f}: {ex}")
+        return False
+    metrics.observe("rootbox_change_detect_seconds", time.time() - started, scanner=scanner)
+    image_catalog.set_change(f, score, duplicate)
+    if duplicate:
+        metrics.inc("rootbox_duplicates_total", scanner=scanner, policy=config["policy"])
+        log(scanner, f"{f} is unchanged since the reference scan ({score:.1%} of tiles changed); "
+            f"policy: {config['policy']}", stage="change_detect", duration=time.time() - started)
+    return duplicate
+
+def discard_duplicate(scanner, path):
+    """Delete a near-duplicate scan under the "dedupe" policy."""
+    f = os.path.basename(path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    image_catalog.mark_deleted(f)
+    log(scanner, f"Deleted near-duplicate {f}")
+
+def register_images(scanner, last_uploads):
+    """
+    Add scans in the scanner's live folder that the catalog or upload queue
+    have not seen. The live folder only holds the newest MAX_IMAGES scans plus
+    any new ones, so this listing stays small however large old/ grows.
+    New scans go through change detection, oldest first, and near-duplicates
+    are handled according to the scanner's change detection policy.
+    """
+    folder = os.path.join(SCAN_DIR, scanner)
+    files = sorted(f for f in os.listdir(folder) if f.endswith(image_catalog.IMAGE_EXTENSIONS))
+    legacy_cutoff = last_uploads.get(scanner, 0)
+
+    for f in image_catalog.unknown_filenames(files):
+        timestamp = image_catalog.parse_timestamp(f)
+        if timestamp is None:
+            log(scanner, f"Skipping image with bad timestamp in filename: {f}")
+            continue
+        path = os.path.join(folder, f)
+        image_catalog.add_image(scanner, path, timestamp, os.path.getsize(path))
+
+    # Scans are usually already in the catalog (01_scan_image.py records
+    # them), so new arrivals are the ones the upload queue has not seen
+    added = []
+    config = change_detect.policy_for(load_settings(), scanner)
+    new = [(image_catalog.parse_timestamp(f), f) for f in upload_queue.unknown_filenames(files)]
+    for timestamp, f in sorted(n for n in new if n[0] is not None):
+        path = os.path.join(folder, f)
+        # Images covered by the legacy last_upload.json were already uploaded
+        state = upload_queue.DONE if timestamp <= legacy_cutoff else upload_queue.PENDING
+        priority = upload_queue.NORMAL_PRIORITY
+        if state == upload_queue.PENDING and detect_change(scanner, path, timestamp, config):
+            if config["policy"] == "low_priority":
+                priority = upload_queue.LOW_PRIORITY
+            elif config["policy"] in ("local_only", "dedupe"):
+                state = upload_queue.SKIPPED
+        upload_queue.enqueue(scanner, path, timestamp, state=state, priority=priority)
+        image_catalog.set_upload_state(f, state)
+        if state == upload_queue.SKIPPED and config["policy"] == "dedupe":
+            discard_duplicate(scanner, path)
+            continue
+        added.append(path)
+        if state == upload_queue.PENDING:
+            log(scanner, f"Queued {f} for upload" + (" (low priority)" if priority else ""))
+    queue_previews(scanner, added)
 
 # -----------------------------
 # MAIN
 # -----------------------------
-def main():
+def run_cycle(scanners=None):
+    """
+    Manage, back up and upload images. `scanners` restricts the pass to the
+    given scanner folders (e.g. those that just finished a scan); None means
+    every scanner folder.
+    """
+    started = time.time()
+    kind = "full" if scanners is None else "scanners"
     last_uploads = load_last_uploads()
+    ensure_catalog()
 
-    scanners = get_scanner_folders()
-    if not scanners:
-        log("System", "No scanner folders found.")
+    if scanners is None:
+        scanners = get_scanner_folders()
+        if not scanners:
+            log("System", "No scanner folders found.")
     for scanner in scanners:
         try:
+            # Register before moving anything to old/, so no scan is missed
+            register_images(scanner, last_uploads)
             manage_images(scanner)
+        except Exception as ex:
+            log(scanner, f"Unhandled error in scanner loop: {ex}")
 
-            folder = os.path.join(SCAN_DIR, scanner)
-            images = [f for f in os.listdir(folder) if f.endswith(".png")]
+    try:
+        if drive_configured():
+            requeued = upload_queue.requeue_skipped(NO_DRIVE_REASON)
+            if requeued:
+                log("System", f"Google Drive configured; queued {requeued} scans kept back without it")
+        drain_upload_queue()
+    except Exception as ex:
+        # Hard guard: never let an unexpected error stop the cycle
+        log("System", f"Unexpected error during upload handling: {ex}")
 
-            if not images:
-                continue
+    manage_old_folder()
+    metrics.set_gauge("rootbox_upload_backlog", upload_queue.pending_count())
+    metrics.observe("rootbox_cycle_seconds", time.time() - started, kind=kind)
+
+# -----------------------------
+# GALLERY PREVIEWS
+# -----------------------------
+def queue_previews(scanner, paths):
+    """Render gallery previews for newly registered scans in the background."""
+    if not paths or not previews.available():
+        return
+    if _preview_pool["pool"] is None:
+        # Forked, like the recompression pool
+        _preview_pool["pool"] = ProcessPoolExecutor(
+            max_workers=PREVIEW_WORKERS,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=recompress.lower_priority,
+        )
+    for path in paths:
+        filename = os.path.basename(path)
+        future = _preview_pool["pool"].submit(previews.render, path, scanner, filename)
+        future.add_done_callback(lambda f, scanner=scanner, filename=filename: record_previews(f, scanner, filename))
+
+def record_previews(future, scanner, filename):
+    try:
+        previews.record(filename, future.result())
+    except Exception as ex:
+        log(scanner, f"Rendering previews of {filename} failed: {ex}", stage="preview", level="error")
+
+def shutdown_previews():
+    """Wait for queued previews to finish (used when running as a one-shot script)."""
+    if _preview_pool["pool"] is not None:
+        _preview_pool["pool"].shutdown(wait=True)
+        _preview_pool["pool"] = None
+
+# -----------------------------
+# BACKGROUND RECOMPRESSION
+# -----------------------------
+def recompress_batch(pool, images):
+    """Recompress archived images in the process pool and record the results. Returns a stats dict."""
+    stats = {"images": 0, "saved": 0, "cpu_seconds": 0.0}
+    futures = {}
+    for image in images:
+        if upload_queue.is_pending(image["filename"]):
+            continue
+        futures[pool.submit(recompress.recompress_file, image["path"], RECOMPRESS_FORMAT)] = image
+
+    for future in as_completed(futures):
+        image = futures[future]
+        result = future.result()
+        stats["images"] += 1
+        stats["cpu_seconds"] += result["cpu_seconds"]
+        status = result["status"]
+        if status == "replaced":
+            saved = result["old_size"] - result["new_size"]
+            image_catalog.set_recompressed(image["filename"], image_catalog.RECOMPRESS_DONE,
+                                           result["path"], result["new_size"])
+            adjust_old_usage(image["scanner"], -saved)
+            metrics.inc("rootbox_recompress_saved_bytes_total", saved)
+            stats["saved"] += saved
+        elif status in ("kept", "skipped", "mismatch"):
+            if status == "mismatch":
+                log(image["scanner"], f"Recompressed {image['filename']} did not match original pixels; kept original")
+            image_catalog.set_recompressed(image["filename"], image_catalog.RECOMPRESS_DONE)
+        elif status == "error":
+            log(image["scanner"], f"Recompression of {image['filename']} failed: {result.get('error')}")
+            image_catalog.set_recompressed(image["filename"], image_catalog.RECOMPRESS_FAILED)
+        # "missing": the image was evicted meanwhile; nothing to record
+    return stats
+
+def run_recompressor(stop_event):
+    """
+    Low-priority background stage: losslessly recompress archived images in
+    old/, oldest first, using a niced process pool. Only images that have
+    already been uploaded are touched.
+    """
+    if RECOMPRESS_FORMAT not in recompress.FORMATS:
+        return
+    if not recompress.available():
+        log("System", "Pillow not installed; archive recompression disabled")
+        return
 
-            # Find newest by unix timestamp in filename
+    # Fork explicitly: the controller runs as a plain script, which spawn
+    # and forkserver would re-execute in every worker.
+    pool = ProcessPoolExecutor(
+        max_workers=RECOMPRESS_WORKERS,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=recompress.lower_priority,
+    )
+    try:
+        while not stop_event.is_set():
             try:
-                images.sort(key=lambda f: int(f.split("-")[-1].replace(".png", "")))
-            except ValueError:
-                log(scanner, "Skipping image with bad timestamp in filename")
-                continue
+                images = image_catalog.recompress_candidates(RECOMPRESS_BATCH)
+                if not images:
+                    stop_event.wait(RECOMPRESS_IDLE_SECONDS)
+                    continue
+                stats = recompress_batch(pool, images)
+                log("System", f"Recompressed {stats['images']} archived images to {RECOMPRESS_FORMAT}: "
+                              f"saved {stats['saved'] / 1024**2:.1f} MB in {stats['cpu_seconds']:.1f} CPU-s",
+                    stage="recompress", saved_bytes=stats['saved'], cpu_seconds=round(stats['cpu_seconds'], 2))
+            except Exception as ex:
+                log("System", f"Unhandled error in recompression worker: {ex}")
+                stop_event.wait(RECOMPRESS_IDLE_SECONDS)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
 
-            latest_file = os.path.join(folder, images[-1])
-            latest_timestamp = int(images[-1].split("-")[-1].replace(".png", ""))
+def take_worker_lock(wait):
+    """
+    Lock out other image manager processes and return the lock file, or None
+    if `wait` is False and another process holds it. Uploads left "uploading"
+    are put back in the queue, since nothing else can be uploading them now.
+    """
+    os.makedirs(os.path.dirname(WORKER_LOCK_PATH), exist_ok=True)
+    f = open(WORKER_LOCK_PATH, 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    recovered = upload_queue.recover_interrupted()
+    if recovered:
+        log("System", f"Requeued {recovered} upload(s) interrupted by a restart")
+    return f
 
-            last_uploaded = last_uploads.get(scanner, 0)
+def run_worker(events, stop_event):
+    """
+    Long-lived worker used by 00_scan_control.py. Waits for scanner IDs on
+    the `events` queue (one per finished scan) and processes just those
+    scanners, keeping the Drive service and folder IDs cached in memory.
+    A full cycle runs at startup and every WORKER_IDLE_SECONDS, whether or
+    not events keep arriving; in between, the worker also wakes when a
+    queued upload's backoff expires.
+    """
+    worker_lock = take_worker_lock(wait=True)
+    log("System", "Image manager worker started")
+    threading.Thread(target=run_recompressor, args=(stop_event,), name="recompress", daemon=True).start()
+    threading.Thread(target=run_usb_sync, args=(stop_event,), name="usb-sync", daemon=True).start()
+    last_full_cycle = 0  # forces a full cycle on the first pass
+
+    while not stop_event.is_set():
+        now = time.time()
+        full_cycle_at = last_full_cycle + WORKER_IDLE_SECONDS
+        retry_at = upload_queue.next_attempt_time()
+        if retry_at is not None:
+            retry_at = max(retry_at, _upload_pause["until"])
+        wake_at = full_cycle_at if retry_at is None else min(full_cycle_at, retry_at)
+        timeout = max(0, wake_at - now)
+        try:
+            pending = {events.get(timeout=timeout)}
+        except queue.Empty:
+            pending = None
 
-            if latest_timestamp > last_uploaded:
-                try:
-                    upload_latest_image(scanner, latest_file, latest_timestamp, last_uploads)
-                except Exception as ex:
-                    # Hard guard: never let an unexpected error stop the loop
-                    log(scanner, f"Unexpected error during upload handling: {ex}")
+        # Coalesce scans that finished together into one pass
+        while pending is not None:
+            try:
+                pending.add(events.get_nowait())
+            except queue.Empty:
+                break
+
+        if stop_event.is_set():
+            break
+
+        try:
+            if time.time() >= full_cycle_at:
+                # Covers the scanners in `pending` too
+                last_full_cycle = time.time()
+                run_cycle()
+            elif pending is None:
+                drain_upload_queue()
             else:
-                log(scanner, "No new images to upload")
+                run_cycle(sorted(scanner for scanner in pending if scanner))
         except Exception as ex:
-            log(scanner, f"Unhandled error in scanner loop: {ex}")
+            log("System", f"Unhandled error in image manager worker: {ex}")
+    worker_lock.close()
 
-    manage_old_folder()
+def main():
+    worker_lock = take_worker_lock(wait=False)
+    if worker_lock is None:
+        log("System", "Another image manager is running; nothing to do")
+        return
+    run_cycle()
+    try:
+        sync_usb_drives(get_usb_mounts())
+    except Exception as ex:
+        log("System", f"Unhandled error during USB sync: {ex}")
+    shutdown_previews()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -3,6 +3,12 @@ import subprocess
 import json
 import re
 import os
+import select
+import socket
+
+import device_options
+import rootbox_log
+from scan_executor import USB_SYSFS_DIR, DeviceBusy, device_lock, exclusive_buses
 
 # Find user home path and create folder directory
 HOME_DIR = os.path.expanduser("~")
@@ -17,7 +23,107 @@ ENABLE_FILTER = True
 INCLUDE_KEYWORDS = ["pixma", "hp"]
 # -------------------------------
 
+# USB interface classes a scanner can present: still image, printer
+# (multifunction devices) and vendor specific. Changes to other devices
+# (USB drives, keyboards, hubs) never trigger a SANE enumeration.
+SCANNER_INTERFACE_CLASSES = {"06", "07", "ff"}
+
+# Without udev netlink events, /sys/bus/usb/devices is polled this often
+# (a directory listing, no device I/O)
+POLL_SECONDS = 2
+# With netlink events, the topology is still re-checked this often in case
+# an event was missed
+FALLBACK_CHECK_SECONDS = 60
+# Give a newly plugged device time to settle before enumerating it
+SETTLE_SECONDS = 2
+# How long to wait for scans on the affected buses to finish before
+# putting off an enumeration
+BUS_WAIT_SECONDS = 30
+# Delay before retrying an enumeration that failed or was put off
+RETRY_SECONDS = 15
+# How long an option query waits for a device the controller is scanning
+# with (or holding a SANE session on) before trying again later
+DEVICE_QUERY_WAIT_SECONDS = 5
+
+NETLINK_KOBJECT_UEVENT = 15
+
+def log(message, **fields):
+    rootbox_log.log(message, source="autodetect", **fields)
+
+def _read_sysfs(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except Exception:
+        return ""
+
+def usb_topology():
+    """
+    Snapshot of connected USB devices that could be scanners, as a sorted
+    tuple of (sysfs name, vendor, product, devnum). Re-plugging a device
+    changes its devnum, so it changes the snapshot too.
+    """
+    try:
+        entries = os.listdir(USB_SYSFS_DIR)
+    except Exception:
+        return ()
+
+    classes = {}
+    for entry in entries:
+        if ":" in entry:
+            device = entry.split(":", 1)[0]
+            classes.setdefault(device, set()).add(
+                _read_sysfs(os.path.join(USB_SYSFS_DIR, entry, "bInterfaceClass")).lower())
+
+    topology = []
+    for entry in entries:
+        if ":" in entry or not classes.get(entry, set()) & SCANNER_INTERFACE_CLASSES:
+            continue
+        base = os.path.join(USB_SYSFS_DIR, entry)
+        topology.append((
+            entry,
+            _read_sysfs(os.path.join(base, "idVendor")),
+            _read_sysfs(os.path.join(base, "idProduct")),
+            _read_sysfs(os.path.join(base, "devnum")),
+        ))
+    return tuple(sorted(topology))
+
+def topology_buses(topology):
+    """Lock names of the buses a SANE enumeration will touch."""
+    buses = {f"bus{entry.split('-', 1)[0]}" for entry, _, _, _ in topology}
+    return sorted(buses | {"unknown"})
+
+def open_uevent_socket():
+    """Kernel uevent netlink socket, or None if unavailable (falls back to polling)."""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, 1))
+        return sock
+    except Exception as e:
+        log(f"udev events unavailable, polling {USB_SYSFS_DIR}: {e}", level="warning")
+        return None
+
+def wait_for_usb_event(sock, timeout):
+    """Block until a USB add/remove uevent arrives or `timeout` passes. Returns True on an event."""
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        ready, _, _ = select.select([sock], [], [], remaining)
+        if not ready:
+            return False
+        fields = sock.recv(65536).split(b"\0")
+        if b"SUBSYSTEM=usb" in fields and (b"ACTION=add" in fields or b"ACTION=remove" in fields):
+            return True
+
+def drain_events(sock):
+    """Discard queued uevents (a single plug produces several)."""
+    while select.select([sock], [], [], 0)[0]:
+        sock.recv(65536)
+
 def detect_scanners():
+    """SANE device names from `scanimage -L`, or None if enumeration failed."""
     try:
         result = subprocess.run(['scanimage', '-L'], capture_output=True, text=True, check=True)
         devices = []
@@ -34,23 +140,106 @@ def detect_scanners():
                     filtered.append(d)
             devices = filtered
 
-        return devices if devices else []
+        return devices
     except Exception as e:
-        print(f"Error detecting scanners: {e}")
-        return []
+        log(f"Error detecting scanners: {e}", level="error")
+        return None
+
+def load_devices():
+    try:
+        with open(OUTPUT_PATH, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return None
 
 def save_devices(devices):
+    """Write the device list, only if it differs from what is on disk. Returns True if written."""
+    content = {"devices": devices}
+    if load_devices() == content:
+        return False
     try:
-        with open(OUTPUT_PATH, 'w') as f:
-            json.dump({"devices": devices}, f, indent=2)
+        tmp = OUTPUT_PATH + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(content, f, indent=2)
+        os.replace(tmp, OUTPUT_PATH)
+        return True
     except Exception as e:
-        print(f"Error saving devices: {e}")
+        log(f"Error saving devices: {e}", level="error")
+        return False
+
+def cache_device_options(devices):
+    """
+    Query option ranges of devices seen for the first time (the bus must be
+    idle). Returns the devices that were busy, to be tried again later.
+    """
+    busy = []
+    for device in devices:
+        if device_options.cached(device) is not None:
+            continue
+        started = time.time()
+        try:
+            with device_lock(device, DEVICE_QUERY_WAIT_SECONDS):
+                options = device_options.refresh(device)
+            log(f"Cached {len(options)} options for {device}", stage="enumerate", duration=time.time() - started)
+        except DeviceBusy as e:
+            log(f"Options of {device} not read yet: {e}", stage="enumerate")
+            busy.append(device)
+        except Exception as e:
+            log(f"Could not read options of {device}: {e}", stage="enumerate", level="error")
+    return busy
+
+def enumerate_if_idle(topology):
+    """
+    Run a SANE enumeration once no scan is using the affected buses (scans
+    wait while it runs), and read the option ranges of new devices. Returns
+    the device list (None if it was put off or failed) and the devices whose
+    options could not be read because they were busy.
+    """
+    try:
+        with exclusive_buses(topology_buses(topology), BUS_WAIT_SECONDS):
+            started = time.time()
+            devices = detect_scanners()
+            if devices is None:
+                return None, []
+            log(f"Enumerated {len(devices)} scanner(s)", stage="enumerate", duration=time.time() - started)
+            return devices, cache_device_options(devices)
+    except TimeoutError as e:
+        log(f"Scans in progress, enumeration deferred: {e}", stage="enumerate")
+        return None, []
+
+def cache_options_if_idle(devices, topology):
+    """Retry option queries for busy devices once the buses are idle. Returns those still busy."""
+    try:
+        with exclusive_buses(topology_buses(topology), BUS_WAIT_SECONDS):
+            return cache_device_options(devices)
+    except TimeoutError:
+        return devices
 
 def main():
+    sock = open_uevent_socket()
+    known_topology = None
+    retry_at = None
+    busy = []  # devices whose options are still to be read
+
     while True:
-        devices = detect_scanners()
-        save_devices(devices)
-        time.sleep(10)  # wait 10 seconds before next scan
+        topology = usb_topology()
+        if topology != known_topology or (retry_at and time.time() >= retry_at):
+            devices, busy = enumerate_if_idle(topology)
+            if devices is None:
+                retry_at = time.time() + RETRY_SECONDS
+            else:
+                known_topology, retry_at = topology, None
+                if save_devices(devices):
+                    log(f"Scanner devices changed: {devices}", stage="enumerate")
+        elif busy:
+            busy = cache_options_if_idle(busy, topology)
+
+        timeout = RETRY_SECONDS if retry_at or busy else (FALLBACK_CHECK_SECONDS if sock else POLL_SECONDS)
+        if sock is None:
+            time.sleep(timeout)
+        elif wait_for_usb_event(sock, timeout):
+            time.sleep(SETTLE_SECONDS)
+            drain_events(sock)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,276 @@
+"""
+Benchmark the whole scan -> catalog -> upload pipeline, offline.
+
+Everything runs under a temporary RootBox directory with stand-ins for the
+outside world: benchmarks/fake_scanimage.py instead of scanimage (synthetic
+scans of configurable size and latency) and benchmarks/fake_drive.py
+instead of Google Drive (a local resumable-upload endpoint). USB backup is
+pointed at an empty directory. The real settings, catalog and scan folders
+are not touched, and no scanner, network or Google account is needed.
+
+Two parts:
+
+  pipeline  runs 00_scan_control.py (with its image manager worker) for
+            --duration seconds with 6, 24 and 100 scanners, and reports scans
+            per hour, scan-to-upload latency (scan saved -> upload finished)
+            and the mean image manager pass time
+  archive   fills the catalog with 1k..200k archived images, then times the
+            image manager pass that follows a round of scans (and one full
+            pass), to show how cycle time grows with the size of old/
+
+Usage:
+    python3 benchmarks/bench_pipeline.py [--scanners 6 24 100] [--duration 120]
+        [--archive-sizes 1000 10000 50000 200000] [--skip-pipeline] [--skip-archive]
+"""
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import pickle
+import re
+import shutil
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_drive  # noqa: E402
+import fake_scanimage  # noqa: E402
+
+# Scanners per simulated USB bus; with the default max_scans_per_bus of 2
+# this gives the controller a realistic amount of bus contention
+SCANNERS_PER_BUS = 4
+
+def drive_root_folder_id():
+    with open(os.path.join(REPO_DIR, "02_image_manager.py")) as f:
+        return re.search(r'DRIVE_ROOT_FOLDER_ID = "([^"]*)"', f.read()).group(1)
+
+def scanner_ids(count):
+    return [f"scanner{i:02d}" for i in range(1, count + 1)]
+
+def make_home(tmp, scanners, args):
+    """
+    A RootBox directory with the repo's scripts, settings for `scanners`,
+    valid-looking Drive credentials and cached Drive folder IDs (so no
+    Drive metadata call is ever made). Returns the environment to run in.
+    """
+    from google.oauth2.credentials import Credentials
+
+    home = os.path.join(tmp, "home")
+    rootbox = os.path.join(home, "RootBox")
+    for sub in ("web", "creds"):
+        os.makedirs(os.path.join(rootbox, sub), exist_ok=True)
+    for path in glob.glob(os.path.join(REPO_DIR, "*.py")):
+        os.symlink(path, os.path.join(rootbox, os.path.basename(path)))
+
+    settings = {
+        "capture": {"engine": "scanimage", "mode": "stream", "format": "png", "compress_level": 1},
+        "scanners": {
+            scanner: {
+                "label": "bench",
+                "enabled": True,
+                "interval_minutes": args.interval / 60,
+                "resolution": args.resolution,
+                "device": f"fake:libusb:{i // SCANNERS_PER_BUS + 1:03d}:{i % SCANNERS_PER_BUS + 2:03d}",
+            }
+            for i, scanner in enumerate(scanners)
+        },
+    }
+    with open(os.path.join(rootbox, "web", "settings.json"), "w") as f:
+        json.dump(settings, f, indent=2)
+    with open(os.path.join(rootbox, "creds", "token.pickle"), "wb") as f:
+        pickle.dump(Credentials(token="bench"), f)
+    root = drive_root_folder_id()
+    with open(os.path.join(rootbox, "creds", "folder_ids.json"), "w") as f:
+        json.dump({f"{root}/{scanner}": f"bench-{scanner}" for scanner in scanners}, f)
+
+    wrapper = os.path.join(tmp, "scanimage")
+    with open(wrapper, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(BENCH_DIR, "fake_scanimage.py")}" "$@"\n')
+    os.chmod(wrapper, 0o755)
+
+    env = dict(os.environ, HOME=home, SCANIMAGE=wrapper, USB_SEARCH_PATHS=os.path.join(tmp, "no-usb"),
+               FAKE_SCAN_SECONDS=str(args.scan_seconds))
+    if args.pixels:
+        env["FAKE_SCAN_PIXELS"] = args.pixels
+    return env, rootbox
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[pct - 1]
+
+# -----------------------------
+# Pipeline
+# -----------------------------
+def run_pipeline(scanner_count, drive, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env, rootbox = make_home(tmp, scanner_ids(scanner_count), args)
+        env["DRIVE_UPLOAD_URL"] = drive.url
+        drive.uploads.clear()
+        with open(os.path.join(tmp, "controller.out"), "w") as out:
+            started = time.time()
+            proc = subprocess.Popen([sys.executable, os.path.join(rootbox, "00_scan_control.py")],
+                                    env=env, stdout=out, stderr=subprocess.STDOUT)
+            try:
+                time.sleep(args.duration)
+            finally:
+                proc.send_signal(signal.SIGTERM)
+                try:
+                    proc.wait(timeout=60)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+            elapsed = time.time() - started
+
+        with sqlite3.connect(os.path.join(rootbox, "state", "catalog.db")) as conn:
+            added = dict(conn.execute("SELECT filename, added FROM images").fetchall())
+        cycle_sum = cycle_count = 0
+        metrics_db = os.path.join(rootbox, "state", "metrics.db")
+        if os.path.exists(metrics_db):
+            with sqlite3.connect(metrics_db) as conn:
+                for name, value in conn.execute(
+                        "SELECT name, value FROM samples WHERE metric='rootbox_cycle_seconds' AND le=-1"):
+                    if name.endswith("_sum"):
+                        cycle_sum += value
+                    else:
+                        cycle_count += value
+
+    latencies = sorted(u["finished"] - added[name] for name, u in drive.uploads.items() if name in added)
+    return {
+        "scanners": scanner_count,
+        "seconds": elapsed,
+        "scans": len(added),
+        "scans_per_hour": len(added) / elapsed * 3600,
+        "uploads": len(latencies),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "cycle_mean": cycle_sum / cycle_count if cycle_count else float("nan"),
+    }
+
+# -----------------------------
+# Archive size
+# -----------------------------
+def fill_archive(image_catalog, old_dir, scanners, count, image_bytes):
+    """Catalog `count` archived, already uploaded images (no files: deleting a missing one is harmless)."""
+    conn = image_catalog._connect()
+    start = int(time.time()) - count * 60
+    rows = []
+    for i in range(count):
+        scanner = scanners[i % len(scanners)]
+        filename = f"{scanner}-archive-{start + i * 60}.png"
+        rows.append((filename, scanner, start + i * 60, image_bytes, image_catalog.OLD,
+                     os.path.join(old_dir, filename), "done", time.time(), image_catalog.RECOMPRESS_DONE))
+    with image_catalog._lock:
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO images (filename, scanner, timestamp, size, location, path, upload_state, added, recompressed) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("COMMIT")
+
+def archive_worker(args):
+    """Runs in a child process whose HOME is the temporary RootBox (module paths are set at import)."""
+    sys.path.insert(0, REPO_DIR)
+    spec = importlib.util.spec_from_file_location("image_manager", os.path.join(REPO_DIR, "02_image_manager.py"))
+    manager = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(manager)
+
+    scanners = scanner_ids(args.archive_scanners)
+    fill_archive(manager.image_catalog, manager.OLD_DIR, scanners, args.archive_run,
+                 int(args.archive_image_mb * 1024**2))
+    width, height = fake_scanimage.image_size(args.resolution)
+    template = os.path.join(manager.ROOTBOX_DIR, "template.png")
+    fake_scanimage.write_png(template, width, height, fake_scanimage.synthetic_pixels(width, height, seed=1))
+
+    times = []
+    timestamp = int(time.time())
+    for _ in range(args.cycles):
+        timestamp += 60
+        for scanner in scanners:
+            folder = os.path.join(manager.SCAN_DIR, scanner)
+            os.makedirs(folder, exist_ok=True)
+            shutil.copyfile(template, os.path.join(folder, f"{scanner}-bench-{timestamp}.png"))
+        started = time.perf_counter()
+        manager.run_cycle(scanners)
+        times.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    manager.run_cycle()
+    full = time.perf_counter() - started
+    manager.shutdown_previews()
+    manager.rootbox_log.close()
+
+    with open(args.result_file, "w") as f:
+        json.dump({"times": times, "full": full}, f)
+
+def run_archive(size, drive, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env, _ = make_home(tmp, scanner_ids(args.archive_scanners), args)
+        env["DRIVE_UPLOAD_URL"] = drive.url
+        result_file = os.path.join(tmp, "result.json")
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--archive-run", str(size), "--result-file", result_file,
+             "--archive-scanners", str(args.archive_scanners), "--cycles", str(args.cycles),
+             "--archive-image-mb", str(args.archive_image_mb), "--resolution", str(args.resolution)],
+            env=env, check=True, stdout=subprocess.DEVNULL,
+        )
+        with open(result_file) as f:
+            result = json.load(f)
+    times = sorted(result["times"])
+    return {"archive": size, "p50": percentile(times, 50), "p95": percentile(times, 95), "full": result["full"]}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scanners", type=int, nargs="+", default=[6, 24, 100])
+    parser.add_argument("--duration", type=float, default=120, help="seconds to run the controller per scanner count")
+    parser.add_argument("--interval", type=float, default=60, help="scan interval in seconds")
+    parser.add_argument("--scan-seconds", type=float, default=2, help="fake scan latency")
+    parser.add_argument("--resolution", type=int, default=75)
+    parser.add_argument("--pixels", help="fake scan size as WIDTHxHEIGHT (default: A4 at --resolution)")
+    parser.add_argument("--drive-latency", type=float, default=0.02, help="seconds added to each fake Drive request")
+    parser.add_argument("--archive-sizes", type=int, nargs="+", default=[1000, 10000, 50000, 200000])
+    parser.add_argument("--archive-scanners", type=int, default=6)
+    parser.add_argument("--archive-image-mb", type=float, default=0.1, help="catalogued size of each archived image")
+    parser.add_argument("--cycles", type=int, default=15, help="scan rounds timed per archive size")
+    parser.add_argument("--skip-pipeline", action="store_true")
+    parser.add_argument("--skip-archive", action="store_true")
+    parser.add_argument("--archive-run", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.archive_run is not None:
+        archive_worker(args)
+        return
+
+    drive = fake_drive.start(latency=args.drive_latency)
+    try:
+        if not args.skip_pipeline:
+            print(f"Pipeline: {args.duration:.0f}s per run, {args.interval:.0f}s interval, "
+                  f"{args.scan_seconds}s scans at {args.resolution} dpi")
+            print(f"{'scanners':>9}{'scans':>8}{'scans/h':>10}{'uploads':>9}"
+                  f"{'p50 lat s':>11}{'p95 lat s':>11}{'cycle s':>10}")
+            for count in args.scanners:
+                r = run_pipeline(count, drive, args)
+                print(f"{r['scanners']:>9}{r['scans']:>8}{r['scans_per_hour']:>10.0f}{r['uploads']:>9}"
+                      f"{r['latency_p50']:>11.2f}{r['latency_p95']:>11.2f}{r['cycle_mean']:>10.3f}", flush=True)
+
+        if not args.skip_archive:
+            print(f"\nArchive: {args.archive_scanners} scanners, {args.cycles} scan rounds per size")
+            print(f"{'archived':>10}{'p50 pass s':>12}{'p95 pass s':>12}{'full pass s':>13}")
+            for size in args.archive_sizes:
+                r = run_archive(size, drive, args)
+                print(f"{r['archive']:>10}{r['p50']:>12.3f}{r['p95']:>12.3f}{r['full']:>13.3f}", flush=True)
+    finally:
+        drive.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark lossless recompression of archived scans.
+
+Copies the given PNGs (or a synthetic scan-like image when none are given)
+to a temporary directory, recompresses them with every format in
+recompress.FORMATS and reports bytes saved against CPU-seconds spent.
+
+Usage:
+    python3 benchmarks/bench_recompress.py [image.png | folder ...] [--limit N]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import recompress  # noqa: E402
+
+def synthetic_scan(path, width=2480, height=3508):
+    """A 300 dpi A4-sized image written the way scanimage --format=png does (default compression)."""
+    from PIL import Image, ImageDraw, ImageFilter
+
+    img = Image.effect_noise((width, height), 24).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for i in range(0, width, 40):
+        draw.line([(i, 0), (width - i, height)], fill=(90, 60, 30), width=6)
+    img = img.filter(ImageFilter.GaussianBlur(2))
+    img.save(path, format="PNG", compress_level=6)
+
+def collect(paths, limit):
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files.extend(os.path.join(p, f) for f in sorted(os.listdir(p)) if f.endswith(".png"))
+        else:
+            files.append(p)
+    return files[:limit]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    if not recompress.available():
+        print("Pillow is required: pip install pillow")
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sources = collect(args.paths, args.limit)
+        if not sources:
+            sample = os.path.join(tmp, "synthetic-scan-0.png")
+            synthetic_scan(sample)
+            sources = [sample]
+
+        print(f"{'format':<8}{'images':>8}{'before MB':>12}{'after MB':>12}{'saved %':>10}{'CPU-s':>10}{'MB/CPU-s':>11}")
+        for fmt in recompress.FORMATS:
+            work = os.path.join(tmp, fmt)
+            os.makedirs(work)
+            before = after = cpu = 0
+            for src in sources:
+                dst = os.path.join(work, os.path.basename(src))
+                shutil.copy2(src, dst)
+                result = recompress.recompress_file(dst, fmt)
+                if result["status"] == "error":
+                    print(f"  {fmt}: {os.path.basename(src)} failed: {result.get('error')}")
+                    continue
+                before += result["old_size"]
+                after += result["new_size"]
+                cpu += result["cpu_seconds"]
+            saved = before - after
+            pct = 100 * saved / before if before else 0
+            rate = (saved / 1024**2) / cpu if cpu else 0
+            print(f"{fmt:<8}{len(sources):>8}{before / 1024**2:>12.2f}{after / 1024**2:>12.2f}"
+                  f"{pct:>10.1f}{cpu:>10.2f}{rate:>11.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark per-scan latency of the scan engines.
+
+Runs a number of scans against one SANE device (by default the built-in
+`test` backend, so no hardware is needed) through:
+
+  subprocess  python3 01_scan_image.py per scan, as the controller used to
+              (interpreter start + scanimage + backend load + device open)
+  scanimage   the scanimage engine called in-process (scanimage per scan)
+  sane        the sane engine called in-process, reusing one open session
+
+Everything is written under a temporary RootBox directory; the real
+settings, catalog and scan folders are not touched.
+
+Usage:
+    python3 benchmarks/bench_scan_latency.py [--device test:0] [--resolution 75] [--scans 10]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCAN_IMAGE_SCRIPT = os.path.join(REPO_DIR, "01_scan_image.py")
+SCANNER_ID = "scanner99"
+
+def write_settings(home, device, resolution, engine):
+    web = os.path.join(home, "RootBox", "web")
+    os.makedirs(web, exist_ok=True)
+    settings = {
+        "capture": {"engine": engine, "mode": "stream", "format": "png", "compress_level": 1},
+        "scanners": {SCANNER_ID: {"label": "bench", "device": device, "resolution": resolution}},
+    }
+    with open(os.path.join(web, "settings.json"), "w") as f:
+        json.dump(settings, f)
+
+def load_scan_module():
+    sys.path.insert(0, REPO_DIR)
+    spec = importlib.util.spec_from_file_location("scan_image", SCAN_IMAGE_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def time_subprocess(home, scans):
+    env = dict(os.environ, HOME=home)
+    times = []
+    for _ in range(scans):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, SCAN_IMAGE_SCRIPT, SCANNER_ID], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+def time_in_process(module, scans):
+    times = []
+    for _ in range(scans):
+        start = time.perf_counter()
+        module.scan(SCANNER_ID, in_process=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="test:0")
+    parser.add_argument("--resolution", type=int, default=75)
+    parser.add_argument("--scans", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        # The RootBox modules resolve their paths from $HOME when imported
+        os.environ["HOME"] = home
+        module = load_scan_module()
+
+        results = {}
+        write_settings(home, args.device, args.resolution, "scanimage")
+        results["subprocess"] = time_subprocess(home, args.scans)
+        results["scanimage"] = time_in_process(module, args.scans)
+        if module.sane_session.available():
+            write_settings(home, args.device, args.resolution, "sane")
+            results["sane"] = time_in_process(module, args.scans)
+            module.sane_session.close_all()
+        else:
+            print("python-sane not installed; skipping the sane engine")
+
+    print(f"{'engine':<12}{'scans':>7}{'first s':>10}{'median s':>10}{'mean s':>10}{'rest median s':>15}")
+    for engine, times in results.items():
+        rest = statistics.median(times[1:]) if len(times) > 1 else times[0]
+        print(f"{engine:<12}{len(times):>7}{times[0]:>10.3f}{statistics.median(times):>10.3f}"
+              f"{statistics.mean(times):>10.3f}{rest:>15.3f}")
+
+if __name__ == "__main__":
+    main()
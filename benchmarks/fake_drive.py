@@ -0,0 +1,109 @@
+"""
+Local stand-in for the Google Drive resumable upload endpoint.
+
+Implements what drive_upload.py uses: POST ?uploadType=resumable starts a
+session (Location header), PUT with Content-Range sends a chunk (308 with a
+Range header until the last one, then 200 with the file resource), and
+PUT "bytes */SIZE" asks for the current offset. Received data is counted,
+not stored. Point uploads at it with DRIVE_UPLOAD_URL=http://HOST:PORT/upload.
+
+Usage:
+    python3 benchmarks/fake_drive.py [--port 8765] [--latency 0.05]
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeDrive(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0):
+        super().__init__(address, FakeDriveHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.sessions = {}  # session id -> {"name", "size", "received", "started"}
+        self.uploads = {}   # file name -> {"size", "started", "finished"}
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/upload"
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, headers=None, body=b""):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_POST(self):
+        server = self.server
+        metadata = json.loads(self._body() or b"{}")
+        time.sleep(server.latency)
+        with server.lock:
+            session_id = str(next(server.ids))
+            server.sessions[session_id] = {
+                "name": metadata.get("name", ""),
+                "size": int(self.headers.get("X-Upload-Content-Length") or 0),
+                "received": 0,
+                "started": time.time(),
+            }
+        host, port = server.server_address[:2]
+        self._reply(200, {"Location": f"http://{host}:{port}/upload/session/{session_id}"})
+
+    def do_PUT(self):
+        server = self.server
+        data = self._body()
+        time.sleep(server.latency)
+        session = server.sessions.get(self.path.rsplit("/", 1)[-1])
+        if session is None:
+            self._reply(404)
+            return
+        content_range = self.headers.get("Content-Range", "")
+        if not content_range.startswith("bytes */"):
+            start = int(content_range.split(" ", 1)[1].split("-", 1)[0])
+            if start == session["received"]:
+                session["received"] += len(data)
+        if session["received"] >= session["size"]:
+            with server.lock:
+                server.uploads[session["name"]] = {
+                    "size": session["size"], "started": session["started"], "finished": time.time()}
+            self._reply(200, {"Content-Type": "application/json"},
+                        json.dumps({"id": f"fake-{session['name']}"}).encode())
+        else:
+            headers = {"Range": f"bytes=0-{session['received'] - 1}"} if session["received"] else {}
+            self._reply(308, headers)
+
+def start(port=0, latency=0.0):
+    """Serve on 127.0.0.1 in a background thread; returns the server (see .url and .uploads)."""
+    server = FakeDrive(("127.0.0.1", port), latency)
+    threading.Thread(target=server.serve_forever, name="fake-drive", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    args = parser.parse_args()
+    server = FakeDrive(("127.0.0.1", args.port), args.latency)
+    print(f"Fake Drive listening; set DRIVE_UPLOAD_URL={server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
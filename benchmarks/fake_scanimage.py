@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the scanimage CLI, for benchmarks and tests without scanners.
+
+Understands the arguments 01_scan_image.py passes (-d, --resolution,
+--mode Color|Gray, -l/-t/-x/-y in mm, --format=pnm|png, --batch=FILE) and
+writes a synthetic scan: PNM on stdout, or a PNG file in batch mode. -A
+lists the options of an A4 flatbed. Tuned through the environment:
+
+  FAKE_SCAN_SECONDS  time a scan takes (default 2)
+  FAKE_SCAN_PIXELS   image size as WIDTHxHEIGHT (default: A4 at the requested resolution)
+
+Point the RootBox scripts at it with SCANIMAGE=/path/to/fake_scanimage.py.
+"""
+import os
+import random
+import sys
+import time
+
+A4_INCHES = (8.27, 11.69)
+A4_MM = (210.0, 297.0)
+
+OPTIONS = """All options specific to device `fake:libusb:001:001':
+  Scan mode:
+    --mode Color|Gray [Color]
+        Selects the scan mode.
+    --depth 8|16 [8]
+        Number of bits per sample.
+    --resolution 75|150|300|600|1200dpi [150]
+        Sets the resolution of the scanned image.
+  Geometry:
+    -l 0..210mm (in steps of 0.1) [0]
+        Top-left x position of scan area.
+    -t 0..297mm (in steps of 0.1) [0]
+        Top-left y position of scan area.
+    -x 0..210mm (in steps of 0.1) [210]
+        Width of scan-area.
+    -y 0..297mm (in steps of 0.1) [297]
+        Height of scan-area.
+"""
+
+def image_size(resolution, area=None):
+    """Pixels for the scan area ((width, height) in mm, default the whole bed)."""
+    pixels = os.environ.get("FAKE_SCAN_PIXELS")
+    if pixels:
+        width, _, height = pixels.lower().partition("x")
+        width, height = int(width), int(height)
+        if area:
+            width, height = int(width * area[0] / A4_MM[0]), int(height * area[1] / A4_MM[1])
+        return width, height
+    if area:
+        return int(area[0] / 25.4 * resolution), int(area[1] / 25.4 * resolution)
+    return int(A4_INCHES[0] * resolution), int(A4_INCHES[1] * resolution)
+
+def synthetic_pixels(width, height, seed=None):
+    """
+    RGB bytes with some structure and some noise, so PNG compresses them
+    roughly as much as a real scan (and much less than a flat image).
+    """
+    rnd = random.Random(seed)
+    row = bytes(rnd.getrandbits(8) // 4 + 96 for _ in range(width * 3))
+    rows = []
+    for y in range(height):
+        shift = (y * 7) % len(row)
+        rows.append(row[shift:] + row[:shift])
+    return b"".join(rows)
+
+def write_png(path, width, height, data, mode="RGB"):
+    from PIL import Image
+    Image.frombytes(mode, (width, height), data).save(path, format="PNG", compress_level=1)
+
+def main(args):
+    if "-L" in args:
+        print("device `fake:libusb:001:001' is a RootBox fake flatbed scanner")
+        return 0
+    if "-A" in args:
+        print(OPTIONS, end="")
+        return 0
+    resolution = 150
+    batch = None
+    mode = "Color"
+    geometry = {}
+    for i, arg in enumerate(args):
+        if arg.startswith("--resolution="):
+            resolution = int(arg.split("=", 1)[1])
+        elif arg.startswith("--batch="):
+            batch = arg.split("=", 1)[1]
+        elif arg == "--mode":
+            mode = args[i + 1]
+        elif arg in ("-x", "-y"):
+            geometry[arg] = float(args[i + 1])
+
+    time.sleep(float(os.environ.get("FAKE_SCAN_SECONDS", "2")))
+    area = None
+    if geometry:
+        area = (geometry.get("-x", A4_MM[0]), geometry.get("-y", A4_MM[1]))
+    width, height = image_size(resolution, area)
+    data = synthetic_pixels(width, height, seed=time.time_ns())
+    if mode == "Gray":
+        data = data[::3]
+    if batch:
+        write_png(batch, width, height, data, "L" if mode == "Gray" else "RGB")
+    else:
+        magic = b"P5" if mode == "Gray" else b"P6"
+        sys.stdout.buffer.write(magic + b"\n%d %d\n255\n" % (width, height) + data)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; without it every scan counts as changed
+    np = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+STATE_DIR = os.path.join(ROOTBOX_DIR, "state")
+SIGNATURES_DB_PATH = os.path.join(STATE_DIR, "change_detect.db")
+
+# Scans are compared as grayscale images SAMPLE_WIDTH pixels wide (about
+# 0.8 mm per pixel for an A4 bed), split into TILE x TILE pixel tiles
+SAMPLE_WIDTH = 256
+TILE = 16
+# A sample pixel has changed when it differs by more than this many grey
+# levels (after removing any overall brightness shift), and a tile has
+# changed when more than TILE_FRACTION of its pixels have
+PIXEL_THRESHOLD = 24
+TILE_FRACTION = 0.02
+
+# Policy defaults, overridden by the "change_detection" block in settings.json
+# and per scanner by a "change_detection" block in the scanner's settings:
+#   policy: what happens to a near-duplicate scan
+#           "upload"       tag it only
+#           "low_priority" upload it after every changed scan
+#           "local_only"   keep it on the device (and USB), never upload it
+#           "dedupe"       delete it straight away
+#   threshold: a scan is a near-duplicate when at most this fraction of its
+#              tiles changed since the reference scan
+#   max_gap_hours: a scan this long after the reference is always kept, so
+#                  a dormant box still gets one scan a day into the archive
+DEFAULT_CHANGE_DETECTION = {"policy": "upload", "threshold": 0.0, "max_gap_hours": 24}
+POLICIES = ("upload", "low_priority", "local_only", "dedupe")
+
+# `pending` holds signatures computed at capture time until the image manager
+# checks the scan; `refs` holds each scanner's reference: the last scan that
+# was not a near-duplicate. Comparing against it rather than the previous scan
+# means slow growth adds up until it counts as a change.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending (
+    filename   TEXT PRIMARY KEY,
+    scanner    TEXT NOT NULL,
+    width      INTEGER NOT NULL,
+    height     INTEGER NOT NULL,
+    data       BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refs (
+    scanner    TEXT PRIMARY KEY,
+    filename   TEXT NOT NULL,
+    timestamp  INTEGER NOT NULL,
+    width      INTEGER NOT NULL,
+    height     INTEGER NOT NULL,
+    data       BLOB NOT NULL
+);
+"""
+
+_lock = threading.Lock()
+_conn = None
+
+def _connect():
+    global _conn
+    if _conn is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        conn = sqlite3.connect(SIGNATURES_DB_PATH, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _conn = conn
+    return _conn
+
+def _execute(sql, params=()):
+    """Run a write statement; returns the number of rows changed."""
+    with _lock:
+        return _connect().execute(sql, params).rowcount
+
+def _query(sql, params=()):
+    with _lock:
+        return [dict(r) for r in _connect().execute(sql, params).fetchall()]
+
+def available():
+    return np is not None and Image is not None
+
+def policy_for(settings, scanner):
+    """Change detection settings for a scanner, with defaults filled in."""
+    config = dict(DEFAULT_CHANGE_DETECTION, **settings.get("change_detection", {}))
+    config.update(settings.get("scanners", {}).get(scanner, {}).get("change_detection", {}))
+    if config["policy"] not in POLICIES:
+        config["policy"] = DEFAULT_CHANGE_DETECTION["policy"]
+    return config
+
+# -----------------------------
+# Signatures
+# -----------------------------
+def _reducible(img):
+    """
+    The image in a mode Image.reduce() accepts. 16-bit grayscale keeps its
+    top 8 bits; bilevel, palette and other modes become plain grayscale.
+    """
+    if img.mode.startswith("I"):
+        return Image.fromarray((np.asarray(img).astype(np.uint32) >> 8).clip(0, 255).astype(np.uint8), "L")
+    if img.mode not in ("L", "RGB", "RGBA"):
+        return img.convert("L")
+    return img
+
+def signature(img):
+    """
+    Downsampled grayscale copy of a PIL image: (width, height, bytes). The
+    full-size image is only touched by Image.reduce(), which averages whole
+    blocks of pixels in C; everything after works on ~100K pixels.
+    """
+    img = _reducible(img)
+    height = max(TILE, round(SAMPLE_WIDTH * img.height / img.width / TILE) * TILE)
+    factor = max(1, min(img.width // SAMPLE_WIDTH, img.height // height))
+    small = img.reduce(factor) if factor > 1 else img
+    small = small.convert("L").resize((SAMPLE_WIDTH, height), Image.BILINEAR)
+    return SAMPLE_WIDTH, height, small.tobytes()
+
+def signature_from_file(path):
+    """Signature of a saved scan, for scans captured without one (e.g. batch mode)."""
+    with Image.open(path) as img:
+        img.draft("RGB", (SAMPLE_WIDTH * 2, SAMPLE_WIDTH * 2))  # JPEG sources decode at reduced scale
+        return signature(img)
+
+def record(scanner, filename, img):
+    """Compute and store the signature of a scan still in memory after capture."""
+    width, height, data = signature(img)
+    _execute(
+        "INSERT OR REPLACE INTO pending (filename, scanner, width, height, data) VALUES (?, ?, ?, ?, ?)",
+        (filename, scanner, width, height, data),
+    )
+
+def _pop_pending(filename):
+    with _lock:
+        conn = _connect()
+        row = conn.execute("SELECT width, height, data FROM pending WHERE filename=?", (filename,)).fetchone()
+        conn.execute("DELETE FROM pending WHERE filename=?", (filename,))
+    return (row["width"], row["height"], row["data"]) if row else None
+
+# -----------------------------
+# Comparison
+# -----------------------------
+def changed_fraction(a, b):
+    """
+    Fraction of tiles that differ between two signatures (1.0 if they cannot
+    be compared). A uniform brightness shift, e.g. from the lamp warming up,
+    is removed first so it does not count as change.
+    """
+    if a[:2] != b[:2]:
+        return 1.0
+    width, height = a[:2]
+    pa = np.frombuffer(a[2], dtype=np.uint8).reshape(height, width).astype(np.int16)
+    pb = np.frombuffer(b[2], dtype=np.uint8).reshape(height, width).astype(np.int16)
+    diff = pa - pb
+    diff -= int(np.median(diff))
+    changed = np.abs(diff) > PIXEL_THRESHOLD
+    tiles = changed.reshape(height // TILE, TILE, width // TILE, TILE).mean(axis=(1, 3))
+    return float((tiles > TILE_FRACTION).mean())
+
+def check(scanner, filename, timestamp, path, threshold, max_gap_hours):
+    """
+    Compare a new scan with the scanner's reference scan. Returns
+    (changed fraction or None if there was nothing to compare with,
+    near-duplicate flag). Scans that are not near-duplicates become the
+    new reference. Scans must be checked in timestamp order.
+    """
+    sig = _pop_pending(filename) or signature_from_file(path)
+    refs = _query("SELECT timestamp, width, height, data FROM refs WHERE scanner=?", (scanner,))
+    score = None
+    duplicate = False
+    if refs and timestamp - refs[0]["timestamp"] < max_gap_hours * 3600:
+        ref = refs[0]
+        score = changed_fraction(sig, (ref["width"], ref["height"], ref["data"]))
+        duplicate = score <= threshold
+    if not duplicate:
+        _execute(
+            "INSERT OR REPLACE INTO refs (scanner, filename, timestamp, width, height, data) VALUES (?, ?, ?, ?, ?, ?)",
+            (scanner, filename, timestamp) + tuple(sig),
+        )
+    return score, duplicate
@@ -0,0 +1,191 @@
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import threading
+import time
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+STATE_DIR = os.path.join(ROOTBOX_DIR, "state")
+OPTIONS_DB_PATH = os.path.join(STATE_DIR, "device_options.db")
+
+# Set SCANIMAGE to use a different scanimage binary (e.g. a stand-in for testing)
+SCANIMAGE = os.environ.get("SCANIMAGE", "scanimage")
+QUERY_TIMEOUT_SECONDS = 30
+
+# Scan geometry in settings.json: "roi" holds scanimage's -l/-t (top-left
+# corner) and -x/-y (width and height), in the device's unit (normally mm)
+GEOMETRY = ("l", "t", "x", "y")
+# Scan modes offered when a device's own list is not known yet
+DEFAULT_MODES = ["Color", "Gray"]
+DEFAULT_DEPTHS = [8, 16]
+
+# What each device reported for `scanimage -A`, parsed (see parse_options)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS device_options (
+    device   TEXT PRIMARY KEY,
+    options  TEXT NOT NULL,
+    updated  REAL NOT NULL
+);
+"""
+
+_lock = threading.Lock()
+_conn = None
+
+def _connect():
+    global _conn
+    if _conn is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        conn = sqlite3.connect(OPTIONS_DB_PATH, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _conn = conn
+    return _conn
+
+def _execute(sql, params=()):
+    """Run a write statement; returns the number of rows changed."""
+    with _lock:
+        return _connect().execute(sql, params).rowcount
+
+def _query(sql, params=()):
+    with _lock:
+        return [dict(r) for r in _connect().execute(sql, params).fetchall()]
+
+# -----------------------------
+# Querying devices
+# -----------------------------
+_OPTION_LINE = re.compile(r"^\s+(-{1,2}[a-z][\w-]*)\s+(\S.*?)(?:\s+\[([^\]]*)\])?\s*$")
+_RANGE = re.compile(r"^(-?[\d.]+)\.\.(-?[\d.]+)([a-z%]*)(?:\s+\(in steps of ([\d.]+)\))?$")
+_NUMBER = re.compile(r"^(-?\d+(?:\.\d+)?)([a-z%]*)$")
+
+def _number(text):
+    value = float(text)
+    return int(value) if value.is_integer() else value
+
+def parse_options(text):
+    """
+    Option constraints from `scanimage -A` output:
+    {name: {"min", "max", "step", "unit", "default"}} for ranges and
+    {name: {"values", "unit", "default"}} for lists. Names lose their
+    leading dashes ("-l", "--mode" -> "l", "mode").
+    """
+    options = {}
+    for line in text.splitlines():
+        match = _OPTION_LINE.match(line)
+        if not match:
+            continue
+        name, spec, default = match.groups()
+        name = name.lstrip("-")
+        if spec.startswith("[="):  # boolean options, e.g. --preview[=(yes|no)]
+            continue
+        option = {"default": default}
+        span = _RANGE.match(spec)
+        if span:
+            low, high, unit, step = span.groups()
+            option.update(min=_number(low), max=_number(high), unit=unit,
+                          step=_number(step) if step else None)
+        else:
+            values = spec.split("|")
+            numbers = [_NUMBER.match(v) for v in values]
+            if all(numbers):
+                option.update(values=[_number(n.group(1)) for n in numbers], unit=numbers[-1].group(2))
+            else:
+                option.update(values=values, unit="")
+        if default not in (None, "inactive"):
+            number = _NUMBER.match(default)
+            option["default"] = _number(number.group(1)) if number else default
+        options[name] = option
+    return options
+
+def query(device):
+    """Ask a device for its options with `scanimage -A`. Raises on failure."""
+    result = subprocess.run([SCANIMAGE, "-d", device, "-A"], capture_output=True, text=True,
+                            check=True, timeout=QUERY_TIMEOUT_SECONDS)
+    options = parse_options(result.stdout)
+    if not options:
+        raise ValueError(f"No options reported by {device}")
+    return options
+
+# -----------------------------
+# Cache
+# -----------------------------
+def cached(device):
+    """Cached options of a device, or None if it has never been queried."""
+    rows = _query("SELECT options FROM device_options WHERE device=?", (device,))
+    return json.loads(rows[0]["options"]) if rows else None
+
+def all_cached():
+    return {r["device"]: json.loads(r["options"]) for r in _query("SELECT device, options FROM device_options")}
+
+def refresh(device):
+    """Query a device and cache the result. Returns its options; raises on failure."""
+    options = query(device)
+    _execute("INSERT OR REPLACE INTO device_options (device, options, updated) VALUES (?, ?, ?)",
+             (device, json.dumps(options), time.time()))
+    return options
+
+# -----------------------------
+# Scanner settings
+# -----------------------------
+def _allowed(option, value):
+    """True if a value satisfies a parsed constraint."""
+    if "values" in option:
+        return value in option["values"]
+    if not isinstance(value, (int, float)):
+        return False
+    return option["min"] <= value <= option["max"]
+
+def validate(config, options=None):
+    """
+    Check a scanner's "resolution", "mode", "depth" and "roi" settings,
+    against the device's options when they are known. Returns a list of
+    problems (empty if the settings are usable).
+    """
+    errors = []
+    options = options or {}
+    for name in ("resolution", "mode", "depth"):
+        value = config.get(name)
+        if value is None or name not in options:
+            continue
+        option = options[name]
+        if not _allowed(option, value):
+            allowed = ("/".join(str(v) for v in option["values"]) if "values" in option
+                       else f"{option['min']}..{option['max']}")
+            errors.append(f"{name} {value} is not supported by the device ({allowed})")
+
+    roi = config.get("roi")
+    if roi:
+        if any(not isinstance(roi.get(k), (int, float)) for k in GEOMETRY):
+            return errors + ["scan area needs all of left, top, width and height"]
+        if roi["x"] <= 0 or roi["y"] <= 0 or roi["l"] < 0 or roi["t"] < 0:
+            errors.append("scan area must have a positive size and start inside the bed")
+        # -x/-y ranges give the size of the bed
+        for start, size, label in (("l", "x", "width"), ("t", "y", "height")):
+            bed = options.get(size)
+            if bed and "max" in bed and roi[start] + roi[size] > bed["max"]:
+                errors.append(f"scan area ends at {roi[start] + roi[size]:g}{bed['unit']}, "
+                              f"past the bed {label} of {bed['max']:g}{bed['unit']}")
+    return errors
+
+def scanimage_args(config):
+    """scanimage arguments for a scanner's mode, depth and scan area."""
+    args = ["--mode", config.get("mode") or "Color"]
+    if config.get("depth"):
+        args += ["--depth", str(config["depth"])]
+    roi = config.get("roi")
+    if roi:
+        for k in GEOMETRY:
+            args += [f"-{k}", f"{roi[k]:g}"]
+    return args
+
+def sane_geometry(roi):
+    """SANE corner options (tl-x, tl-y, br-x, br-y) for a scan area, or None for the full bed."""
+    if not roi:
+        return None
+    return {"tl_x": roi["l"], "tl_y": roi["t"], "br_x": roi["l"] + roi["x"], "br_y": roi["t"] + roi["y"]}
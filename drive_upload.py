@@ -0,0 +1,222 @@
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+# Resumable upload sessions (session URI + confirmed byte offset), one JSON
+# file per image, so an interrupted upload resumes after a restart.
+SESSION_DIR = os.path.join(ROOTBOX_DIR, "state", "upload_sessions")
+
+# Set DRIVE_UPLOAD_URL to point uploads at a local stand-in for testing.
+DRIVE_UPLOAD_URL = os.environ.get("DRIVE_UPLOAD_URL", "https://www.googleapis.com/upload/drive/v3/files")
+
+# Chunks must be a multiple of 256 KiB for the Drive resumable protocol
+CHUNK_SIZE = 8 * 256 * 1024  # 2 MiB
+# Optional bandwidth cap in bytes/second shared by all uploads (0 = unlimited)
+MAX_BYTES_PER_SEC = int(os.environ.get("UPLOAD_MAX_BYTES_PER_SEC", "0"))
+
+HTTP_TIMEOUT = 60
+
+class UploadError(Exception):
+    """An upload step failed. `status` is the HTTP status (if any), `stage` is "start" or "chunk"."""
+
+    def __init__(self, message, status=None, stage=None):
+        super().__init__(message)
+        self.status = status
+        self.stage = stage
+
+# -----------------------------
+# Throttling
+# -----------------------------
+class Throttle:
+    """Token bucket shared by every upload thread."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= nbytes
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+_throttle = Throttle(MAX_BYTES_PER_SEC)
+
+class _ThrottledChunk:
+    """File-like body for urllib that reads a byte range through the throttle."""
+
+    def __init__(self, f, length, throttle):
+        self.f = f
+        self.remaining = length
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        self.throttle.consume(len(data))
+        return data
+
+# -----------------------------
+# Session persistence
+# -----------------------------
+def _session_path(filename):
+    return os.path.join(SESSION_DIR, f"{filename}.json")
+
+def load_session(filename, size):
+    try:
+        with open(_session_path(filename), 'r') as f:
+            session = json.load(f)
+    except Exception:
+        return None
+    # A session for a different version of the file is useless
+    if session.get("size") != size:
+        discard_session(filename)
+        return None
+    return session
+
+def save_session(filename, session):
+    os.makedirs(SESSION_DIR, exist_ok=True)
+    tmp = _session_path(filename) + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(session, f)
+    os.replace(tmp, _session_path(filename))
+
+def discard_session(filename):
+    try:
+        os.remove(_session_path(filename))
+    except FileNotFoundError:
+        pass
+
+# -----------------------------
+# Protocol
+# -----------------------------
+def _request(url, method, token, headers=None, data=None):
+    """
+    Send one request. Returns (status, headers, body); 308 (Resume Incomplete)
+    is returned like a success rather than raised. Network failures raise
+    UploadError, like HTTP errors further up.
+    """
+    req = urllib.request.Request(url, data=data, method=method)
+    req.add_header("Authorization", f"Bearer {token}")
+    for key, value in (headers or {}).items():
+        req.add_header(key, value)
+    try:
+        with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT) as resp:
+            return resp.status, resp.headers, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+    except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+        raise UploadError(f"{method} {url.split('?', 1)[0]} failed: {e}") from e
+
+def _offset_from_range(headers):
+    """Next byte to send, from a 308 response's 'Range: bytes=0-N' header."""
+    value = headers.get("Range") if headers else None
+    if not value:
+        return 0
+    return int(value.rsplit("-", 1)[-1]) + 1
+
+def _start_session(token, metadata, size, mime_type):
+    status, headers, body = _request(
+        f"{DRIVE_UPLOAD_URL}?uploadType=resumable&fields=id",
+        "POST",
+        token,
+        headers={
+            "Content-Type": "application/json; charset=UTF-8",
+            "X-Upload-Content-Type": mime_type,
+            "X-Upload-Content-Length": str(size),
+        },
+        data=json.dumps(metadata).encode("utf-8"),
+    )
+    if status != 200 or not headers.get("Location"):
+        raise UploadError(f"Could not start upload session (HTTP {status}): {body[:200]!r}", status, "start")
+    return headers["Location"]
+
+def _query_offset(token, session_uri, size):
+    """
+    Ask the server how much of an existing session it has. Returns the next
+    offset, the finished file resource (dict) if complete, or None if the
+    session has expired.
+    """
+    status, headers, body = _request(
+        session_uri, "PUT", token,
+        headers={"Content-Length": "0", "Content-Range": f"bytes */{size}"},
+        data=b"",
+    )
+    if status in (200, 201):
+        return json.loads(body or b"{}")
+    if status == 308:
+        return _offset_from_range(headers)
+    if status in (404, 410):
+        return None
+    raise UploadError(f"Upload status check failed (HTTP {status})", status, "chunk")
+
+def resumable_upload(path, metadata, token, mime_type="image/png", chunk_size=CHUNK_SIZE, throttle=None):
+    """
+    Upload a file to Drive in chunks using the resumable protocol. The session
+    URI and confirmed offset are saved after every chunk, so a later call for
+    the same file (even from a new process) continues where this one stopped.
+    Returns the created file resource (dict with 'id'). Raises UploadError.
+    """
+    throttle = _throttle if throttle is None else throttle
+    filename = os.path.basename(path)
+    size = os.path.getsize(path)
+
+    session = load_session(filename, size)
+    offset = 0
+    if session:
+        result = _query_offset(token, session["session_uri"], size)
+        if isinstance(result, dict):
+            discard_session(filename)
+            return result
+        if result is None:
+            discard_session(filename)
+            session = None
+        else:
+            offset = result
+
+    if not session:
+        session = {"session_uri": _start_session(token, metadata, size, mime_type), "size": size, "offset": 0}
+        save_session(filename, session)
+
+    with open(path, 'rb') as f:
+        while True:
+            f.seek(offset)
+            length = min(chunk_size, size - offset)
+            end = offset + length - 1
+            content_range = f"bytes {offset}-{end}/{size}" if length else f"bytes */{size}"
+            status, headers, body = _request(
+                session["session_uri"], "PUT", token,
+                headers={"Content-Length": str(length), "Content-Range": content_range},
+                data=_ThrottledChunk(f, length, throttle),
+            )
+            if status in (200, 201):
+                discard_session(filename)
+                return json.loads(body or b"{}")
+            if status == 308:
+                offset = _offset_from_range(headers)
+                session["offset"] = offset
+                save_session(filename, session)
+                continue
+            if status in (404, 410):
+                discard_session(filename)
+                raise UploadError(f"Upload session expired (HTTP {status}); will restart", status, "chunk")
+            # 5xx / 429 etc: keep the session so the next attempt resumes
+            raise UploadError(f"Upload chunk failed at byte {offset} (HTTP {status})", status, "chunk")
@@ -0,0 +1,278 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+STATE_DIR = os.path.join(ROOTBOX_DIR, "state")
+CATALOG_DB_PATH = os.path.join(STATE_DIR, "catalog.db")
+
+# Where the local copy of an image lives
+LIVE = "live"        # scan_images/<scanner>/
+OLD = "old"          # old/
+DELETED = "deleted"  # no local copy left
+
+# Archived images may have been recompressed to another lossless format
+IMAGE_EXTENSIONS = (".png", ".webp", ".tif")
+
+# Recompression state
+RECOMPRESS_TODO = 0
+RECOMPRESS_DONE = 1
+RECOMPRESS_FAILED = -1
+
+# `totals` is kept up to date by triggers, so archive sizes are a single
+# row lookup no matter how many images the catalog holds.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    filename      TEXT PRIMARY KEY,
+    scanner       TEXT NOT NULL,
+    timestamp     INTEGER NOT NULL,
+    size          INTEGER NOT NULL,
+    location      TEXT NOT NULL,
+    path          TEXT NOT NULL,
+    on_usb        INTEGER NOT NULL DEFAULT 0,
+    upload_state  TEXT NOT NULL DEFAULT 'pending',
+    added         REAL NOT NULL,
+    recompressed  INTEGER NOT NULL DEFAULT 0,
+    change        REAL,
+    duplicate     INTEGER NOT NULL DEFAULT 0,
+    depth         INTEGER NOT NULL DEFAULT 8
+);
+CREATE INDEX IF NOT EXISTS images_location ON images (location, scanner, timestamp);
+CREATE INDEX IF NOT EXISTS images_scanner ON images (scanner, timestamp);
+
+CREATE TABLE IF NOT EXISTS totals (
+    location  TEXT NOT NULL,
+    scanner   TEXT NOT NULL,
+    bytes     INTEGER NOT NULL DEFAULT 0,
+    count     INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (location, scanner)
+);
+
+CREATE TRIGGER IF NOT EXISTS images_insert AFTER INSERT ON images BEGIN
+    INSERT OR IGNORE INTO totals (location, scanner) VALUES (NEW.location, NEW.scanner);
+    UPDATE totals SET bytes = bytes + NEW.size, count = count + 1
+        WHERE location = NEW.location AND scanner = NEW.scanner;
+END;
+
+CREATE TRIGGER IF NOT EXISTS images_delete AFTER DELETE ON images BEGIN
+    UPDATE totals SET bytes = bytes - OLD.size, count = count - 1
+        WHERE location = OLD.location AND scanner = OLD.scanner;
+END;
+
+CREATE TRIGGER IF NOT EXISTS images_update AFTER UPDATE OF location, size, scanner ON images BEGIN
+    UPDATE totals SET bytes = bytes - OLD.size, count = count - 1
+        WHERE location = OLD.location AND scanner = OLD.scanner;
+    INSERT OR IGNORE INTO totals (location, scanner) VALUES (NEW.location, NEW.scanner);
+    UPDATE totals SET bytes = bytes + NEW.size, count = count + 1
+        WHERE location = NEW.location AND scanner = NEW.scanner;
+END;
+"""
+
+_lock = threading.Lock()
+_conn = None
+
+def _connect():
+    global _conn
+    if _conn is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        conn = sqlite3.connect(CATALOG_DB_PATH, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _migrate(conn)
+        _conn = conn
+    return _conn
+
+def _migrate(conn):
+    """Bring catalogs created by older versions up to the current schema."""
+    columns = {r["name"] for r in conn.execute("PRAGMA table_info(images)")}
+    if "recompressed" not in columns:
+        conn.execute("ALTER TABLE images ADD COLUMN recompressed INTEGER NOT NULL DEFAULT 0")
+    if "change" not in columns:
+        conn.execute("ALTER TABLE images ADD COLUMN change REAL")
+        conn.execute("ALTER TABLE images ADD COLUMN duplicate INTEGER NOT NULL DEFAULT 0")
+    if "depth" not in columns:
+        conn.execute("ALTER TABLE images ADD COLUMN depth INTEGER NOT NULL DEFAULT 8")
+    conn.execute("CREATE INDEX IF NOT EXISTS images_recompress ON images (recompressed, location, timestamp)")
+
+def _execute(sql, params=()):
+    """Run a write statement; returns the number of rows changed."""
+    with _lock:
+        return _connect().execute(sql, params).rowcount
+
+def _query(sql, params=()):
+    with _lock:
+        return [dict(r) for r in _connect().execute(sql, params).fetchall()]
+
+def parse_timestamp(filename):
+    """Unix timestamp from '<scanner>-<label>-<timestamp>.png', or None."""
+    try:
+        return int(os.path.splitext(filename)[0].split("-")[-1])
+    except ValueError:
+        return None
+
+# -----------------------------
+# Writes
+# -----------------------------
+def add_image(scanner, path, timestamp, size, location=LIVE, upload_state="pending", depth=8):
+    """Record an image (`depth` is bits per sample as scanned). Returns True if it was new to the catalog."""
+    added = _execute(
+        "INSERT OR IGNORE INTO images (filename, scanner, timestamp, size, location, path, upload_state, added, depth) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (os.path.basename(path), scanner, timestamp, size, location, path, upload_state, time.time(), depth),
+    )
+    return added > 0
+
+def move(filename, location, path):
+    _execute("UPDATE images SET location=?, path=? WHERE filename=?", (location, path, filename))
+
+def mark_deleted(filename):
+    _execute("UPDATE images SET location=? WHERE filename=?", (DELETED, filename))
+
+def set_size(filename, size):
+    _execute("UPDATE images SET size=? WHERE filename=?", (size, filename))
+
+def set_on_usb(filename):
+    _execute("UPDATE images SET on_usb=1 WHERE filename=?", (filename,))
+
+def set_upload_state(filename, state):
+    _execute("UPDATE images SET upload_state=? WHERE filename=?", (state, filename))
+
+def set_change(filename, change, duplicate):
+    """Record change detection: fraction of tiles changed (None if not compared) and the near-duplicate flag."""
+    _execute("UPDATE images SET change=?, duplicate=? WHERE filename=?", (change, int(duplicate), filename))
+
+def set_recompressed(filename, state, path=None, size=None):
+    """Record a recompression outcome; `path`/`size` are updated when the file was replaced."""
+    if path is None:
+        _execute("UPDATE images SET recompressed=? WHERE filename=?", (state, filename))
+    else:
+        _execute("UPDATE images SET recompressed=?, path=?, size=? WHERE filename=?", (state, path, size, filename))
+
+# -----------------------------
+# Reads
+# -----------------------------
+def unknown_filenames(filenames):
+    """Subset of `filenames` not yet in the catalog."""
+    filenames = list(filenames)
+    known = set()
+    for start in range(0, len(filenames), 500):
+        chunk = filenames[start:start + 500]
+        marks = ",".join("?" * len(chunk))
+        known.update(r["filename"] for r in _query(f"SELECT filename FROM images WHERE filename IN ({marks})", chunk))
+    return [f for f in filenames if f not in known]
+
+def images(location, scanner=None, limit=None, after=None):
+    """Images at a location, oldest first; `after` skips timestamps up to and including it."""
+    sql = "SELECT * FROM images WHERE location=?"
+    params = [location]
+    if scanner is not None:
+        sql += " AND scanner=?"
+        params.append(scanner)
+    if after is not None:
+        sql += " AND timestamp>?"
+        params.append(after)
+    sql += " ORDER BY timestamp"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return _query(sql, params)
+
+def get(filename):
+    rows = _query("SELECT * FROM images WHERE filename=?", (filename,))
+    return rows[0] if rows else None
+
+def recent(scanner, limit, offset=0):
+    """A scanner's images that still have a local copy, newest first."""
+    return _query(
+        "SELECT * FROM images WHERE scanner=? AND location IN (?, ?) ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+        (scanner, LIVE, OLD, limit, offset),
+    )
+
+def history(scanner, after=None, limit=100):
+    """
+    A scanner's images that still have a local copy (live or old/), oldest
+    first; `after` skips timestamps up to and including it.
+    """
+    return _query(
+        "SELECT * FROM images WHERE scanner=? AND location IN (?, ?) AND timestamp>? ORDER BY timestamp LIMIT ?",
+        (scanner, LIVE, OLD, -1 if after is None else after, limit),
+    )
+
+def recompress_candidates(limit):
+    """Oldest archived 8-bit images not yet recompressed that are not waiting for upload."""
+    return _query(
+        "SELECT * FROM images WHERE recompressed=? AND location=? AND upload_state IN ('done', 'unknown', 'skipped') "
+        "AND depth<=8 ORDER BY timestamp LIMIT ?",
+        (RECOMPRESS_TODO, OLD, limit),
+    )
+
+def location_size(location, scanner=None):
+    """Total bytes stored at a location (optionally for one scanner)."""
+    if scanner is None:
+        rows = _query("SELECT COALESCE(SUM(bytes), 0) AS b FROM totals WHERE location=?", (location,))
+    else:
+        rows = _query("SELECT bytes AS b FROM totals WHERE location=? AND scanner=?", (location, scanner))
+    return rows[0]["b"] if rows else 0
+
+def scanner_sizes(location):
+    """{scanner: bytes} stored at a location."""
+    rows = _query("SELECT scanner, bytes FROM totals WHERE location=? AND count>0", (location,))
+    return {r["scanner"]: r["bytes"] for r in rows}
+
+def location_count(location, scanner=None):
+    if scanner is None:
+        rows = _query("SELECT COALESCE(SUM(count), 0) AS n FROM totals WHERE location=?", (location,))
+    else:
+        rows = _query("SELECT count AS n FROM totals WHERE location=? AND scanner=?", (location, scanner))
+    return rows[0]["n"] if rows else 0
+
+def is_empty():
+    return not _query("SELECT 1 FROM images LIMIT 1")
+
+# -----------------------------
+# Bootstrap
+# -----------------------------
+def rebuild(scan_dir, old_dir):
+    """
+    One-off full index of scan_dir/<scanner>/ and old_dir, used when the
+    catalog is first created. Returns the number of images in the catalog.
+    """
+    sources = []
+    if os.path.isdir(scan_dir):
+        for scanner in os.listdir(scan_dir):
+            folder = os.path.join(scan_dir, scanner)
+            if os.path.isdir(folder) and scanner.startswith("scanner"):
+                sources.append((folder, LIVE, scanner))
+    if os.path.isdir(old_dir):
+        sources.append((old_dir, OLD, None))
+
+    rows = []
+    now = time.time()
+    for folder, location, scanner in sources:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if not entry.name.endswith(IMAGE_EXTENSIONS) or not entry.is_file():
+                    continue
+                timestamp = parse_timestamp(entry.name)
+                if timestamp is None:
+                    continue
+                owner = scanner or entry.name.split("-")[0]
+                rows.append((entry.name, owner, timestamp, entry.stat().st_size, location, entry.path, "unknown", now))
+
+    with _lock:
+        conn = _connect()
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT OR IGNORE INTO images (filename, scanner, timestamp, size, location, path, upload_state, added) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        conn.execute("COMMIT")
+        added = conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+    return added
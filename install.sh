@@ -21,7 +21,7 @@ AUTODETECT_SERVICE="rootbox-scanner-autodetect"
 print_section "📦 Installing dependencies..."
 sudo apt update
 sudo apt install -y git python3 python3-pip python3-venv python3-dev \
-  sane-utils libsane-common libjpeg-dev build-essential \
+  sane-utils libsane-common libsane-dev libjpeg-dev build-essential ffmpeg \
   realvnc-vnc-server realvnc-vnc-viewer
 
 # ----------------------------
@@ -61,6 +61,9 @@ source venv/bin/activate
 pip install --upgrade pip
 pip install flask gunicorn
 pip install google-api-python-client google-auth-httplib2 google-auth-oauthlib
+pip install pillow
+pip install numpy
+pip install python-sane || echo "⚠️ python-sane failed to build; scans will use scanimage"
 
 # Step 5: Create required folders
 mkdir -p "$INSTALL_DIR/logs"
@@ -83,7 +86,7 @@ After=network.target
 User=$USER
 WorkingDirectory=$INSTALL_DIR/web
 Environment="PATH=$INSTALL_DIR/venv/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
-ExecStart=$INSTALL_DIR/venv/bin/gunicorn -w 2 -b 0.0.0.0:5000 app:app
+ExecStart=$INSTALL_DIR/venv/bin/gunicorn -w 2 -k gthread --threads 8 -b 0.0.0.0:5000 app:app
 Restart=always
 
 [Install]
@@ -0,0 +1,62 @@
+import os
+
+BLOCK_SIZE = 8192
+# Upper bound on what one incremental read returns, so a client far behind
+# catches up in several small responses rather than one huge one
+MAX_READ_BYTES = 256 * 1024
+
+def _file_id(st):
+    return f"{st.st_dev:x}-{st.st_ino:x}"
+
+def file_id(path):
+    """Identity of the current log file; changes when the log is rotated."""
+    try:
+        return _file_id(os.stat(path))
+    except OSError:
+        return ""
+
+def tail(path, lines=50):
+    """
+    Last `lines` lines of a file, reading backwards from the end in blocks,
+    so the cost does not depend on the file size.
+    Returns (text, end offset, file id).
+    """
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        data = b""
+        # One extra newline: the file normally ends with one
+        while pos > 0 and data.count(b"\n") <= lines:
+            step = min(BLOCK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+        fid = _file_id(os.fstat(f.fileno()))
+    # The last element is b"" or a line still being written; leave the
+    # latter for the next incremental read
+    parts = data.split(b"\n")
+    end -= len(parts.pop())
+    text = b"".join(line + b"\n" for line in parts[-lines:]) if lines > 0 else b""
+    return text.decode("utf-8", errors="replace"), end, fid
+
+def read_since(path, offset, fid=None, max_bytes=MAX_READ_BYTES):
+    """
+    Complete lines written after byte `offset`. If the file was rotated or
+    truncated since (`fid` differs or it is shorter than `offset`), reading
+    restarts from the beginning of the new file.
+    Returns (text, new offset, file id, reset).
+    """
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        current = _file_id(st)
+        reset = (fid and fid != current) or offset > st.st_size
+        if reset:
+            offset = 0
+        f.seek(offset)
+        data = f.read(max_bytes)
+    # Hold back a partly written last line until it is finished
+    # (unless a single line fills the whole read)
+    complete = data[:data.rfind(b"\n") + 1]
+    if not complete and len(data) == max_bytes:
+        complete = data
+    return complete.decode("utf-8", errors="replace"), offset + len(complete), current, bool(reset)
@@ -0,0 +1,218 @@
+import atexit
+import bisect
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+STATE_DIR = os.path.join(ROOTBOX_DIR, "state")
+METRICS_DB_PATH = os.path.join(STATE_DIR, "metrics.db")
+
+# Each process adds up its measurements in memory and merges them into the
+# shared database this often (and at exit), so recording is a dict update
+# and the controller, scan subprocesses and web workers share one view
+FLUSH_SECONDS = 10
+
+# Latency buckets in seconds: from a quick USB copy up to a 1200 dpi scan
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+
+# Every metric is declared here: name -> (type, help)
+METRICS = {
+    "rootbox_scan_seconds": ("histogram", "Scheduled scan time, including waiting for the device and bus"),
+    "rootbox_scans_total": ("counter", "Scheduled scans by result (ok, failed, timeout)"),
+    "rootbox_scans_running": ("gauge", "Scheduled scans in progress"),
+    "rootbox_scanners_degraded": ("gauge", "Scanners currently marked degraded"),
+    "rootbox_manual_scans_total": ("counter", "Manual scans from the web UI by result"),
+    "rootbox_capture_seconds": ("histogram", "Time to capture and save one image, by engine"),
+    "rootbox_image_bytes_total": ("counter", "Bytes of scan images written"),
+    "rootbox_cycle_seconds": ("histogram", "Image manager pass time (kind: full or scanners)"),
+    "rootbox_upload_seconds": ("histogram", "Google Drive upload time per image"),
+    "rootbox_upload_bytes_total": ("counter", "Bytes uploaded to Google Drive"),
+    "rootbox_upload_failures_total": ("counter", "Failed Google Drive upload attempts"),
+    "rootbox_upload_backlog": ("gauge", "Images waiting to be uploaded"),
+    "rootbox_usb_copy_seconds": ("histogram", "Time to sync a batch of images to one USB drive"),
+    "rootbox_usb_bytes_total": ("counter", "Bytes copied to USB drives"),
+    "rootbox_usb_failures_total": ("counter", "USB drive syncs that stopped with an error"),
+    "rootbox_evictions_total": ("counter", "Archived images deleted from old/"),
+    "rootbox_evicted_bytes_total": ("counter", "Bytes freed by deleting archived images"),
+    "rootbox_archive_bytes": ("gauge", "Bytes stored in old/ per scanner"),
+    "rootbox_recompress_saved_bytes_total": ("counter", "Bytes saved by recompressing archived images"),
+    "rootbox_change_detect_seconds": ("histogram", "Time to compare a new scan with the scanner's reference scan"),
+    "rootbox_duplicates_total": ("counter", "Scans found unchanged since the reference scan, by policy"),
+}
+
+# One row per series. Histograms are stored Prometheus-style as _bucket
+# rows (with `le`), _sum and _count; `le` is -1 for every other series.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    metric   TEXT NOT NULL,
+    name     TEXT NOT NULL,
+    labels   TEXT NOT NULL,
+    le       REAL NOT NULL,
+    value    REAL NOT NULL,
+    updated  REAL NOT NULL,
+    PRIMARY KEY (name, labels, le)
+);
+"""
+
+_lock = threading.Lock()
+_conn = None
+_pending = {}  # (metric, labels) -> counter delta, gauge value or [bucket counts, sum, count]
+_pending_lock = threading.Lock()
+_gauges = {}   # (metric, labels) -> last gauge value this process recorded
+_writer = None
+
+def _connect():
+    global _conn
+    if _conn is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        conn = sqlite3.connect(METRICS_DB_PATH, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _conn = conn
+    return _conn
+
+def _escape(value):
+    """Escape a label value as the Prometheus text format requires."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(labels):
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()) if v is not None)
+
+# -----------------------------
+# Recording (never blocks on the database, never raises)
+# -----------------------------
+def inc(metric, value=1, **labels):
+    """Add to a counter."""
+    key = (metric, _labels(labels))
+    with _pending_lock:
+        _pending[key] = _pending.get(key, 0) + value
+    _start_writer()
+
+def set_gauge(metric, value, **labels):
+    """Set a gauge. Only a changed value is written, so callers can set gauges as often as they like."""
+    key = (metric, _labels(labels))
+    with _pending_lock:
+        if _gauges.get(key) == value:
+            return
+        _gauges[key] = _pending[key] = value
+    _start_writer()
+
+def observe(metric, value, **labels):
+    """Record one value (usually seconds) in a histogram."""
+    key = (metric, _labels(labels))
+    with _pending_lock:
+        hist = _pending.get(key)
+        if hist is None:
+            hist = _pending[key] = [[0] * (len(DEFAULT_BUCKETS) + 1), 0.0, 0]
+        hist[0][bisect.bisect_left(DEFAULT_BUCKETS, value)] += 1
+        hist[1] += value
+        hist[2] += 1
+    _start_writer()
+
+def _start_writer():
+    global _writer
+    if _writer is not None:
+        return
+    with _pending_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, name="metrics", daemon=True)
+            _writer.start()
+            atexit.register(flush)
+
+def _writer_loop():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        flush()
+
+def flush():
+    """Merge everything recorded since the last flush into the database."""
+    global _pending
+    with _pending_lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return
+    now = time.time()
+    counter = ("INSERT INTO samples (metric, name, labels, le, value, updated) VALUES (?, ?, ?, ?, ?, ?) "
+               "ON CONFLICT(name, labels, le) DO UPDATE SET value=value+excluded.value, updated=excluded.updated")
+    gauge = ("INSERT INTO samples (metric, name, labels, le, value, updated) VALUES (?, ?, ?, -1, ?, ?) "
+             "ON CONFLICT(name, labels, le) DO UPDATE SET value=excluded.value, updated=excluded.updated")
+    try:
+        with _lock:
+            conn = _connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for (metric, labels), value in pending.items():
+                    kind = METRICS.get(metric, ("counter",))[0]
+                    if kind == "gauge":
+                        conn.execute(gauge, (metric, metric, labels, value, now))
+                    elif kind == "histogram":
+                        buckets, total, count = value
+                        cumulative = 0
+                        for le, n in zip(DEFAULT_BUCKETS + (float("inf"),), buckets):
+                            cumulative += n
+                            conn.execute(counter, (metric, metric + "_bucket", labels, le, cumulative, now))
+                        conn.execute(counter, (metric, metric + "_sum", labels, -1, total, now))
+                        conn.execute(counter, (metric, metric + "_count", labels, -1, count, now))
+                    else:
+                        conn.execute(counter, (metric, metric, labels, -1, value, now))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    except Exception as ex:
+        print(f"Failed to write metrics: {ex}", file=sys.stderr)
+        _restore(pending)
+
+def _restore(pending):
+    """Merge measurements that could not be written back into `_pending`, for the next flush."""
+    with _pending_lock:
+        for key, value in pending.items():
+            current = _pending.get(key)
+            kind = METRICS.get(key[0], ("counter",))[0]
+            if current is None:
+                _pending[key] = value
+            elif kind == "histogram":
+                current[0] = [a + b for a, b in zip(current[0], value[0])]
+                current[1] += value[1]
+                current[2] += value[2]
+            elif kind != "gauge":  # a gauge set since the failed flush is newer
+                _pending[key] = current + value
+
+# -----------------------------
+# Exposition
+# -----------------------------
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(int(value)) if float(value).is_integer() else repr(value)
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    flush()
+    with _lock:
+        rows = _connect().execute(
+            "SELECT metric, name, labels, le, value FROM samples ORDER BY metric, labels, name, le"
+        ).fetchall()
+    lines = []
+    current = None
+    for row in rows:
+        if row["metric"] != current:
+            current = row["metric"]
+            kind, help_text = METRICS.get(current, ("untyped", ""))
+            lines.append(f"# HELP {current} {help_text}")
+            lines.append(f"# TYPE {current} {kind}")
+        labels = row["labels"]
+        if row["name"].endswith("_bucket"):
+            le = f'le="{_format_value(row["le"])}"'
+            labels = f"{labels},{le}" if labels else le
+        lines.append(f"{row['name']}{{{labels}}} {_format_value(row['value'])}" if labels
+                     else f"{row['name']} {_format_value(row['value'])}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,152 @@
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; the gallery is unavailable without it
+    Image = None
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+CACHE_DIR = os.path.join(ROOTBOX_DIR, "cache", "previews")
+STATE_DIR = os.path.join(ROOTBOX_DIR, "state")
+INDEX_DB_PATH = os.path.join(STATE_DIR, "previews.db")
+
+# Longest side in pixels of each preview kind. As JPEG a thumbnail is a few
+# KB and a preview around 100 KB, against tens of MB for a 600 dpi scan.
+SIZES = {"thumb": 256, "preview": 1280}
+JPEG_QUALITY = 80
+
+# The cache is kept under this size on disk; the least recently viewed
+# previews are deleted first (they are rebuilt on demand)
+MAX_CACHE_BYTES = 500 * 1024**2
+# A view is recorded at most once per entry in this many seconds, so
+# browsing does not turn into a database write per image
+TOUCH_SECONDS = 300
+
+# Index of cached files shared by the image manager and the web workers;
+# `last_used` orders the LRU eviction
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS previews (
+    filename   TEXT NOT NULL,
+    kind       TEXT NOT NULL,
+    path       TEXT NOT NULL,
+    size       INTEGER NOT NULL,
+    created    REAL NOT NULL,
+    last_used  REAL NOT NULL,
+    PRIMARY KEY (filename, kind)
+);
+CREATE INDEX IF NOT EXISTS previews_lru ON previews (last_used);
+"""
+
+_lock = threading.Lock()
+_conn = None
+
+def _connect():
+    global _conn
+    if _conn is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        conn = sqlite3.connect(INDEX_DB_PATH, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _conn = conn
+    return _conn
+
+def _execute(sql, params=()):
+    """Run a write statement; returns the number of rows changed."""
+    with _lock:
+        return _connect().execute(sql, params).rowcount
+
+def _query(sql, params=()):
+    with _lock:
+        return [dict(r) for r in _connect().execute(sql, params).fetchall()]
+
+def available():
+    return Image is not None
+
+def cache_path(scanner, filename, kind):
+    return os.path.join(CACHE_DIR, kind, scanner, os.path.splitext(filename)[0] + ".jpg")
+
+# -----------------------------
+# Rendering
+# -----------------------------
+def render(src_path, scanner, filename, kinds=None):
+    """
+    Decode a scan once and write each preview kind (largest first, each made
+    from the previous one) to the cache directory. Runs in a worker process
+    or a web request thread; the caller records the results with record().
+    Returns [(kind, path, size)].
+    """
+    kinds = sorted(kinds or SIZES, key=SIZES.get, reverse=True)
+    results = []
+    with Image.open(src_path) as img:
+        img.draft("RGB", (SIZES[kinds[0]], SIZES[kinds[0]]))  # JPEG sources decode at reduced scale
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        for kind in kinds:
+            img.thumbnail((SIZES[kind], SIZES[kind]), Image.LANCZOS, reducing_gap=3.0)
+            path = cache_path(scanner, filename, kind)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                img.save(tmp, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            results.append((kind, path, os.path.getsize(path)))
+    return results
+
+# -----------------------------
+# Cache index
+# -----------------------------
+def record(filename, results):
+    """Add rendered previews to the index, then trim the cache to MAX_CACHE_BYTES."""
+    now = time.time()
+    for kind, path, size in results:
+        _execute(
+            "INSERT OR REPLACE INTO previews (filename, kind, path, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+            (filename, kind, path, size, now, now),
+        )
+    evict()
+
+def evict(max_bytes=MAX_CACHE_BYTES):
+    """Delete least recently used previews until the cache fits in `max_bytes`. Returns bytes freed."""
+    total = _query("SELECT COALESCE(SUM(size), 0) AS b FROM previews")[0]["b"]
+    freed = 0
+    while total - freed > max_bytes:
+        rows = _query("SELECT filename, kind, path, size FROM previews ORDER BY last_used LIMIT 100")
+        if not rows:
+            break
+        for row in rows:
+            try:
+                os.remove(row["path"])
+            except FileNotFoundError:
+                pass
+            _execute("DELETE FROM previews WHERE filename=? AND kind=?", (row["filename"], row["kind"]))
+            freed += row["size"]
+            if total - freed <= max_bytes:
+                break
+    return freed
+
+def get(scanner, filename, kind, src_path=None):
+    """
+    Path of a cached preview, rendering it from `src_path` first if it is not
+    cached. Returns None if it is not cached and there is no source left.
+    """
+    rows = _query("SELECT path, last_used FROM previews WHERE filename=? AND kind=?", (filename, kind))
+    if rows and os.path.exists(rows[0]["path"]):
+        if time.time() - rows[0]["last_used"] >= TOUCH_SECONDS:
+            _execute("UPDATE previews SET last_used=? WHERE filename=? AND kind=?", (time.time(), filename, kind))
+        return rows[0]["path"]
+    if not src_path or not os.path.exists(src_path):
+        return None
+    results = render(src_path, scanner, filename)
+    record(filename, results)
+    return dict((k, p) for k, p, _ in results)[kind]
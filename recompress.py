@@ -0,0 +1,120 @@
+import os
+import time
+
+try:
+    from PIL import Image, PngImagePlugin
+except ImportError:  # Pillow is optional; recompression is skipped without it
+    Image = PngImagePlugin = None
+
+# Lossless target formats: extension and Pillow save options
+FORMATS = {
+    "png": (".png", {"format": "PNG", "optimize": True, "compress_level": 9}),
+    "webp": (".webp", {"format": "WEBP", "lossless": True, "quality": 100, "method": 6}),
+    "tiff": (".tif", {"format": "TIFF", "compression": "tiff_adobe_deflate"}),
+}
+
+# Worker processes run at this nice level so scans and the web UI keep priority
+NICE_LEVEL = 15
+
+def available():
+    return Image is not None
+
+def default_workers():
+    """Leave one core free for scanning and the web UI."""
+    return max(1, (os.cpu_count() or 1) - 1)
+
+def lower_priority():
+    """ProcessPoolExecutor initializer."""
+    try:
+        os.nice(NICE_LEVEL)
+    except Exception:
+        pass
+
+# Bits per sample each Pillow mode holds; modes not listed hold 8
+MODE_BITS = {"1": 1, "I;16": 16, "I;16B": 16, "I;16L": 16, "I": 32, "F": 32}
+
+def _pixels(img):
+    img.load()
+    return img.mode, img.size, img.tobytes()
+
+def _native_bits(path, img):
+    """Bits per sample stored in the file, which Pillow may have decoded to fewer (e.g. 16-bit RGB as RGB)."""
+    if img.format == "PNG":
+        with open(path, 'rb') as f:
+            header = f.read(25)  # signature, IHDR length/type, width, height, bit depth
+        return header[24] if len(header) == 25 else 8
+    if img.format == "TIFF":
+        bits = img.tag_v2.get(258, (8,))
+        return max(bits) if isinstance(bits, tuple) else bits
+    return 8
+
+def _save_options(img):
+    """Carry resolution, colour profile and PNG text over to the re-encoded file."""
+    options = {}
+    for key in ("dpi", "icc_profile", "exif"):
+        if img.info.get(key):
+            options[key] = img.info[key]
+    text = getattr(img, "text", None)
+    if text:
+        info = PngImagePlugin.PngInfo()
+        for key, value in text.items():
+            info.add_text(key, value)
+        options["pnginfo"] = info
+    return options
+
+def recompress_file(path, fmt="png", replace=True):
+    """
+    Losslessly re-encode one image. The result is decoded again and only
+    replaces the original if its pixels are identical and it is smaller.
+    Files with more bits per sample than Pillow decodes (16-bit colour) are
+    left alone, as comparing two 8-bit decodes would not notice the loss.
+    Runs inside a worker process.
+
+    Returns a dict: path (final path), old_size, new_size, cpu_seconds and
+    status ("replaced", "kept" when no smaller, "skipped" when too deep,
+    "mismatch", "missing" or "error").
+    """
+    start_cpu = time.process_time()
+    ext, options = FORMATS[fmt]
+    result = {"path": path, "old_size": 0, "new_size": 0, "cpu_seconds": 0.0, "status": "error"}
+    tmp = None
+    try:
+        result["old_size"] = result["new_size"] = os.path.getsize(path)
+        with Image.open(path) as img:
+            if _native_bits(path, img) > MODE_BITS.get(img.mode, 8):
+                result["status"] = "skipped"
+                return result
+            original = _pixels(img)
+            target = os.path.splitext(path)[0] + ext
+            tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(target)}.recompress")
+            img.save(tmp, **options, **_save_options(img))
+
+        with Image.open(tmp) as check:
+            identical = _pixels(check) == original
+
+        new_size = os.path.getsize(tmp)
+        if not identical:
+            result["status"] = "mismatch"
+        elif new_size >= result["old_size"]:
+            result["status"] = "kept"
+        elif replace:
+            if not os.path.exists(path):
+                result["status"] = "missing"  # evicted while we worked
+            else:
+                os.replace(tmp, target)
+                tmp = None
+                if target != path:
+                    os.remove(path)
+                result.update(path=target, new_size=new_size, status="replaced")
+        else:
+            result.update(new_size=new_size, status="replaced")
+    except FileNotFoundError:
+        result["status"] = "missing"
+    except Exception as ex:
+        result["status"] = "error"
+        result["error"] = str(ex)
+    finally:
+        if tmp and os.path.exists(tmp):
+            os.remove(tmp)
+        result["cpu_seconds"] = time.process_time() - start_cpu
+    return result
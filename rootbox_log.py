@@ -0,0 +1,178 @@
+import atexit
+import fcntl
+import gzip
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+LOG_DIR = os.path.join(ROOTBOX_DIR, "logs")
+# One JSON object per line: ts, level, source, msg and optionally scanner,
+# stage, duration (seconds) and any other fields the caller adds
+LOG_PATH = os.path.join(LOG_DIR, "control_log.jsonl")
+# Serialises writes and rotation between processes sharing the log
+LOCK_PATH = os.path.join(LOG_DIR, ".control_log.lock")
+
+# Rotate once the live file would exceed this size; rotated segments are
+# gzipped and only the newest KEEP_SEGMENTS are kept
+MAX_LOG_BYTES = 5 * 1024**2
+KEEP_SEGMENTS = 10
+
+# The writer collects records for up to FLUSH_SECONDS (or FLUSH_RECORDS
+# records) and writes them with a single append, so a burst of messages
+# costs one SD-card write instead of one per line
+FLUSH_SECONDS = 2
+FLUSH_RECORDS = 200
+# Producers never block on a slow disk: records beyond this are dropped
+# (and counted in the next record written)
+QUEUE_SIZE = 10000
+
+SOURCE_LABELS = {"image_manager": "Image Manager", "autodetect": "Autodetect"}
+
+_queue = queue.Queue(maxsize=QUEUE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+_dropped = 0
+
+def format_record(record):
+    """Human-readable form of a record, as shown in the web UI and on stdout."""
+    try:
+        ts = datetime.fromisoformat(record["ts"]).strftime("%Y-%m-%d %H:%M:%S")
+    except Exception:
+        ts = record.get("ts", "")
+    parts = [f"[{ts}]"]
+    if record.get("scanner"):
+        parts.append(f"[{record['scanner']}]")
+    if record.get("source") in SOURCE_LABELS:
+        parts.append(f"[{SOURCE_LABELS[record['source']]}]")
+    parts.append(record.get("msg", ""))
+    if record.get("duration") is not None:
+        parts.append(f"({record['duration']:.1f}s)")
+    return " ".join(parts)
+
+def format_line(line):
+    """Format one line of the log file; lines that are not JSON are returned as they are."""
+    try:
+        return format_record(json.loads(line))
+    except Exception:
+        return line
+
+def log(message, source="controller", scanner=None, stage=None, duration=None, level="info", echo=True, **fields):
+    """
+    Queue a structured log record for the writer thread. Never blocks and
+    never raises. `echo` also prints the formatted record to stdout.
+    """
+    global _dropped
+    record = {"ts": datetime.now().isoformat(timespec="milliseconds"), "level": level, "source": source}
+    if scanner is not None:
+        record["scanner"] = scanner
+    if stage is not None:
+        record["stage"] = stage
+    if duration is not None:
+        record["duration"] = round(duration, 3)
+    record["msg"] = message
+    record.update(fields)
+
+    if echo:
+        print(format_record(record))
+    _start_writer()
+    try:
+        _queue.put_nowait(record)
+    except queue.Full:
+        _dropped += 1
+
+def _start_writer():
+    global _writer
+    if _writer is not None:
+        return
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, name="log-writer", daemon=True)
+            _writer.start()
+            atexit.register(close)
+
+def _writer_loop():
+    global _dropped
+    while True:
+        batch = [_queue.get()]
+        deadline = time.monotonic() + FLUSH_SECONDS
+        while batch[-1] is not None and len(batch) < FLUSH_RECORDS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        records = [r for r in batch if r is not None]
+        if _dropped:
+            records.append({"ts": datetime.now().isoformat(timespec="milliseconds"), "level": "warning",
+                            "source": "log", "msg": f"Log queue full; dropped {_dropped} records"})
+            _dropped = 0
+        try:
+            if records:
+                _write(records)
+        except Exception as ex:
+            print(f"Failed to write log: {ex}", file=sys.stderr)
+        for _ in batch:
+            _queue.task_done()
+        if batch[-1] is None:
+            return
+
+def _write(records):
+    data = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in records).encode("utf-8")
+    os.makedirs(LOG_DIR, exist_ok=True)
+    segment = None
+    with open(LOCK_PATH, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            size = os.path.getsize(LOG_PATH)
+        except OSError:
+            size = 0
+        if size and size + len(data) > MAX_LOG_BYTES:
+            segment = os.path.join(LOG_DIR, f"control_log-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.jsonl")
+            os.rename(LOG_PATH, segment)
+        fd = os.open(LOG_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+    if segment:
+        _compress(segment)
+        _prune()
+
+def _compress(path):
+    with open(path, 'rb') as src, gzip.open(path + ".gz", 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+
+def _prune():
+    segments = sorted(f for f in os.listdir(LOG_DIR) if f.startswith("control_log-") and f.endswith(".jsonl.gz"))
+    for name in segments[:-KEEP_SEGMENTS]:
+        try:
+            os.remove(os.path.join(LOG_DIR, name))
+        except OSError:
+            pass
+
+def flush():
+    """Block until every queued record has been written."""
+    if _writer is not None:
+        _queue.join()
+
+def close():
+    """Write everything still queued and stop the writer thread."""
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None and writer.is_alive():
+        _queue.put(None)
+        writer.join()
@@ -0,0 +1,159 @@
+import threading
+import time
+
+try:
+    import sane
+except ImportError:  # python-sane is optional; scans fall back to the scanimage CLI
+    sane = None
+
+# Sessions unused for this long are closed (see scan_executor.release_parked).
+# Other processes that want the device, e.g. a manual scan started from the
+# web UI, get it sooner. 0 keeps idle sessions open until the process exits.
+DEFAULT_IDLE_SECONDS = 900
+
+_lock = threading.Lock()
+_initialised = False
+_sessions = {}  # device name -> Session
+
+class Session:
+    """An open SANE device handle reused across scans."""
+
+    def __init__(self, device):
+        self.device = device
+        self.handle = sane.open(device)
+        self.lock = threading.Lock()
+        self.opened = time.time()
+        self.last_used = self.opened
+        self.scans = 0
+        self.abandoned = False
+
+    def set_option(self, name, value):
+        """Set a SANE option if the backend has it and it differs from the current value."""
+        key = name.replace("-", "_")
+        if key not in self.handle.opt:
+            return False
+        if getattr(self.handle, key) != value:
+            setattr(self.handle, key, value)
+        return True
+
+    def set_geometry(self, geometry):
+        """
+        Scan the region {"tl_x", "tl_y", "br_x", "br_y"}, or the whole bed for
+        None. On each axis the corner that keeps the area valid is moved first.
+        """
+        for tl, br in (("tl_x", "br_x"), ("tl_y", "br_y")):
+            if tl not in self.handle.opt or br not in self.handle.opt:
+                continue
+            if geometry is None:
+                low, high = self.handle.opt[tl].constraint[0], self.handle.opt[br].constraint[1]
+            else:
+                low, high = geometry[tl], geometry[br]
+            if low >= getattr(self.handle, br):
+                self.set_option(br, high)
+                self.set_option(tl, low)
+            else:
+                self.set_option(tl, low)
+                self.set_option(br, high)
+
+    def scan(self, resolution, mode="Color", depth=None, geometry=None):
+        """Acquire one image; returns a Pillow image."""
+        self.set_option("resolution", resolution)
+        self.set_option("mode", mode)
+        if depth:
+            self.set_option("depth", depth)
+        self.set_geometry(geometry)
+        img = self.handle.scan()
+        self.scans += 1
+        self.last_used = time.time()
+        return img
+
+    def close(self):
+        try:
+            self.handle.close()
+        except Exception:
+            pass
+
+def available():
+    return sane is not None
+
+def _init():
+    global _initialised
+    if not _initialised:
+        sane.init()
+        _initialised = True
+
+def get_session(device):
+    """Return the open session for a device, opening it on first use."""
+    with _lock:
+        _init()
+        session = _sessions.get(device)
+        if session is None:
+            session = Session(device)
+            _sessions[device] = session
+        return session
+
+def is_open(device):
+    with _lock:
+        return device in _sessions
+
+def close_session(device):
+    with _lock:
+        session = _sessions.pop(device, None)
+    if session:
+        with session.lock:
+            session.close()
+
+def abort(device):
+    """
+    Cancel a scan that is stuck in a SANE call and forget its session. The
+    handle is not closed, since the scanning thread may still be inside it.
+    """
+    with _lock:
+        session = _sessions.pop(device, None)
+    if session:
+        session.abandoned = True
+        try:
+            session.handle.cancel()
+        except Exception:
+            pass
+
+def scan(device, resolution, mode="Color", depth=None, geometry=None):
+    """
+    Scan with a persistent handle for `device`. A handle that fails is
+    closed and reopened once, since a device that was unplugged or reset
+    leaves a stale handle behind. Raises sane's error types on failure.
+    """
+    for attempt in (1, 2):
+        session = get_session(device)
+        with session.lock:
+            try:
+                return session.scan(resolution, mode, depth, geometry)
+            except Exception:
+                if attempt == 2 or session.abandoned:
+                    raise
+        with _lock:
+            if _sessions.get(device) is session:
+                del _sessions[device]
+        session.close()
+
+def close_all():
+    global _initialised
+    with _lock:
+        devices = list(_sessions)
+    for device in devices:
+        close_session(device)
+    with _lock:
+        if _initialised:
+            try:
+                sane.exit()
+            except Exception:
+                pass
+            _initialised = False
+
+def sessions():
+    """Snapshot of open sessions: {device: {"opened", "last_used", "scans"}}."""
+    with _lock:
+        return {
+            d: {"opened": s.opened, "last_used": s.last_used, "scans": s.scans}
+            for d, s in _sessions.items()
+        }
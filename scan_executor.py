@@ -0,0 +1,432 @@
+import fcntl
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import sane_session
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+LOCK_DIR = os.path.join(ROOTBOX_DIR, 'locks')
+SCAN_IMAGE_SCRIPT = os.path.join(ROOTBOX_DIR, '01_scan_image.py')
+
+USB_SYSFS_DIR = "/sys/bus/usb/devices"
+
+# How many scans may share one USB bus (or hub) at the same time.
+# Overridden by "max_scans_per_bus" / "scan_group_by" in settings.json.
+DEFAULT_MAX_SCANS_PER_BUS = 2
+DEFAULT_GROUP_BY = "bus"  # "bus" or "hub"
+
+SLOT_POLL_SECONDS = 0.5
+
+# Scan deadlines in seconds by resolution: a scan gets the limit of the
+# smallest listed resolution at or above its own. Overridden by
+# "scan_timeouts" in settings.json or "scan_timeout_seconds" per scanner.
+DEFAULT_SCAN_TIMEOUTS = {75: 90, 150: 120, 300: 240, 600: 600, 1200: 1800}
+# After the deadline the scan is sent SIGTERM, then SIGKILL this much later
+KILL_GRACE_SECONDS = 5
+
+class ScanTimeout(Exception):
+    """A scan ran past its deadline and was stopped."""
+
+class DeviceBusy(Exception):
+    """The device stayed locked by someone else (e.g. a manual scan) for the whole wait."""
+
+def scan_timeout(resolution, timeouts=None, override=None):
+    """Deadline in seconds for a scan at `resolution` dpi."""
+    if override:
+        return float(override)
+    table = {int(k): v for k, v in (timeouts or DEFAULT_SCAN_TIMEOUTS).items()}
+    for limit in sorted(table):
+        if resolution <= limit:
+            return float(table[limit])
+    # Beyond the table: scale the largest entry by scan area
+    largest = max(table)
+    return float(table[largest]) * (resolution / largest) ** 2
+
+# -----------------------------
+# USB topology helpers
+# -----------------------------
+def _read_sysfs(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except Exception:
+        return ""
+
+def _find_sysfs_device(device):
+    """
+    Return the sysfs directory name (e.g. "1-1.2") of the USB device behind a
+    SANE device string, or None if it cannot be resolved.
+    Handles "backend:libusb:BBB:DDD" names and pixma-style
+    "pixma:VVVVPPPP_SERIAL" names.
+    """
+    try:
+        entries = [e for e in os.listdir(USB_SYSFS_DIR) if ":" not in e]
+    except Exception:
+        return None
+
+    match = re.search(r"libusb:(\d+):(\d+)", device)
+    if match:
+        busnum, devnum = int(match.group(1)), int(match.group(2))
+        for entry in entries:
+            base = os.path.join(USB_SYSFS_DIR, entry)
+            if (_read_sysfs(os.path.join(base, "busnum")) == str(busnum)
+                    and _read_sysfs(os.path.join(base, "devnum")) == str(devnum)):
+                return entry
+        return None
+
+    match = re.search(r":([0-9A-Fa-f]{4})([0-9A-Fa-f]{4})(?:_(\w+))?", device)
+    if match:
+        vendor, product, serial = match.group(1).lower(), match.group(2).lower(), match.group(3)
+        for entry in entries:
+            base = os.path.join(USB_SYSFS_DIR, entry)
+            if (_read_sysfs(os.path.join(base, "idVendor")).lower() == vendor
+                    and _read_sysfs(os.path.join(base, "idProduct")).lower() == product):
+                if serial and _read_sysfs(os.path.join(base, "serial")) not in ("", serial):
+                    continue
+                return entry
+    return None
+
+def get_usb_group(device, group_by=DEFAULT_GROUP_BY):
+    """
+    Return the concurrency group for a SANE device: "bus1" when grouping by
+    bus, or the parent hub port path (e.g. "hub1-1") when grouping by hub.
+    Devices that cannot be resolved share the "unknown" group.
+    """
+    if not device:
+        return "unknown"
+
+    match = re.search(r"libusb:(\d+):", device)
+    if match and group_by == "bus":
+        return f"bus{int(match.group(1))}"
+
+    entry = _find_sysfs_device(device)
+    if not entry:
+        return "unknown"
+
+    # sysfs names look like "<bus>-<port>[.<port>...]"
+    bus, _, ports = entry.partition("-")
+    if group_by == "hub" and "." in ports:
+        return f"hub{bus}-{ports.rsplit('.', 1)[0]}"
+    return f"bus{bus}"
+
+# -----------------------------
+# Locks
+# -----------------------------
+def _lock_path(name):
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", name) or "default"
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    return os.path.join(LOCK_DIR, f"{safe}.lock")
+
+def _request_path(name):
+    return _lock_path(f"want-{name}")
+
+def request_device(name):
+    """Ask the process that has parked a device lock (see release_parked) to give it up."""
+    try:
+        path = _request_path(name)
+        with open(path, 'a'):
+            pass
+        os.utime(path)
+    except OSError:
+        pass
+
+def _requested_since(name, since):
+    try:
+        return os.stat(_request_path(name)).st_mtime > since
+    except OSError:
+        return False
+
+def _acquire(f, device, timeout):
+    """flock a device lock file, asking a parked holder to let go. Raises DeviceBusy after `timeout`."""
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return
+    except BlockingIOError:
+        request_device(device)
+    if timeout is None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                raise DeviceBusy(f"Device {device} still busy after {timeout:.0f}s")
+            time.sleep(SLOT_POLL_SECONDS)
+
+@contextmanager
+def device_lock(device, timeout=None):
+    """
+    Hold an exclusive lock on a SANE device for the duration of a scan.
+    Uses flock on a file in LOCK_DIR, so it is honoured across threads and
+    across processes (controller and web app alike). Raises DeviceBusy if
+    the device is still busy after `timeout` seconds.
+    """
+    with open(_lock_path(f"device-{device}"), 'w') as f:
+        _acquire(f, device, timeout)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# Device locks kept after an in-process scan left its SANE session open:
+# device -> (lock file, time the lock was taken, time it was last parked)
+_parked = {}
+_parked_lock = threading.Lock()
+# Devices whose in-process scan timed out while stuck in a SANE call:
+# device -> (lock file, scan thread). The lock is kept until the thread
+# exits, so nothing else opens the device under it.
+_quarantined = {}
+_hung_threads = {}  # device -> scan thread still alive after its deadline
+
+@contextmanager
+def session_device_lock(device, timeout=None):
+    """
+    device_lock for in-process scans. While the scan leaves a SANE session
+    open the lock is parked rather than released, so no other process
+    opens the device under the session; release_parked() gives it back.
+    """
+    name = device or "default"
+    with _parked_lock:
+        if name in _quarantined:
+            raise DeviceBusy(f"Device {name} is quarantined until its hung scan exits")
+        parked = _parked.pop(name, None)
+    if parked is None:
+        f = open(_lock_path(f"device-{name}"), 'w')
+        try:
+            _acquire(f, name, timeout)
+        except BaseException:
+            f.close()
+            raise
+        taken = time.time()
+    else:
+        f, taken, _ = parked
+    try:
+        yield
+    finally:
+        thread = _hung_threads.pop(name, None)
+        if thread is not None and thread.is_alive():
+            with _parked_lock:
+                _quarantined[name] = (f, thread)
+        elif sane_session.is_open(device):
+            with _parked_lock:
+                _parked[name] = (f, taken, time.time())
+        else:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+def release_parked(idle_seconds=sane_session.DEFAULT_IDLE_SECONDS):
+    """
+    Close the SANE sessions of parked devices that another process has asked
+    for, that have been idle for `idle_seconds` (0: no limit) or whose
+    session is gone, and release their device locks. Returns the devices.
+    """
+    now = time.time()
+    released = []
+    with _parked_lock:
+        for name, (f, taken, parked_at) in list(_parked.items()):
+            device = "" if name == "default" else name
+            if (sane_session.is_open(device) and not _requested_since(name, taken)
+                    and not (idle_seconds and now - parked_at > idle_seconds)):
+                continue
+            del _parked[name]
+            sane_session.close_session(device)
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+            released.append(name)
+    return released
+
+def release_quarantined():
+    """Release the device locks of quarantined devices whose hung scan has exited. Returns the devices."""
+    released = []
+    with _parked_lock:
+        for name, (f, thread) in list(_quarantined.items()):
+            if thread.is_alive():
+                continue
+            del _quarantined[name]
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+            released.append(name)
+    return released
+
+def _deadline(timeout):
+    return None if timeout is None else time.monotonic() + timeout
+
+def _remaining(deadline):
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+@contextmanager
+def bus_slot(group, limit, timeout=None):
+    """
+    Take one of `limit` scan slots for a USB bus/hub group, waiting until
+    one is free. Raises DeviceBusy if none is free after `timeout` seconds.
+    """
+    limit = max(1, int(limit))
+    deadline = _deadline(timeout)
+    while True:
+        for slot in range(limit):
+            f = open(_lock_path(f"{group}-slot{slot}"), 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            try:
+                yield slot
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+            return
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeviceBusy(f"No free scan slot on {group} after {timeout:.0f}s")
+        time.sleep(SLOT_POLL_SECONDS)
+
+@contextmanager
+def bus_in_use(bus, timeout=None):
+    """
+    Shared lock held by every scan on a USB bus ("busN" or "unknown").
+    Device enumeration takes it exclusively, so it never runs while a scan
+    is using the bus and scans wait for an enumeration to finish. Raises
+    DeviceBusy if the bus is still being enumerated after `timeout` seconds.
+    """
+    deadline = _deadline(timeout)
+    with open(_lock_path(f"usage-{bus}"), 'w') as f:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | (0 if deadline is None else fcntl.LOCK_NB))
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise DeviceBusy(f"USB {bus} still being enumerated after {timeout:.0f}s")
+                time.sleep(SLOT_POLL_SECONDS)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+@contextmanager
+def exclusive_buses(buses, timeout):
+    """
+    Take the usage lock of every bus in `buses` exclusively, waiting up to
+    `timeout` seconds for scans on them to finish. Raises TimeoutError if
+    they stay busy. Locks are only ever held all together or not at all,
+    so a waiting enumeration never blocks scans on an idle bus.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        held = []
+        for bus in sorted(set(buses)):
+            f = open(_lock_path(f"usage-{bus}"), 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                break
+            held.append(f)
+        else:
+            break
+        for f in held:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"USB buses busy: {', '.join(sorted(set(buses)))}")
+        time.sleep(SLOT_POLL_SECONDS)
+    try:
+        yield
+    finally:
+        for f in held:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+# -----------------------------
+# Scan job
+# -----------------------------
+def _run_subprocess(cmd, timeout):
+    """
+    Run a command in its own process group; on timeout the whole group
+    (the scan script and its scanimage child) is terminated, then killed.
+    """
+    proc = subprocess.Popen(cmd, start_new_session=True)
+    try:
+        returncode = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                break
+            try:
+                proc.wait(timeout=KILL_GRACE_SECONDS)
+                break
+            except subprocess.TimeoutExpired:
+                continue
+        raise ScanTimeout(f"Scan exceeded {timeout:.0f}s and was killed")
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+def _run_in_thread(scan_fn, scanner_id, device, timeout):
+    """
+    Run an in-process scan with a deadline. A thread blocked in a SANE call
+    cannot be killed, so on timeout the scan is cancelled and its session
+    abandoned; the next scan opens the device afresh. A thread that does not
+    return even then keeps the device quarantined (see session_device_lock).
+    """
+    outcome = {}
+
+    def target():
+        try:
+            scan_fn(scanner_id)
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, name=f"scan-{scanner_id}", daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        sane_session.abort(device)
+        thread.join(KILL_GRACE_SECONDS)
+        if thread.is_alive():
+            _hung_threads[device or "default"] = thread
+        raise ScanTimeout(f"Scan exceeded {timeout:.0f}s and was cancelled")
+    if "error" in outcome:
+        raise outcome["error"]
+
+def run_scan(scanner_id, device, max_per_bus=DEFAULT_MAX_SCANS_PER_BUS, group_by=DEFAULT_GROUP_BY,
+             scan_fn=None, timeout=None, on_locked=None):
+    """
+    Scan one scanner once both the device lock and a bus slot are held.
+    `scan_fn(scanner_id)` scans in-process (keeping SANE sessions open);
+    without it 01_scan_image.py is run as a subprocess, which raises
+    subprocess.CalledProcessError on failure. With a `timeout` the scan is
+    stopped at the deadline and ScanTimeout is raised; waiting for the
+    device lock and a bus slot counts against the same limit and raises
+    DeviceBusy. An in-process scan that leaves its SANE session open keeps
+    the device lock until release_parked() lets it go. `on_locked()` is
+    called once the device is held and the scan is about to start.
+    """
+    group = get_usb_group(device, group_by)
+    bus = group if group_by == "bus" else get_usb_group(device, "bus")
+    deadline = _deadline(timeout)
+    lock = device_lock(device or "default", timeout) if scan_fn is None else session_device_lock(device, timeout)
+    with lock:
+        with bus_slot(group, max_per_bus, _remaining(deadline)):
+            with bus_in_use(bus, _remaining(deadline)):
+                if on_locked is not None:
+                    on_locked()
+                if scan_fn is not None:
+                    if timeout is None:
+                        scan_fn(scanner_id)
+                    else:
+                        _run_in_thread(scan_fn, scanner_id, device, timeout)
+                else:
+                    _run_subprocess(["python3", SCAN_IMAGE_SCRIPT, scanner_id], timeout)
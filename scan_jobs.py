@@ -0,0 +1,135 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+STATE_DIR = os.path.join(ROOTBOX_DIR, "state")
+JOBS_DB_PATH = os.path.join(STATE_DIR, "scan_jobs.db")
+
+# Finished jobs are kept this long so the page can still fetch the result
+KEEP_FINISHED_SECONDS = 24 * 3600
+
+# Job states
+QUEUED = "queued"      # accepted, waiting for a worker thread
+WAITING = "waiting"    # waiting for the device lock / a bus slot
+SCANNING = "scanning"  # device held, scan running
+DONE = "done"
+FAILED = "failed"
+ACTIVE_STATES = (QUEUED, WAITING, SCANNING)
+
+# Jobs are shared by every web worker process. The partial unique index
+# allows only one active job per scanner, which is what stops two clicks
+# (in any worker) from booking the same scanner twice.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id        TEXT PRIMARY KEY,
+    scanner   TEXT NOT NULL,
+    state     TEXT NOT NULL,
+    pid       INTEGER NOT NULL,
+    created   REAL NOT NULL,
+    started   REAL,
+    finished  REAL,
+    timeout   REAL,
+    message   TEXT,
+    image     TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active ON jobs (scanner)
+    WHERE state IN ('queued', 'waiting', 'scanning');
+"""
+
+_lock = threading.Lock()
+_conn = None
+
+def _connect():
+    global _conn
+    if _conn is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        conn = sqlite3.connect(JOBS_DB_PATH, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _conn = conn
+    return _conn
+
+def _execute(sql, params=()):
+    """Run a write statement; returns the number of rows changed."""
+    with _lock:
+        return _connect().execute(sql, params).rowcount
+
+def _query(sql, params=()):
+    with _lock:
+        return [dict(r) for r in _connect().execute(sql, params).fetchall()]
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def _reap(job):
+    """Fail an active job whose owning process has died (e.g. a restarted web worker)."""
+    if job["state"] in ACTIVE_STATES and not _pid_alive(job["pid"]):
+        _execute(
+            "UPDATE jobs SET state=?, finished=?, message=? WHERE id=? AND state IN (?, ?, ?)",
+            (FAILED, time.time(), "Interrupted: web worker stopped", job["id"], *ACTIVE_STATES),
+        )
+        job.update(state=FAILED, message="Interrupted: web worker stopped")
+    return job
+
+def active_job(scanner):
+    rows = _query(
+        "SELECT * FROM jobs WHERE scanner=? AND state IN (?, ?, ?)", (scanner, *ACTIVE_STATES)
+    )
+    if not rows:
+        return None
+    job = _reap(rows[0])
+    return job if job["state"] in ACTIVE_STATES else None
+
+def create(scanner, timeout=None):
+    """
+    Queue a job for a scanner. Returns (job, created): if the scanner already
+    has an active job, that job is returned with created=False.
+    """
+    now = time.time()
+    _execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished<?", (now - KEEP_FINISHED_SECONDS,))
+    existing = active_job(scanner)
+    if existing:
+        return existing, False
+    job_id = uuid.uuid4().hex
+    try:
+        _execute(
+            "INSERT INTO jobs (id, scanner, state, pid, created, timeout) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, scanner, QUEUED, os.getpid(), now, timeout),
+        )
+    except sqlite3.IntegrityError:
+        # Another worker queued one for this scanner in the meantime
+        existing = active_job(scanner)
+        if existing:
+            return existing, False
+        raise
+    return get(job_id), True
+
+def get(job_id):
+    rows = _query("SELECT * FROM jobs WHERE id=?", (job_id,))
+    return _reap(rows[0]) if rows else None
+
+def set_state(job_id, state, message=None):
+    if state == SCANNING:
+        _execute("UPDATE jobs SET state=?, started=? WHERE id=?", (state, time.time(), job_id))
+    else:
+        _execute("UPDATE jobs SET state=?, message=COALESCE(?, message) WHERE id=?", (state, message, job_id))
+
+def finish(job_id, ok, message, image=None):
+    _execute(
+        "UPDATE jobs SET state=?, finished=?, message=?, image=? WHERE id=?",
+        (DONE if ok else FAILED, time.time(), message, image, job_id),
+    )
@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+STATE_DIR = os.path.join(ROOTBOX_DIR, "state")
+STATE_DB_PATH = os.path.join(STATE_DIR, "runtime.db")
+
+# Runtime state that used to be written into settings.json. settings.json
+# now holds only what the user configures; the controller records scan
+# times, deadlines and health here. WAL mode lets the web app read a
+# consistent snapshot while the controller writes.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scanner_state (
+    scanner          TEXT PRIMARY KEY,
+    last_scan        REAL,
+    next_due         REAL,
+    failures         INTEGER NOT NULL DEFAULT 0,
+    degraded_since   REAL,
+    degraded_reason  TEXT,
+    updated          REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scan_events (
+    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    scanner  TEXT NOT NULL,
+    created  REAL NOT NULL
+);
+"""
+
+_lock = threading.Lock()
+_conn = None
+
+def _connect():
+    global _conn
+    if _conn is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        conn = sqlite3.connect(STATE_DB_PATH, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _conn = conn
+    return _conn
+
+def _execute(sql, params=()):
+    """Run a write statement; returns the number of rows changed."""
+    with _lock:
+        return _connect().execute(sql, params).rowcount
+
+def _query(sql, params=()):
+    with _lock:
+        return [dict(r) for r in _connect().execute(sql, params).fetchall()]
+
+def _upsert(scanner, **fields):
+    """Set some columns of a scanner's row, creating it if needed."""
+    fields["updated"] = time.time()
+    columns = ", ".join(fields)
+    marks = ", ".join("?" * len(fields))
+    updates = ", ".join(f"{c}=excluded.{c}" for c in fields)
+    _execute(
+        f"INSERT INTO scanner_state (scanner, {columns}) VALUES (?, {marks}) "
+        f"ON CONFLICT(scanner) DO UPDATE SET {updates}",
+        (scanner, *fields.values()),
+    )
+
+# -----------------------------
+# Reads
+# -----------------------------
+def scanner_states():
+    """{scanner: state dict} for every scanner with recorded state, read as one snapshot."""
+    return {r["scanner"]: r for r in _query("SELECT * FROM scanner_state")}
+
+def scanner_state(scanner):
+    rows = _query("SELECT * FROM scanner_state WHERE scanner=?", (scanner,))
+    return rows[0] if rows else None
+
+# -----------------------------
+# Writes
+# -----------------------------
+def set_next_due(scanner, next_due):
+    _upsert(scanner, next_due=next_due)
+
+def record_success(scanner, started):
+    """A good scan: remember when it started and clear any failure state."""
+    _upsert(scanner, last_scan=started, failures=0, degraded_since=None, degraded_reason=None)
+
+def record_failure(scanner, failures, degraded_reason=None):
+    """A failed scan; `degraded_reason` marks the scanner degraded (keeping the original `since`)."""
+    if degraded_reason is None:
+        _upsert(scanner, failures=failures)
+        return
+    state = scanner_state(scanner) or {}
+    since = state.get("degraded_since") or time.time()
+    _upsert(scanner, failures=failures, degraded_since=since, degraded_reason=degraded_reason)
+
+# -----------------------------
+# Scan events from other processes
+# -----------------------------
+def post_scan_event(scanner):
+    """Tell the controller's image manager about a scan taken outside it (e.g. a manual scan)."""
+    _execute("INSERT INTO scan_events (scanner, created) VALUES (?, ?)", (scanner, time.time()))
+
+def take_scan_events():
+    """Scanner IDs of posted scan events, oldest first; they are removed from the store."""
+    with _lock:
+        conn = _connect()
+        rows = conn.execute("SELECT id, scanner FROM scan_events ORDER BY id").fetchall()
+        if rows:
+            conn.execute("DELETE FROM scan_events WHERE id<=?", (rows[-1]["id"],))
+    return [r["scanner"] for r in rows]
+
+# -----------------------------
+# Migration
+# -----------------------------
+def migrate_settings(settings):
+    """
+    Move runtime fields that older versions kept in settings.json into the
+    store. Returns True if `settings` was changed and should be saved.
+    """
+    changed = False
+    for scanner, config in settings.get("scanners", {}).items():
+        last_scan = config.pop("last_scan", None)
+        degraded = config.pop("degraded", None)
+        if last_scan is None and degraded is None:
+            continue
+        changed = True
+        if last_scan is not None:
+            try:
+                _upsert(scanner, last_scan=time.mktime(time.strptime(last_scan[:19], "%Y-%m-%dT%H:%M:%S")))
+            except ValueError:
+                pass
+        if degraded:
+            _upsert(scanner, failures=degraded.get("failures", 0), degraded_since=time.time(),
+                    degraded_reason=degraded.get("reason"))
+    return changed
@@ -0,0 +1,28 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+from PIL import Image  # noqa: E402
+
+import change_detect  # noqa: E402
+
+def gradient(width=1024, height=768):
+    return np.tile(np.linspace(0, 1, width), (height, 1))
+
+@pytest.mark.parametrize("mode, dtype", [("I;16", "<u2"), ("I;16B", ">u2")])
+def test_16bit_gray_matches_8bit_signature(mode, dtype):
+    values = gradient()
+    img8 = Image.fromarray((values * 255).astype(np.uint8), "L")
+    samples = ((values * 255).astype(np.uint16) << 8).astype(dtype)
+    img16 = Image.frombytes(mode, img8.size, samples.tobytes())
+
+    width, height, data8 = change_detect.signature(img8)
+    assert change_detect.signature(img16) == (width, height, data8)
+
+def test_bilevel_image_has_a_signature():
+    img = Image.fromarray(gradient() > 0.5).convert("1")
+
+    width, height, data = change_detect.signature(img)
+
+    assert width == change_detect.SAMPLE_WIDTH
+    assert len(data) == width * height
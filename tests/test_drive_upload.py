@@ -0,0 +1,69 @@
+import os
+import socket
+
+import pytest
+
+import drive_upload
+from benchmarks import fake_drive
+
+CHUNK = 256 * 1024
+
+class Interrupted(Exception):
+    pass
+
+class CountingThrottle:
+    def __init__(self):
+        self.sent = 0
+
+    def consume(self, nbytes):
+        self.sent += nbytes
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    monkeypatch.setattr(drive_upload, "SESSION_DIR", str(tmp_path / "state" / "upload_sessions"))
+    server = fake_drive.start()
+    monkeypatch.setattr(drive_upload, "DRIVE_UPLOAD_URL", server.url)
+    yield server
+    server.shutdown()
+
+def test_interrupted_upload_resumes_from_saved_session(tmp_path, drive, monkeypatch):
+    path = str(tmp_path / "scanner1-a-100.png")
+    with open(path, 'wb') as f:
+        f.write(os.urandom(3 * CHUNK + 1000))
+    size = os.path.getsize(path)
+
+    # Die right after the first chunk is confirmed and checkpointed
+    save_session = drive_upload.save_session
+    def save_then_die(filename, session):
+        save_session(filename, session)
+        if session["offset"]:
+            raise Interrupted()
+    monkeypatch.setattr(drive_upload, "save_session", save_then_die)
+    with pytest.raises(Interrupted):
+        drive_upload.resumable_upload(path, {"name": "scanner1-a-100.png"}, "token",
+                                      chunk_size=CHUNK, throttle=CountingThrottle())
+    session_file = os.path.join(drive_upload.SESSION_DIR, "scanner1-a-100.png.json")
+    assert drive_upload.load_session("scanner1-a-100.png", size)["offset"] == CHUNK
+
+    monkeypatch.setattr(drive_upload, "save_session", save_session)
+    throttle = CountingThrottle()
+    result = drive_upload.resumable_upload(path, {"name": "scanner1-a-100.png"}, "token",
+                                           chunk_size=CHUNK, throttle=throttle)
+
+    assert result == {"id": "fake-scanner1-a-100.png"}
+    assert throttle.sent == size - CHUNK
+    assert len(drive.sessions) == 1
+    assert drive.uploads["scanner1-a-100.png"]["size"] == size
+    assert not os.path.exists(session_file)
+
+def test_unreachable_server_raises_upload_error(tmp_path, drive, monkeypatch):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    monkeypatch.setattr(drive_upload, "DRIVE_UPLOAD_URL", f"http://127.0.0.1:{port}/upload")
+    path = str(tmp_path / "scan.png")
+    with open(path, 'wb') as f:
+        f.write(b"x" * 10)
+
+    with pytest.raises(drive_upload.UploadError):
+        drive_upload.resumable_upload(path, {"name": "scan.png"}, "token")
@@ -0,0 +1,47 @@
+import pytest
+
+import metrics
+
+@pytest.fixture(autouse=True)
+def metrics_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "METRICS_DB_PATH", str(tmp_path / "metrics.db"))
+    monkeypatch.setattr(metrics, "_conn", None)
+    monkeypatch.setattr(metrics, "_pending", {})
+    monkeypatch.setattr(metrics, "_gauges", {})
+
+def test_unchanged_gauge_is_not_written_again():
+    metrics.set_gauge("rootbox_scans_running", 2)
+    metrics.flush()
+
+    metrics.set_gauge("rootbox_scans_running", 2)
+    assert metrics._pending == {}
+
+    metrics.set_gauge("rootbox_scans_running", 3)
+    metrics.flush()
+    assert "rootbox_scans_running 3" in metrics.render()
+
+def test_failed_flush_keeps_counts_for_the_next_one(monkeypatch):
+    connect = metrics._connect
+    metrics.inc("rootbox_scans_total", result="ok")
+    metrics.observe("rootbox_scan_seconds", 2.0)
+
+    def broken():
+        raise OSError("disk full")
+    monkeypatch.setattr(metrics, "_connect", broken)
+    metrics.flush()
+
+    metrics.inc("rootbox_scans_total", result="ok")
+    metrics.observe("rootbox_scan_seconds", 3.0)
+    monkeypatch.setattr(metrics, "_connect", connect)
+    metrics.flush()
+
+    text = metrics.render()
+    assert 'rootbox_scans_total{result="ok"} 2' in text
+    assert "rootbox_scan_seconds_count 2" in text
+    assert "rootbox_scan_seconds_sum 5" in text
+
+def test_label_values_are_escaped():
+    metrics.inc("rootbox_scans_total", scanner='Canon "Lide"\\1\n')
+    metrics.flush()
+    assert 'rootbox_scans_total{scanner="Canon \\"Lide\\"\\\\1\\n"} 1' in metrics.render()
@@ -0,0 +1,48 @@
+import struct
+import zlib
+
+import pytest
+
+PIL = pytest.importorskip("PIL")
+from PIL import Image, PngImagePlugin  # noqa: E402
+
+import recompress  # noqa: E402
+
+def _chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def write_rgb16_png(path, width=32, height=16):
+    """Pillow cannot write 16-bit colour PNGs, so build one by hand."""
+    rows = b"".join(
+        b"\0" + b"".join(struct.pack(">HHH", x * 2000 + 1, y * 3000 + 7, (x * y) % 65536) for x in range(width))
+        for y in range(height)
+    )
+    with open(path, 'wb') as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 16, 2, 0, 0, 0)))
+        f.write(_chunk(b"pHYs", struct.pack(">IIB", 11811, 11811, 1)))  # 300 dpi
+        f.write(_chunk(b"IDAT", zlib.compress(rows, 0)))
+        f.write(_chunk(b"IEND", b""))
+
+def test_16bit_colour_png_is_not_touched(tmp_path):
+    path = str(tmp_path / "scan.png")
+    write_rgb16_png(path)
+    before = open(path, 'rb').read()
+
+    result = recompress.recompress_file(path, "png")
+
+    assert result["status"] == "skipped"
+    assert open(path, 'rb').read() == before
+
+def test_replaced_png_keeps_dpi_and_text(tmp_path):
+    path = str(tmp_path / "scan.png")
+    info = PngImagePlugin.PngInfo()
+    info.add_text("Software", "scanimage")
+    Image.effect_noise((200, 200), 10).convert("RGB").save(path, dpi=(300, 300), pnginfo=info, compress_level=0)
+
+    result = recompress.recompress_file(path, "png")
+
+    assert result["status"] == "replaced"
+    with Image.open(result["path"]) as img:
+        assert tuple(round(d) for d in img.info["dpi"]) == (300, 300)
+        assert img.text["Software"] == "scanimage"
@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import scan_executor
+from conftest import ROOT
+
+FAKE_SCANIMAGE = os.path.join(ROOT, "benchmarks", "fake_scanimage.py")
+DEVICE = "fake:libusb:001:001"
+
+@pytest.fixture(autouse=True)
+def lock_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(scan_executor, "LOCK_DIR", str(tmp_path / "locks"))
+    monkeypatch.setattr(scan_executor, "SLOT_POLL_SECONDS", 0.05)
+    monkeypatch.setattr(scan_executor, "KILL_GRACE_SECONDS", 1)
+
+def device_is_free():
+    try:
+        with scan_executor.device_lock(DEVICE, 0.2):
+            return True
+    except scan_executor.DeviceBusy:
+        return False
+
+def test_hung_scanimage_is_killed_at_the_deadline(tmp_path, monkeypatch):
+    # A scanner that never answers: the fake scanimage sleeps for an hour
+    home = tmp_path / "home"
+    (home / "RootBox" / "web").mkdir(parents=True)
+    (home / "RootBox" / "web" / "settings.json").write_text(json.dumps(
+        {"scanners": {"scanner1": {"label": "Box", "device": DEVICE, "resolution": 75}}}))
+    monkeypatch.setenv("HOME", str(home))
+    monkeypatch.setenv("SCANIMAGE", FAKE_SCANIMAGE)
+    monkeypatch.setenv("FAKE_SCAN_SECONDS", "3600")
+    monkeypatch.setattr(scan_executor, "SCAN_IMAGE_SCRIPT", os.path.join(ROOT, "01_scan_image.py"))
+
+    started = time.monotonic()
+    with pytest.raises(scan_executor.ScanTimeout):
+        scan_executor.run_scan("scanner1", DEVICE, timeout=2)
+
+    assert time.monotonic() - started < 2 + 2 * scan_executor.KILL_GRACE_SECONDS
+    assert device_is_free()
+
+def test_hung_in_process_scan_quarantines_the_device():
+    release = threading.Event()
+
+    with pytest.raises(scan_executor.ScanTimeout):
+        scan_executor.run_scan("scanner1", DEVICE, scan_fn=lambda scanner_id: release.wait(), timeout=0.2)
+
+    # Still stuck in the "SANE call": nobody else may open the device
+    assert not device_is_free()
+    with pytest.raises(scan_executor.DeviceBusy):
+        scan_executor.run_scan("scanner1", DEVICE, scan_fn=lambda scanner_id: None, timeout=1)
+    assert scan_executor.release_quarantined() == []
+
+    release.set()
+    time.sleep(0.1)
+    assert scan_executor.release_quarantined() == [DEVICE]
+    assert device_is_free()
+
+def test_waiting_for_a_bus_slot_counts_against_the_deadline():
+    group = scan_executor.get_usb_group(DEVICE)
+    with scan_executor.bus_slot(group, 1):
+        with pytest.raises(scan_executor.DeviceBusy):
+            scan_executor.run_scan("scanner1", DEVICE, max_per_bus=1, scan_fn=lambda scanner_id: None, timeout=0.3)
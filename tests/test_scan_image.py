@@ -0,0 +1,35 @@
+import io
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+
+from conftest import load_script  # noqa: E402
+
+scan_image = load_script("01_scan_image.py", "scan_image")
+
+def pnm(header, data):
+    return io.BufferedReader(io.BytesIO(header.encode() + data))
+
+@pytest.fixture(autouse=True)
+def small_bands(monkeypatch):
+    # Several bands per test image, the last one partial
+    monkeypatch.setattr(scan_image, "PNM_BAND_BYTES", 1000)
+
+@pytest.mark.parametrize("magic, maxval, shape, dtype", [
+    ("P6", 255, (50, 77, 3), np.uint8),
+    ("P5", 255, (50, 77), np.uint8),
+    ("P5", 65535, (50, 77), ">u2"),
+])
+def test_read_pnm_decodes_in_bands(magic, maxval, shape, dtype):
+    pixels = np.random.randint(0, maxval + 1, shape).astype(dtype)
+
+    img = scan_image.read_pnm(pnm(f"{magic}\n# scanimage\n77 50\n{maxval}\n", pixels.tobytes()))
+
+    assert img.size == (77, 50)
+    assert img.tobytes() == pixels.tobytes()
+
+def test_read_pnm_rejects_a_short_stream():
+    with pytest.raises(ValueError, match="ended early"):
+        scan_image.read_pnm(pnm("P5\n77 50\n255\n", b"\0" * 3000))
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import usb_sync
+from conftest import load_script
+
+def make_scan(folder, filename, data=b"scan"):
+    path = os.path.join(folder, filename)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return {"scanner": "scanner1", "filename": filename, "path": path}
+
+@pytest.fixture
+def drive(tmp_path):
+    usb_sync._manifests.clear()
+    mount_point = tmp_path / "usb"
+    (mount_point / "scan_images" / "scanner1").mkdir(parents=True)
+    return {"mount_point": str(mount_point), "id": "1"}
+
+def test_file_already_on_drive_is_reported_present(tmp_path, drive):
+    image = make_scan(str(tmp_path), "scanner1-a-100.png")
+    with open(os.path.join(drive["mount_point"], "scan_images", "scanner1", image["filename"]), 'wb') as f:
+        f.write(b"scan")
+
+    stats = usb_sync.sync_drive(drive, [image])
+
+    assert stats["copied"] == []
+    assert stats["present_files"] == [image["filename"]]
+
+    # Second pass: known from the manifest, still reported
+    assert usb_sync.sync_drive(drive, [image])["present_files"] == [image["filename"]]
+
+def test_log_usb_sync_counts_present_files(tmp_path, drive):
+    pytest.importorskip("googleapiclient")
+    image_manager = load_script("02_image_manager.py", "image_manager")
+    old = make_scan(str(tmp_path), "scanner1-a-100.png")
+    new = make_scan(str(tmp_path), "scanner1-a-200.png")
+    usb_sync.sync_drive(drive, [old])
+
+    on_usb = image_manager.log_usb_sync(usb_sync.sync([drive], [old, new]))
+
+    assert on_usb == {old["filename"], new["filename"]}
+
+def test_recompressed_image_is_not_copied_again(tmp_path, drive):
+    image = make_scan(str(tmp_path), "scanner1-a-100.webp")
+    image["filename"] = "scanner1-a-100.png"  # catalog keeps the name it was scanned under
+
+    assert usb_sync.sync_drive(drive, [image])["copied"] == [image["filename"]]
+    usb_sync._manifests.clear()
+    stats = usb_sync.sync_drive(drive, [image])
+
+    assert stats["copied"] == []
+    assert stats["present_files"] == [image["filename"]]
+    assert "scanner1-a-100.webp" in usb_sync._read_manifest(drive["mount_point"])
@@ -0,0 +1,276 @@
+"""
+Time-lapse videos and contact sheets of a scanner's history, built on the
+device and extended in place: each run only adds the scans taken since the
+previous one.
+
+Usage:
+    python3 timelapse.py SCANNER [--video] [--sheet] [--fps 12]
+
+Output goes to ~/RootBox/timelapse/<scanner>/: timelapse.mp4 (needs ffmpeg)
+and contact sheet pages sheet-0001.png, sheet-0002.png, ...
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import image_catalog
+import previews
+
+try:
+    from PIL import Image, ImageDraw, ImageOps
+except ImportError:  # Pillow is optional; time-lapses are unavailable without it
+    Image = None
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+TIMELAPSE_DIR = os.path.join(ROOTBOX_DIR, "timelapse")
+
+# Set FFMPEG to use a different ffmpeg binary
+FFMPEG = os.environ.get("FFMPEG", "ffmpeg")
+
+# Frames come from the preview cache (previews.py), so each scan is only
+# ever downscaled once: the 1280 px preview for video, the 256 px thumbnail
+# for contact sheets. The gallery shares the same files.
+VIDEO_KIND = "preview"
+SHEET_KIND = "thumb"
+
+# Video: frames per second and x264 quality. Each run encodes its new frames
+# into a segment, and the segments are joined without re-encoding.
+DEFAULT_FPS = 12
+VIDEO_CRF = 23
+
+# Contact sheets: thumbnails per page, with the scan time under each
+SHEET_COLUMNS = 8
+SHEET_ROWS = 6
+CAPTION_HEIGHT = 16
+
+# Catalog rows fetched at a time while streaming frames
+FRAME_PAGE = 100
+
+def available():
+    return Image is not None
+
+def output_dir(scanner):
+    return os.path.join(TIMELAPSE_DIR, scanner)
+
+def load_state(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+def save_state(path, state):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+# -----------------------------
+# Frames
+# -----------------------------
+def frames(scanner, after=None):
+    """
+    A scanner's scans with a local copy (live folder and old/), oldest
+    first, by the timestamp in their filename. Only FRAME_PAGE catalog rows
+    are held at a time, however long the experiment has run.
+    """
+    while True:
+        page = image_catalog.history(scanner, after, FRAME_PAGE)
+        if not page:
+            return
+        for image in page:
+            yield image
+        after = page[-1]["timestamp"]
+
+def frame_image(image, kind):
+    """The cached downscaled copy of a scan, rendered on a miss. None if no copy is left."""
+    path = image["path"]
+    if not os.path.exists(path):
+        # Moved to old/ (or deleted) since it was listed
+        current = image_catalog.get(image["filename"])
+        path = current["path"] if current and current["location"] != image_catalog.DELETED else None
+    cached = previews.get(image["scanner"], image["filename"], kind, path)
+    if cached is None:
+        return None
+    with Image.open(cached) as img:
+        return img.convert("RGB")
+
+def fit(img, size, background):
+    """Scale an image to fit `size` and centre it on a background of that size."""
+    if img.size != size:
+        img = ImageOps.contain(img, size)
+    canvas = Image.new("RGB", size, background)
+    canvas.paste(img, ((size[0] - img.width) // 2, (size[1] - img.height) // 2))
+    return canvas
+
+def caption(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+# -----------------------------
+# Video
+# -----------------------------
+def _join_segments(folder, segments):
+    """Concatenate the encoded segments into timelapse.mp4 (stream copy, no re-encoding)."""
+    list_path = os.path.join(folder, "segments.txt")
+    with open(list_path, "w") as f:
+        for name in segments:
+            f.write(f"file 'segments/{name}'\n")
+    output = os.path.join(folder, "timelapse.mp4")
+    tmp = os.path.join(folder, ".timelapse.mp4.part")
+    subprocess.run([FFMPEG, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+                    "-c", "copy", "-movflags", "+faststart", "-f", "mp4", tmp], check=True)
+    os.replace(tmp, output)
+    return output
+
+def append_video(scanner, fps=DEFAULT_FPS):
+    """
+    Add the scans taken since the last run to the scanner's time-lapse video.
+    New frames are piped to ffmpeg one at a time as a new segment. The frame
+    size and rate are fixed by the first run. Returns the number of frames added.
+    """
+    folder = output_dir(scanner)
+    os.makedirs(os.path.join(folder, "segments"), exist_ok=True)
+    state_path = os.path.join(folder, "video.json")
+    state = load_state(state_path) or {"last_timestamp": None, "frames": 0, "size": None,
+                                       "fps": fps, "segments": []}
+    segment = f"{len(state['segments']) + 1:05d}.mp4"
+    segment_path = os.path.join(folder, "segments", segment)
+    proc = None
+    added = 0
+    last = state["last_timestamp"]
+    try:
+        for image in frames(scanner, last):
+            img = frame_image(image, VIDEO_KIND)
+            if img is None:
+                continue
+            if state["size"] is None:
+                # x264 needs even dimensions
+                state["size"] = [img.width // 2 * 2, img.height // 2 * 2]
+            width, height = state["size"]
+            frame = fit(img, (width, height), (0, 0, 0))
+            ImageDraw.Draw(frame).text((8, 8), caption(image["timestamp"]), fill=(255, 255, 255))
+            if proc is None:
+                proc = subprocess.Popen([
+                    FFMPEG, "-y", "-loglevel", "error",
+                    "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}",
+                    "-r", str(state["fps"]), "-i", "-",
+                    "-c:v", "libx264", "-preset", "veryfast", "-crf", str(VIDEO_CRF),
+                    "-pix_fmt", "yuv420p", "-f", "mp4", segment_path,
+                ], stdin=subprocess.PIPE)
+            proc.stdin.write(frame.tobytes())
+            added += 1
+            last = image["timestamp"]
+        if proc is None:
+            return 0
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with status {proc.returncode}")
+    except BaseException:
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+        if os.path.exists(segment_path):
+            os.remove(segment_path)
+        raise
+
+    state["segments"].append(segment)
+    _join_segments(folder, state["segments"])
+    state["frames"] += added
+    state["last_timestamp"] = last
+    save_state(state_path, state)
+    return added
+
+# -----------------------------
+# Contact sheets
+# -----------------------------
+def sheet_path(folder, page):
+    return os.path.join(folder, f"sheet-{page + 1:04d}.png")
+
+def append_contact_sheet(scanner, columns=SHEET_COLUMNS, rows=SHEET_ROWS):
+    """
+    Add the scans taken since the last run to the scanner's contact sheets,
+    filling the last page before starting a new one. Only the page being
+    filled is held in memory. The grid is fixed by the first run. Returns
+    the number of frames added.
+    """
+    folder = output_dir(scanner)
+    os.makedirs(folder, exist_ok=True)
+    state_path = os.path.join(folder, "sheet.json")
+    state = load_state(state_path) or {"last_timestamp": None, "frames": 0, "columns": columns, "rows": rows}
+    columns, rows = state["columns"], state["rows"]
+    cell = previews.SIZES[SHEET_KIND]
+    cell_size = (cell, cell + CAPTION_HEIGHT)
+    per_page = columns * rows
+
+    page = None
+    page_index = None
+    added = 0
+
+    def save_page():
+        page.save(sheet_path(folder, page_index), format="PNG", compress_level=6)
+        save_state(state_path, state)
+
+    for image in frames(scanner, state["last_timestamp"]):
+        img = frame_image(image, SHEET_KIND)
+        if img is None:
+            continue
+        index, position = divmod(state["frames"], per_page)
+        if index != page_index:
+            if page is not None:
+                save_page()
+            page_index = index
+            path = sheet_path(folder, index)
+            if position and os.path.exists(path):
+                with Image.open(path) as existing:
+                    page = existing.convert("RGB")
+            else:
+                page = Image.new("RGB", (columns * cell_size[0], rows * cell_size[1]), (255, 255, 255))
+        x = (position % columns) * cell_size[0]
+        y = (position // columns) * cell_size[1]
+        page.paste(fit(img, (cell, cell), (255, 255, 255)), (x, y))
+        ImageDraw.Draw(page).text((x + 4, y + cell + 2), caption(image["timestamp"]), fill=(0, 0, 0))
+        state["frames"] += 1
+        state["last_timestamp"] = image["timestamp"]
+        added += 1
+    if page is not None:
+        save_page()
+    return added
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scanner")
+    parser.add_argument("--video", action="store_true", help="extend the time-lapse video")
+    parser.add_argument("--sheet", action="store_true", help="extend the contact sheets")
+    parser.add_argument("--fps", type=int, default=DEFAULT_FPS, help="frame rate of a new video")
+    args = parser.parse_args()
+    if not available():
+        print("Pillow is not installed; time-lapses are unavailable")
+        sys.exit(1)
+    video, sheet = (args.video, args.sheet) if args.video or args.sheet else (True, True)
+
+    status = 0
+    if sheet:
+        started = time.time()
+        added = append_contact_sheet(args.scanner)
+        print(f"Contact sheet: added {added} frame(s) in {time.time() - started:.1f}s")
+    if video:
+        started = time.time()
+        try:
+            added = append_video(args.scanner, args.fps)
+            print(f"Video: added {added} frame(s) in {time.time() - started:.1f}s")
+        except FileNotFoundError:
+            print(f"ffmpeg not found ({FFMPEG}); install it with: sudo apt install ffmpeg")
+            status = 1
+        except (RuntimeError, subprocess.CalledProcessError) as e:
+            print(f"Video failed: {e}")
+            status = 1
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+
+# Find user home and RootBox directory
+HOME_DIR = os.path.expanduser("~")
+ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
+
+STATE_DIR = os.path.join(ROOTBOX_DIR, "state")
+QUEUE_DB_PATH = os.path.join(STATE_DIR, "upload_queue.db")
+
+# Retry backoff: BASE * 2^attempts seconds (with jitter), capped at MAX
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 3600
+
+# Upload states
+PENDING = "pending"
+UPLOADING = "uploading"
+DONE = "done"
+LOST = "lost"  # file vanished before it could be uploaded
+SKIPPED = "skipped"  # kept on the device only (see change_detect.py policies)
+
+# Priorities: due items are uploaded lowest number first
+NORMAL_PRIORITY = 0
+LOW_PRIORITY = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    filename      TEXT PRIMARY KEY,
+    scanner       TEXT NOT NULL,
+    path          TEXT NOT NULL,
+    timestamp     INTEGER NOT NULL,
+    state         TEXT NOT NULL DEFAULT 'pending',
+    usb_done      INTEGER NOT NULL DEFAULT 0,
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    next_attempt  REAL NOT NULL DEFAULT 0,
+    last_error    TEXT,
+    created       REAL NOT NULL,
+    priority      INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS uploads_due ON uploads (state, next_attempt, timestamp);
+"""
+
+_lock = threading.Lock()
+_conn = None
+
+def _connect():
+    global _conn
+    if _conn is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        conn = sqlite3.connect(QUEUE_DB_PATH, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _migrate(conn)
+        _conn = conn
+    return _conn
+
+def _migrate(conn):
+    """Bring queues created by older versions up to the current schema."""
+    columns = {r["name"] for r in conn.execute("PRAGMA table_info(uploads)")}
+    if "priority" not in columns:
+        conn.execute("ALTER TABLE uploads ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS uploads_priority ON uploads (state, priority, timestamp)")
+
+def _execute(sql, params=()):
+    """Run a write statement; returns the number of rows changed."""
+    with _lock:
+        return _connect().execute(sql, params).rowcount
+
+def _query(sql, params=()):
+    with _lock:
+        return _connect().execute(sql, params).fetchall()
+
+def enqueue(scanner, path, timestamp, state=PENDING, priority=NORMAL_PRIORITY):
+    """Record a scan. Files already in the queue are left untouched. Returns True if added."""
+    added = _execute(
+        "INSERT OR IGNORE INTO uploads (filename, scanner, path, timestamp, state, created, priority) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (os.path.basename(path), scanner, path, timestamp, state, time.time(), priority),
+    )
+    return added > 0
+
+def unknown_filenames(filenames):
+    """Subset of `filenames` that have never been queued."""
+    filenames = list(filenames)
+    known = set()
+    for start in range(0, len(filenames), 500):
+        chunk = filenames[start:start + 500]
+        marks = ",".join("?" * len(chunk))
+        known.update(r["filename"] for r in _query(f"SELECT filename FROM uploads WHERE filename IN ({marks})", chunk))
+    return [f for f in filenames if f not in known]
+
+def update_path(filename, path):
+    """Follow a queued file when it is moved (e.g. to old/)."""
+    _execute("UPDATE uploads SET path=? WHERE filename=?", (path, filename))
+
+def due_items(limit, now=None):
+    """
+    Pending uploads whose backoff has expired, oldest first with low priority
+    items after all others; marks them as uploading.
+    """
+    now = time.time() if now is None else now
+    with _lock:
+        conn = _connect()
+        rows = conn.execute(
+            "SELECT * FROM uploads WHERE state=? AND next_attempt<=? ORDER BY priority, timestamp LIMIT ?",
+            (PENDING, now, limit),
+        ).fetchall()
+        conn.executemany(
+            "UPDATE uploads SET state=? WHERE filename=?",
+            [(UPLOADING, r["filename"]) for r in rows],
+        )
+    return [dict(r) for r in rows]
+
+def mark_usb_done(filename):
+    _execute("UPDATE uploads SET usb_done=1 WHERE filename=?", (filename,))
+
+def mark_done(filename):
+    _execute("UPDATE uploads SET state=?, last_error=NULL WHERE filename=?", (DONE, filename))
+
+def mark_lost(filename, error):
+    _execute("UPDATE uploads SET state=?, last_error=? WHERE filename=?", (LOST, str(error), filename))
+
+def mark_skipped(filename, reason):
+    """Take an item out of the queue without uploading it; `reason` allows requeue_skipped() later."""
+    _execute("UPDATE uploads SET state=?, last_error=? WHERE filename=? AND state IN (?, ?)",
+             (SKIPPED, str(reason), filename, PENDING, UPLOADING))
+
+def requeue_skipped(reason):
+    """Put items skipped for `reason` back in the queue. Returns how many."""
+    return _execute("UPDATE uploads SET state=?, attempts=0, next_attempt=0, last_error=NULL "
+                    "WHERE state=? AND last_error=?", (PENDING, SKIPPED, str(reason)))
+
+def backoff_delay(attempts):
+    delay = min(BACKOFF_BASE_SECONDS * 2 ** attempts, BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+def mark_failed(filename, error):
+    """Put an item back in the queue with exponential backoff. Returns the delay in seconds."""
+    with _lock:
+        conn = _connect()
+        row = conn.execute("SELECT attempts FROM uploads WHERE filename=?", (filename,)).fetchone()
+        attempts = row["attempts"] if row else 0
+        delay = backoff_delay(attempts)
+        conn.execute(
+            "UPDATE uploads SET state=?, attempts=?, next_attempt=?, last_error=? WHERE filename=?",
+            (PENDING, attempts + 1, time.time() + delay, str(error), filename),
+        )
+    return delay
+
+def recover_interrupted():
+    """
+    Put items left "uploading" by a process that stopped mid-upload back in
+    the queue. Only call this while no other process can be uploading (see
+    the image manager's worker lock). Returns how many.
+    """
+    return _execute("UPDATE uploads SET state=? WHERE state=?", (PENDING, UPLOADING))
+
+def release(filename):
+    """Return a claimed item to the queue without counting an attempt."""
+    _execute("UPDATE uploads SET state=? WHERE filename=? AND state=?", (PENDING, filename, UPLOADING))
+
+def is_pending(filename):
+    rows = _query("SELECT state FROM uploads WHERE filename=?", (filename,))
+    return bool(rows) and rows[0]["state"] in (PENDING, UPLOADING)
+
+def pending_count():
+    return _query("SELECT COUNT(*) AS n FROM uploads WHERE state IN (?, ?)", (PENDING, UPLOADING))[0]["n"]
+
+def next_attempt_time():
+    """Earliest time a pending upload becomes due, or None if nothing is pending."""
+    return _query("SELECT MIN(next_attempt) AS t FROM uploads WHERE state=?", (PENDING,))[0]["t"]
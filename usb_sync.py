@@ -0,0 +1,256 @@
+import os
+import select
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+# Each drive keeps an append-only list of the images already copied to it,
+# one "<filename>\t<size>" line per image, under <drive>/scan_images/.
+# Only complete lines count, so a drive pulled mid-write loses at most the
+# last entry (and that image is simply checked again next time).
+MANIFEST_NAME = ".rootbox_manifest"
+# During a backfill the manifest is appended to after this many copies
+MANIFEST_FLUSH_EVERY = 20
+
+# -----------------------------
+# Mount discovery
+# -----------------------------
+def _unescape(field):
+    """mountinfo escapes space, tab, newline and backslash as \\ooo octal."""
+    if "\\" not in field:
+        return field
+    out, i = [], 0
+    while i < len(field):
+        if field[i] == "\\" and field[i + 1:i + 4].isdigit():
+            out.append(chr(int(field[i + 1:i + 4], 8)))
+            i += 4
+        else:
+            out.append(field[i])
+            i += 1
+    return "".join(out)
+
+def parse_mountinfo(text):
+    """
+    Mounts listed in /proc/<pid>/mountinfo, as dicts with id, mount_point,
+    fstype, source and read_only. Malformed lines are skipped.
+    """
+    mounts = []
+    for line in text.splitlines():
+        fields = line.split()
+        try:
+            sep = fields.index("-", 6)
+            mounts.append({
+                "id": int(fields[0]),
+                "mount_point": _unescape(fields[4]),
+                "fstype": fields[sep + 1],
+                "source": _unescape(fields[sep + 2]),
+                "read_only": "ro" in fields[5].split(","),
+            })
+        except (ValueError, IndexError):
+            continue
+    return mounts
+
+class MountTable:
+    """
+    The mount table, parsed from mountinfo only after the kernel reports a
+    change: mountinfo signals POLLPRI|POLLERR to every reader whenever
+    something is mounted or unmounted, so an unchanged table costs one
+    poll() call instead of a directory walk. Each instance holds its own
+    file handle and therefore sees every change once.
+    """
+
+    def __init__(self, path=MOUNTINFO_PATH):
+        self.path = path
+        self._file = None
+        self._poll = None
+        self._mounts = None
+        self._lock = threading.Lock()
+
+    def changed(self, timeout=0):
+        """
+        Wait up to `timeout` seconds for the mount table to change. True if it
+        changed (or has not been read yet); the next mounts() call re-reads it.
+        """
+        if self._file is None:
+            self._file = open(self.path, 'rb', buffering=0)
+            self._poll = select.poll()
+            self._poll.register(self._file, select.POLLPRI | select.POLLERR)
+            return True
+        events = self._poll.poll(None if timeout is None else timeout * 1000)
+        if any(event & (select.POLLPRI | select.POLLERR) for _, event in events):
+            self._mounts = None
+            return True
+        return False
+
+    def mounts(self):
+        with self._lock:
+            self.changed()
+            if self._mounts is None:
+                self._file.seek(0)
+                self._mounts = parse_mountinfo(self._file.read().decode("utf-8", errors="replace"))
+            return list(self._mounts)
+
+    def mounts_under(self, bases):
+        """
+        Writable mounts that are one of `bases` or an immediate child of one,
+        in the order of `bases`.
+        """
+        bases = [os.path.normpath(b) for b in bases]
+        mounts = [m for m in self.mounts() if not m["read_only"]]
+        result, seen = [], set()
+        for base in bases:
+            for m in mounts:
+                mp = m["mount_point"]
+                if mp in seen or (mp != base and os.path.dirname(mp) != base):
+                    continue
+                if os.access(mp, os.W_OK | os.X_OK):
+                    seen.add(mp)
+                    result.append(m)
+        return result
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+# -----------------------------
+# Manifest
+# -----------------------------
+_manifests = {}  # mount point -> (mount id, {filename: size})
+_drive_locks = {}
+_drive_locks_guard = threading.Lock()
+
+def _drive_lock(mount_point):
+    with _drive_locks_guard:
+        return _drive_locks.setdefault(mount_point, threading.Lock())
+
+def manifest_path(mount_point):
+    return os.path.join(mount_point, "scan_images", MANIFEST_NAME)
+
+def _read_manifest(mount_point):
+    files = {}
+    try:
+        with open(manifest_path(mount_point), 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                name, _, size = line.decode("utf-8", errors="replace").rstrip("\n").partition("\t")
+                if name and size.isdigit():
+                    files[name] = int(size)
+    except FileNotFoundError:
+        pass
+    return files
+
+def _manifest(drive):
+    """{filename: size} already on a drive. Cached per mount, so a different drive at the same path is re-read."""
+    cached = _manifests.get(drive["mount_point"])
+    if cached is None or cached[0] != drive["id"]:
+        cached = (drive["id"], _read_manifest(drive["mount_point"]))
+        _manifests[drive["mount_point"]] = cached
+    return cached[1]
+
+def _append_manifest(mount_point, entries):
+    if not entries:
+        return
+    data = "".join(f"{name}\t{size}\n" for name, size in entries).encode("utf-8")
+    os.makedirs(os.path.dirname(manifest_path(mount_point)), exist_ok=True)
+    fd = os.open(manifest_path(mount_point), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# -----------------------------
+# Copying
+# -----------------------------
+def _copy(src_path, dest_path):
+    """Copy to a temporary name, flush it to the drive, then rename into place."""
+    tmp_path = dest_path + ".part"
+    shutil.copy2(src_path, tmp_path)
+    fd = os.open(tmp_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, dest_path)
+
+def sync_drive(drive, images):
+    """
+    Copy the `images` (dicts with scanner, filename, path) that `drive` does
+    not have yet to <drive>/scan_images/<scanner>/. The manifest records the
+    name written to the drive, which differs from the catalog filename once
+    an image has been recompressed. An image is skipped if the manifest lists
+    either name, or if a file of the same name and size is already on the
+    drive (e.g. copied before manifests existed). Stops at the first
+    error that is not about the source file, as the drive is most likely
+    gone or full.
+    Returns {"copied": [filenames], "present": n, "present_files": [filenames
+    the drive already had], "bytes": n, "seconds": n, "error": str or None}.
+    """
+    root = drive["mount_point"]
+    stats = {"copied": [], "present": 0, "present_files": [], "bytes": 0, "seconds": 0.0, "error": None}
+    started = time.time()
+    lock = _drive_lock(root)
+    pending = []
+    try:
+        for image in images:
+            # The drive is locked per file, not per pass, so copying a single
+            # new scan never waits for more than one file of a long back-fill
+            with lock:
+                manifest = _manifest(drive)
+                name = os.path.basename(image["path"])
+                if name in manifest or image["filename"] in manifest:
+                    stats["present_files"].append(image["filename"])
+                    continue
+                try:
+                    size = os.path.getsize(image["path"])
+                except OSError:
+                    continue  # evicted or recompressed since it was listed
+                dest_dir = os.path.join(root, "scan_images", image["scanner"])
+                dest_path = os.path.join(dest_dir, name)
+                try:
+                    present = os.path.getsize(dest_path) == size
+                except OSError:
+                    present = False
+                if present:
+                    stats["present"] += 1
+                    stats["present_files"].append(image["filename"])
+                else:
+                    os.makedirs(dest_dir, exist_ok=True)
+                    _copy(image["path"], dest_path)
+                    stats["copied"].append(image["filename"])
+                    stats["bytes"] += size
+                manifest[name] = size
+                pending.append((name, size))
+                if len(pending) >= MANIFEST_FLUSH_EVERY:
+                    _append_manifest(root, pending)
+                    pending = []
+    except Exception as ex:
+        stats["error"] = str(ex)
+    with lock:
+        try:
+            _append_manifest(root, pending)
+        except Exception as ex:
+            stats["error"] = stats["error"] or str(ex)
+            # Not recorded on the drive; read the manifest again next time
+            _manifests.pop(root, None)
+    stats["seconds"] = time.time() - started
+    return stats
+
+def sync(drives, images):
+    """
+    Sync the same images to several drives at once, one thread per drive, so
+    a slow stick does not hold up the others.
+    Returns {mount point: stats} as from sync_drive.
+    """
+    images = list(images)
+    if len(drives) == 1:
+        return {drives[0]["mount_point"]: sync_drive(drives[0], images)}
+    with ThreadPoolExecutor(max_workers=max(1, len(drives)), thread_name_prefix="usb-sync") as pool:
+        futures = {d["mount_point"]: pool.submit(sync_drive, d, images) for d in drives}
+    return {mp: f.result() for mp, f in futures.items()}
@@ -1,9 +1,14 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context, send_file
+import fcntl
+import hashlib
 import json
 import os
 import subprocess
 import signal
-from datetime import datetime, timedelta
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 app = Flask(__name__)
 app.secret_key = 'rootbox-secret'  # Replace with secure key in production
@@ -15,9 +20,44 @@ ROOTBOX_DIR = os.path.join(HOME_DIR, "RootBox")
 # File paths
 SETTINGS_PATH = os.path.join(ROOTBOX_DIR, 'web', 'settings.json')
 DEVICES_PATH = os.path.join(ROOTBOX_DIR,'web','scanner_devices.json')
+SETTINGS_LOCK_PATH = os.path.join(ROOTBOX_DIR, 'web', '.settings.lock')
 PID_FILE = os.path.join(ROOTBOX_DIR, 'controller.pid')
 CONTROL_SCRIPT = os.path.join(ROOTBOX_DIR,'00_scan_control.py')
 
+# Live log stream: how often the log is checked for new lines, how often an
+# idle stream sends a keep-alive, and how long one connection is held before
+# the browser is made to reconnect (it resumes from the last line it got)
+LOG_STREAM_POLL_SECONDS = 0.5
+LOG_STREAM_KEEPALIVE_SECONDS = 15
+LOG_STREAM_MAX_SECONDS = 300
+
+# Scan gallery: images per page, and how long browsers may reuse a preview
+# without asking (a preview never changes for a given scan)
+GALLERY_PAGE_SIZE = 24
+GALLERY_MAX_PAGE_SIZE = 100
+PREVIEW_MAX_AGE = 7 * 24 * 3600
+
+# How long saving settings waits for a busy device before validating its
+# scan settings without the device's option ranges
+DEVICE_QUERY_WAIT_SECONDS = 5
+
+sys.path.insert(0, ROOTBOX_DIR)
+from scan_executor import run_scan, scan_timeout, device_lock, DeviceBusy, ScanTimeout, DEFAULT_MAX_SCANS_PER_BUS, DEFAULT_GROUP_BY
+import device_options
+import image_catalog
+import log_tail
+import metrics
+import previews
+import rootbox_log
+import scan_jobs
+import state_store
+from rootbox_log import LOG_PATH
+
+# Manual scans run in the background; device locks still serialise them
+# with the controller and with each other
+MANUAL_SCAN_WORKERS = 6
+manual_scan_executor = ThreadPoolExecutor(max_workers=MANUAL_SCAN_WORKERS)
+
 def load_json(path):
     try:
         with open(path, 'r') as f:
@@ -26,8 +66,50 @@ def load_json(path):
         return {}
 
 def save_json(path, data):
-    with open(path, 'w') as f:
+    """Write via a temp file and rename, so readers never see a half-written file."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
         json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+@contextmanager
+def settings_lock():
+    """Serialise read-modify-write of settings.json between web workers."""
+    with open(SETTINGS_LOCK_PATH, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def options_for_device(device):
+    """A device's cached option ranges, querying the device if it was never queried. None if unknown."""
+    if not device:
+        return None
+    options = device_options.cached(device)
+    if options is None:
+        try:
+            with device_lock(device, DEVICE_QUERY_WAIT_SECONDS):
+                options = device_options.refresh(device)
+        except Exception:
+            return None
+    return options
+
+def parse_scan_geometry(form, scanner_id):
+    """Mode, depth and scan area fields of one scanner row. Raises ValueError for malformed input."""
+    fields = {'mode': form.get(f'mode_{scanner_id}') or 'Color'}
+    depth = form.get(f'depth_{scanner_id}', '')
+    fields['depth'] = int(depth) if depth else None
+    roi = {k: form.get(f'roi_{k}_{scanner_id}', '').strip() for k in device_options.GEOMETRY}
+    if any(roi.values()):
+        if not all(roi.values()):
+            raise ValueError("scan area needs all of left, top, width and height (or none for the full bed)")
+        fields['roi'] = {k: float(v) if '.' in v else int(v) for k, v in roi.items()}
+    else:
+        fields['roi'] = None
+    return fields
 
 def is_controller_running():
     if os.path.exists(PID_FILE):
@@ -66,46 +148,65 @@ def index():
     scanners = settings.get('scanners', {})
 
     if request.method == 'POST':
-        for scanner_id in scanners.keys():
-            label = request.form.get(f'label_{scanner_id}', '').strip()
-            enabled = request.form.get(f'enabled_{scanner_id}') == 'on'
-            interval = int(request.form.get(f'interval_{scanner_id}', '60'))
-            resolution = int(request.form.get(f'res_{scanner_id}', '150'))
-            device = request.form.get(f'device_{scanner_id}', '')
-
-            scanners[scanner_id].update({
-                'label': label,
-                'enabled': enabled,
-                'interval_minutes': interval,
-                'resolution': resolution,
-                'device': device
-            })
-
-        settings['scanners'] = scanners
-        save_json(SETTINGS_PATH, settings)
+        # Query devices that were never queried before taking the settings
+        # lock, so a slow USB query does not hold up other saves
+        device_opts = {device: options_for_device(device)
+                       for key, device in request.form.items() if key.startswith('device_') and device}
+        with settings_lock():
+            # Re-read under the lock so a concurrent save isn't overwritten
+            settings = load_json(SETTINGS_PATH)
+            scanners = settings.get('scanners', {})
+            errors = []
+            for scanner_id in scanners.keys():
+                label = request.form.get(f'label_{scanner_id}', '').strip()
+                enabled = request.form.get(f'enabled_{scanner_id}') == 'on'
+                interval = int(request.form.get(f'interval_{scanner_id}', '60'))
+                if interval < 1:
+                    errors.append(f"{scanner_id}: interval must be at least 1 minute")
+                    continue
+                resolution = int(request.form.get(f'res_{scanner_id}', '150'))
+                device = request.form.get(f'device_{scanner_id}', '')
+                try:
+                    geometry = parse_scan_geometry(request.form, scanner_id)
+                except ValueError as e:
+                    errors.append(f"{scanner_id}: {e}")
+                    continue
+
+                scanners[scanner_id].update({
+                    'label': label,
+                    'enabled': enabled,
+                    'interval_minutes': interval,
+                    'resolution': resolution,
+                    'device': device,
+                    **geometry
+                })
+                # 🔽 Check resolution, mode, depth and scan area against what the device supports
+                errors += [f"{scanner_id}: {e}"
+                           for e in device_options.validate(scanners[scanner_id],
+                                                           device_opts.get(device) or device_options.cached(device))]
+
+            if errors:
+                for error in errors:
+                    flash(f"❌ {error}", "danger")
+                flash("Settings were not saved.", "danger")
+                return redirect(url_for('index'))
+            settings['scanners'] = scanners
+            save_json(SETTINGS_PATH, settings)
         flash("Settings saved successfully.", "success")
         return redirect(url_for('index'))
 
+    # 🔽 Runtime state (last scan, next deadline, health) from the state store
+    states = state_store.scanner_states()
+
     # 🔽 Calculate estimated time remaining per scanner
     countdowns = {}
-    now = datetime.now()
+    now = time.time()
     for scanner_id, config in scanners.items():
-        if config.get("enabled") and "last_scan" in config:
-            try:
-                last_scan = datetime.fromisoformat(config["last_scan"])
-                interval = config.get("interval_minutes", 60)
-                next_scan = last_scan + timedelta(minutes=interval)
-                remaining_td = next_scan - now
-                if remaining_td.total_seconds() > 0:
-                    total_minutes = int(remaining_td.total_seconds() // 60)
-                    hours = total_minutes // 60
-                    minutes = total_minutes % 60
-                    countdowns[scanner_id] = f"{hours:02}:{minutes:02}"
-                else:
-                    countdowns[scanner_id] = "00:00"
-
-            except Exception:
-                countdowns[scanner_id] = None
+        next_due = states.get(scanner_id, {}).get("next_due")
+        if config.get("enabled") and next_due:
+            remaining = max(0, next_due - now)
+            total_minutes = int(remaining // 60)
+            countdowns[scanner_id] = f"{total_minutes // 60:02}:{total_minutes % 60:02}"
         else:
             countdowns[scanner_id] = None
 
@@ -117,6 +218,13 @@ def index():
             device_count[device] = device_count.get(device, 0) + 1
     duplicate_devices = {dev for dev, count in device_count.items() if count > 1}
 
+    # 🔽 Manual scans still in progress, so the page can keep tracking them
+    active_jobs = {}
+    for scanner_id in scanners:
+        job = scan_jobs.active_job(scanner_id)
+        if job:
+            active_jobs[scanner_id] = job['id']
+
     running = is_controller_running()
     return render_template(
         'index.html',
@@ -124,7 +232,12 @@ def index():
         available_devices=available_devices,
         running=running,
         duplicate_devices=duplicate_devices,
-        countdowns=countdowns
+        countdowns=countdowns,
+        active_jobs=active_jobs,
+        states=states,
+        device_opts=device_options.all_cached(),
+        default_modes=device_options.DEFAULT_MODES,
+        default_depths=device_options.DEFAULT_DEPTHS
     )
 
 @app.route('/start', methods=['POST'])
@@ -134,39 +247,224 @@ def start():
 
 @app.route('/stop', methods=['POST'])
 def stop():
-    stopped = stop_controller()
-
-    if stopped:
-        settings = load_json(SETTINGS_PATH)
-        for config in settings.get('scanners', {}).values():
-            config.pop("last_scan", None)  # remove the timer
-        save_json(SETTINGS_PATH, settings)
-
+    # The schedule is kept, so the next start resumes each scanner's phase
+    stop_controller()
     return redirect(url_for('index'))
     
-@app.route('/manual_scan/<scanner_id>', methods=['POST'])
-def manual_scan(scanner_id):
+def run_manual_scan(job_id, scanner_id, settings, timeout):
+    """Background body of a manual scan job."""
+    config = settings.get('scanners', {}).get(scanner_id, {})
+    started = time.time()
+    scan_jobs.set_state(job_id, scan_jobs.WAITING)
     try:
-        result = subprocess.run(
-            ['python3', os.path.join(ROOTBOX_DIR, '01_scan_image.py'), scanner_id],
-            check=True
+        run_scan(
+            scanner_id,
+            config.get('device', ''),
+            settings.get('max_scans_per_bus', DEFAULT_MAX_SCANS_PER_BUS),
+            settings.get('scan_group_by', DEFAULT_GROUP_BY),
+            timeout=timeout,
+            on_locked=lambda: scan_jobs.set_state(job_id, scan_jobs.SCANNING)
         )
-        flash(f"✅ Manual scan for {scanner_id} completed successfully.", "success")
+        image = None
+        try:
+            latest = image_catalog.images(image_catalog.LIVE, scanner_id, after=int(started) - 1)
+            image = latest[-1]['filename'] if latest else None
+        except Exception:
+            pass
+        # Picked up by the controller's image manager like a scheduled scan
+        state_store.post_scan_event(scanner_id)
+        scan_jobs.finish(job_id, True, f"✅ Manual scan for {scanner_id} completed successfully.", image)
+        metrics.inc('rootbox_manual_scans_total', scanner=scanner_id, result='ok')
+    except DeviceBusy as e:
+        scan_jobs.finish(job_id, False, f"⏳ Manual scan for {scanner_id} could not start: {e}")
+        metrics.inc('rootbox_manual_scans_total', scanner=scanner_id, result='busy')
+    except ScanTimeout as e:
+        scan_jobs.finish(job_id, False, f"⏱ Manual scan for {scanner_id} timed out: {e}")
+        metrics.inc('rootbox_manual_scans_total', scanner=scanner_id, result='timeout')
     except subprocess.CalledProcessError as e:
-        flash(f"❌ Manual scan for {scanner_id} failed: {e}", "danger")
-    return redirect(url_for('index'))
+        scan_jobs.finish(job_id, False, f"❌ Manual scan for {scanner_id} failed: {e}")
+        metrics.inc('rootbox_manual_scans_total', scanner=scanner_id, result='failed')
+    except Exception as e:
+        scan_jobs.finish(job_id, False, f"❌ Manual scan for {scanner_id} error: {e}")
+        metrics.inc('rootbox_manual_scans_total', scanner=scanner_id, result='failed')
+
+def readable(text):
+    """Render structured log lines as text for the log panel."""
+    return "".join(rootbox_log.format_line(line) + "\n" for line in text.splitlines())
+
+def job_json(job):
+    now = time.time()
+    return {
+        'id': job['id'],
+        'scanner': job['scanner'],
+        'state': job['state'],
+        'done': job['state'] not in scan_jobs.ACTIVE_STATES,
+        'ok': job['state'] == scan_jobs.DONE,
+        'queued_seconds': round((job['started'] or job['finished'] or now) - job['created'], 1),
+        'scan_seconds': round((job['finished'] or now) - job['started'], 1) if job['started'] else None,
+        'timeout': job['timeout'],
+        'message': job['message'],
+        'image': job['image'],
+    }
+
+@app.route('/manual_scan/<scanner_id>', methods=['POST'])
+def manual_scan(scanner_id):
+    """Queue a manual scan. Returns the job straight away; poll /jobs/<id> for the result."""
+    settings = load_json(SETTINGS_PATH)
+    config = settings.get('scanners', {}).get(scanner_id)
+    if config is None:
+        return jsonify({'error': f"Unknown scanner {scanner_id}"}), 404
+    timeout = scan_timeout(config.get('resolution', 150), settings.get('scan_timeouts'),
+                           config.get('scan_timeout_seconds'))
+
+    job, created = scan_jobs.create(scanner_id, timeout)
+    if created:
+        manual_scan_executor.submit(run_manual_scan, job['id'], scanner_id, settings, timeout)
+    response = job_json(job)
+    response['created'] = created
+    return jsonify(response), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = scan_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job_json(job))
+
+@app.route('/scans/<scanner_id>')
+def scan_gallery(scanner_id):
+    """
+    One page of a scanner's scans, newest first, with links to their
+    thumbnail and preview. `page` starts at 1; `per_page` defaults to
+    GALLERY_PAGE_SIZE. Supports If-None-Match.
+    """
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(max(1, request.args.get('per_page', GALLERY_PAGE_SIZE, type=int)), GALLERY_MAX_PAGE_SIZE)
+    total = (image_catalog.location_count(image_catalog.LIVE, scanner_id)
+             + image_catalog.location_count(image_catalog.OLD, scanner_id))
+    images = []
+    for image in image_catalog.recent(scanner_id, per_page, (page - 1) * per_page):
+        images.append({
+            'filename': image['filename'],
+            'timestamp': image['timestamp'],
+            'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(image['timestamp'])),
+            'size': image['size'],
+            'location': image['location'],
+            'upload_state': image['upload_state'],
+            'duplicate': bool(image['duplicate']),
+            'thumb': url_for('scan_preview', scanner_id=scanner_id, filename=image['filename'], kind='thumb'),
+            'preview': url_for('scan_preview', scanner_id=scanner_id, filename=image['filename'], kind='preview'),
+        })
+    response = jsonify({
+        'scanner': scanner_id,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': (total + per_page - 1) // per_page,
+        'previews': previews.available(),
+        'images': images,
+    })
+    response.set_etag(hashlib.md5(response.get_data()).hexdigest())
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route('/scans/<scanner_id>/<filename>/<kind>')
+def scan_preview(scanner_id, filename, kind):
+    """A JPEG thumbnail or preview of one scan, from the preview cache (rendered on a miss)."""
+    if kind not in previews.SIZES:
+        return jsonify({'error': f"Unknown preview kind {kind}"}), 404
+    if not previews.available():
+        return jsonify({'error': 'Pillow is not installed; previews are unavailable'}), 503
+    image = image_catalog.get(filename)
+    if image is None or image['scanner'] != scanner_id:
+        return jsonify({'error': 'Unknown scan'}), 404
+    src = image['path'] if image['location'] != image_catalog.DELETED else None
+    try:
+        path = previews.get(scanner_id, filename, kind, src)
+    except Exception as e:
+        return jsonify({'error': f"Could not render preview: {e}"}), 500
+    if path is None:
+        return jsonify({'error': 'Scan no longer stored on the device'}), 404
+    return send_file(path, mimetype='image/jpeg', conditional=True, etag=True, max_age=PREVIEW_MAX_AGE)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Pipeline metrics from every RootBox process, in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/log')
 def view_log():
-    log_path = os.path.join(ROOTBOX_DIR, 'logs', 'control_log.txt')
+    """
+    Without parameters: the last `lines` (default 50) lines as text, with the
+    position to continue from in the X-Log-Offset / X-Log-File headers.
+    With `offset` (and `file`): JSON with only the lines written since.
+    `format=json` returns the raw JSON-lines records instead of text.
+    """
     try:
-        with open(log_path, 'r') as f:
-            lines = f.readlines()
-        last_lines = lines[-50:]
-        return ''.join(last_lines)
+        if 'offset' in request.args:
+            try:
+                text, offset, fid, reset = log_tail.read_since(
+                    LOG_PATH, request.args.get('offset', 0, type=int), request.args.get('file'))
+            except FileNotFoundError:
+                text, offset, fid, reset = "", 0, "", False  # nothing logged yet
+            if request.args.get('format') != 'json':
+                text = readable(text)
+            return jsonify({'text': text, 'offset': offset, 'file': fid, 'reset': reset})
+        try:
+            text, offset, fid = log_tail.tail(LOG_PATH, request.args.get('lines', 50, type=int))
+        except FileNotFoundError:
+            text, offset, fid = "", 0, ""  # nothing logged yet
+        if request.args.get('format') == 'json':
+            return Response(text, mimetype='application/x-ndjson', headers={'X-Log-Offset': str(offset), 'X-Log-File': fid})
+        return Response(readable(text), mimetype='text/plain', headers={'X-Log-Offset': str(offset), 'X-Log-File': fid})
     except Exception as e:
         return f"⚠️ Error reading log file: {e}"
 
+@app.route('/log/stream')
+def stream_log():
+    """
+    Server-Sent Events: each event carries the new log lines, with
+    "<file>:<offset>" as its id so a reconnecting browser resumes where it
+    left off. Starts from `offset`/`file`, or the end of the log.
+    """
+    fid, _, offset = request.headers.get('Last-Event-ID', '').rpartition(':')
+    if not (fid and offset.isdigit()):
+        # No usable Last-Event-ID (browsers resend whatever they last saw)
+        fid = request.args.get('file') or log_tail.file_id(LOG_PATH)
+        offset = request.args.get('offset')
+        if offset is not None and not offset.isdigit():
+            return Response("offset must be a non-negative integer", status=400, mimetype='text/plain')
+        if offset is None:
+            try:
+                offset = os.path.getsize(LOG_PATH)
+            except OSError:
+                offset = 0
+    offset = int(offset)
+
+    def events(offset, fid):
+        started = last_sent = time.time()
+        while time.time() - started < LOG_STREAM_MAX_SECONDS:
+            try:
+                text, offset, fid, reset = log_tail.read_since(LOG_PATH, offset, fid)
+            except OSError:
+                text, reset = "", False
+            if reset:
+                yield "event: reset\ndata: \n\n"
+            if text:
+                data = "\n".join(f"data: {rootbox_log.format_line(line)}" for line in text.splitlines())
+                yield f"id: {fid}:{offset}\n{data}\n\n"
+                last_sent = time.time()
+            elif time.time() - last_sent >= LOG_STREAM_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                last_sent = time.time()
+            time.sleep(LOG_STREAM_POLL_SECONDS)
+
+    return Response(
+        stream_with_context(events(offset, fid)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)